@@ -8,46 +8,94 @@ import logging
 from flask import Flask, current_app
 
 from .config import BasicConfig, ProdConfig
-from .helpers import config_logging
+from .helpers import config_logging, ROOM_MODES
 from .post_requests import add
-from .get_requests import stories
+from .get_requests import stories, monitoring
 from .db_hanlder import DBHandler
+from .migrations import migrate_command
+from .archive import compact_command
+from .transfer import export_command, import_command
+from .trace import TraceRecorder
+from .startup import StartupReport
+from . import metrics, serialize, compress
 
 
 LOG = logging.getLogger("collab")
 
-def create_app():
+def create_app(test_config=None):
     """
     driver method for assembling all configuration
     and logging
 
+    :param test_config: settings overriding the configuration, e.g. to run
+        against a scratch directory
+    :type test_config: dict
+    :raises StorageUnavailable: the database could not be set up
     :return: server app
     :rtype: Flask App
     """
     LOG.debug("Initialising flask module...")
-    app = Flask(__name__, instance_relative_config=True)
-    if os.environ.get("FLASK_ENV", "dev").lower() == "production":
-        app.config.from_object(ProdConfig)
-    else:
-        app.config.from_object(BasicConfig)
-    # context intialized early to setup database and other related services
-    app.app_context().push()
-
-    try:
-        os.makedirs(current_app.config['DIR'], exist_ok=True)
-    except OSError as err:
-        LOG.debug(err)
-        LOG.error("Error: Unable to create %s", current_app.config['DIR'])
-        LOG.warning("Initialisation aborted!")
-
-    LOG.debug("Initialising logging module...")
-    config_logging()
-
-    # initialisating database
-    DBHandler()
-
-    # adding blueprints
-    app.register_blueprint(add)
-    app.register_blueprint(stories)
-
-    return app
\ No newline at end of file
+    report = StartupReport()
+    with report.phase("config"):
+        app = Flask(__name__, instance_relative_config=True)
+        if os.environ.get("FLASK_ENV", "dev").lower() == "production":
+            app.config.from_object(ProdConfig)
+        else:
+            app.config.from_object(BasicConfig)
+        if test_config is not None:
+            app.config.from_mapping(test_config)
+
+    # the context only lives while the app is set up, requests, CLI
+    # commands and background threads push their own
+    with app.app_context():
+        try:
+            os.makedirs(current_app.config['DIR'], exist_ok=True)
+        except OSError as err:
+            LOG.debug(err)
+            LOG.error("Error: Unable to create %s", current_app.config['DIR'])
+            LOG.warning("Initialisation aborted!")
+
+        LOG.debug("Initialising logging module...")
+        with report.phase("logging"):
+            config_logging()
+
+        # JSON of request and response bodies
+        with report.phase("json"):
+            LOG.debug("JSON backend: %s", serialize.use(current_app.config['JSON_BACKEND']))
+            app.json = serialize.JSONProvider(app)
+
+        if current_app.config['ROOMS'] not in ROOM_MODES:
+            raise ValueError("unknown ROOMS mode {}".format(current_app.config['ROOMS']))
+
+        # request timing and database instrumentation
+        with report.phase("metrics"):
+            metrics.init_app(app)
+        # registered after the metrics, so that response sizes are those
+        # sent on the wire
+        compress.init_app(app)
+
+        # initialisating database, a failure stops the app from starting
+        with report.phase("database"):
+            DBHandler()
+
+    with report.phase("routes"):
+        # adding blueprints
+        app.register_blueprint(add)
+        app.register_blueprint(stories)
+        app.register_blueprint(monitoring)
+
+        # adding cli commands
+        app.cli.add_command(migrate_command)
+        app.cli.add_command(export_command)
+        app.cli.add_command(import_command)
+        app.cli.add_command(compact_command)
+
+        # recording requests for replay by the load generator
+        if app.config.get('TRACE_FILE'):
+            app.wsgi_app = TraceRecorder(app.wsgi_app, app.config['TRACE_FILE'])
+
+    app.extensions["collab_startup"] = report.finish()
+    if app.config.get('METRICS'):
+        for name, seconds in report.phases.items():
+            metrics.get_registry().observe("collab_startup_duration_seconds", seconds, (("phase", name),))
+    return app
@@ -0,0 +1,298 @@
+"""
+contains the archive tier of completed stories
+
+Completed stories never change again. The archiver moves their sentences
+out of the hot ``sentences`` table into ``story_archive``, one row per
+story holding all its sentences as zlib compressed JSON, and flags the
+story as ``archived``. The metadata served by the listing stays in
+``stories``. Readers of a story join both tables and unpack the archived
+body when there is one, so a story reads the same from either tier.
+
+With ``ARCHIVE`` enabled, every process runs a background thread that
+moves ``ARCHIVE_BATCH`` stories per transaction every
+``ARCHIVE_INTERVAL`` seconds, and only the holder of ``ARCHIVE_LOCK``
+does so at a time. Existing databases are compacted in one go, which
+also gives the freed pages back to the file system, with:
+
+    flask --app collab compact-db
+"""
+
+import os
+import json
+import zlib
+import fcntl
+import atexit
+import sqlite3
+import logging
+import threading
+
+import click
+
+from flask.cli import with_appcontext
+
+
+LOG = logging.getLogger(__name__)
+
+_ARCHIVERS = dict()
+_ARCHIVERS_LOCK = threading.Lock()
+
+
+def pack(rows, level=9):
+    """
+    :param rows: (para_idx, sent_idx, text) of every sentence of a story,
+        in order
+    :type rows: iterable
+    :param level: zlib compression level
+    :type level: int
+    :return: archived body, the sentences of each paragraph as compressed
+        JSON, e.g. [["hi!"]]
+    :rtype: bytes
+    """
+
+    paragraphs = []
+    last_para = None
+    for para_idx, _, text in rows:
+        if para_idx != last_para:
+            paragraphs.append([])
+            last_para = para_idx
+        paragraphs[-1].append(text)
+    return zlib.compress(json.dumps(paragraphs, separators=(",", ":")).encode('utf-8'), level)
+
+
+def unpack(body, para=0, sent=0):
+    """
+    :param body: archived body created by pack
+    :type body: bytes
+    :param para: paragraph index of the first sentence to return
+    :type para: int
+    :param sent: sentence index of the first sentence to return
+    :type sent: int
+    :return: (para_idx, sent_idx, text) of the sentences from the given
+        position onwards, in order
+    :rtype: list
+    """
+
+    return [
+        (para_idx, sent_idx, text)
+        for para_idx, sentences in enumerate(json.loads(zlib.decompress(body).decode('utf-8')))
+        for sent_idx, text in enumerate(sentences)
+        if (para_idx, sent_idx) >= (para, sent)
+    ]
+
+
+def archive_stories(conn, limit, level=9):
+    """
+    moves up to limit completed stories from the sentences table to the
+    archive, oldest first, in one transaction
+
+    :param conn: connection to the database
+    :type conn: sqlite3.Connection
+    :param limit: largest number of stories to move
+    :type limit: int
+    :param level: zlib compression level
+    :type level: int
+    :return: number of archived stories
+    :rtype: int
+    """
+
+    conn.execute("BEGIN IMMEDIATE;")
+    try:
+        ids = [row[0] for row in conn.execute(
+            "SELECT id FROM stories WHERE modifying = 'no' AND archived = 0 ORDER BY id LIMIT ?;", (int(limit),)
+        )]
+        if len(ids) == 0:
+            conn.rollback()
+            return 0
+        marks = ",".join("?" * len(ids))
+        rows = conn.execute(
+            "SELECT story_id, para_idx, sent_idx, text FROM sentences WHERE story_id IN ({}) "
+            "ORDER BY story_id, para_idx, sent_idx;".format(marks), ids
+        ).fetchall()
+        bodies = dict()
+        for row in rows:
+            bodies.setdefault(row[0], []).append(tuple(row[1:]))
+        conn.executemany(
+            "INSERT OR REPLACE INTO story_archive (story_id, body) VALUES (?, ?);",
+            [(id, pack(sentences, level)) for id, sentences in bodies.items()]
+        )
+        conn.execute("DELETE FROM sentences WHERE story_id IN ({});".format(marks), ids)
+        conn.execute("UPDATE stories SET archived = 1 WHERE id IN ({});".format(marks), ids)
+        conn.commit()
+    except sqlite3.Error:
+        conn.rollback()
+        raise
+    return len(ids)
+
+
+def compact(conn, batch=500, level=9, vacuum=True):
+    """
+    archives every completed story and rebuilds the database file
+
+    :param conn: connection to the database, outside of any transaction
+    :type conn: sqlite3.Connection
+    :param batch: stories moved per transaction
+    :type batch: int
+    :param level: zlib compression level
+    :type level: int
+    :param vacuum: whether the file is rebuilt, giving its free pages back
+    :type vacuum: bool
+    :return: number of archived stories and file sizes in bytes
+    :rtype: dict
+    """
+
+    database = conn.execute("PRAGMA database_list;").fetchone()[2]
+    before = _file_size(database)
+    archived = 0
+    while True:
+        moved = archive_stories(conn, batch, level)
+        archived += moved
+        if moved < batch:
+            break
+    if vacuum:
+        conn.execute("VACUUM;")
+        conn.execute("PRAGMA wal_checkpoint(TRUNCATE);")
+    return dict({"archived": archived, "bytes_before": before, "bytes_after": _file_size(database)})
+
+
+def _file_size(database):
+    """
+    :return: size of the database file and its write-ahead log
+    :rtype: int
+    """
+
+    return sum(
+        os.path.getsize(path) for path in (database, database + "-wal") if os.path.exists(path)
+    )
+
+
+class Archiver:
+    """
+    background thread archiving completed stories of one database
+    """
+
+    def __init__(self, pool, lock_path, interval=30.0, batch=100, level=9):
+        """
+        :param pool: connection pool of the database
+        :type pool: collab.pool.ConnectionPool
+        :param lock_path: file locked while archiving, shared by the workers
+        :type lock_path: str
+        :param interval: seconds between runs
+        :type interval: float
+        :param batch: stories moved per transaction
+        :type batch: int
+        :param level: zlib compression level
+        :type level: int
+        """
+
+        self.pool = pool
+        self.lock_path = lock_path
+        self.interval = float(interval)
+        self.batch = int(batch)
+        self.level = int(level)
+        self.archived = 0
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="collab-archiver", daemon=True)
+        self._thread.start()
+
+    def run_once(self):
+        """
+        archives completed stories a batch at a time until none are left,
+        unless another process is doing so
+
+        :return: number of archived stories
+        :rtype: int
+        """
+
+        fd = os.open(self.lock_path, os.O_RDWR | os.O_CREAT, 0o600)
+        try:
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except OSError:
+                return 0
+            archived = 0
+            with self.pool.connection() as conn:
+                while not self._stop.is_set():
+                    moved = archive_stories(conn, self.batch, self.level)
+                    archived += moved
+                    if moved < self.batch:
+                        break
+        finally:
+            os.close(fd)
+        if archived:
+            self.archived += archived
+            LOG.info("archived %s completed stories", archived)
+        return archived
+
+    def _run(self):
+        """
+        background loop archiving stories every interval
+        """
+
+        while not self._stop.wait(self.interval):
+            try:
+                self.run_once()
+            except sqlite3.Error as err:
+                LOG.debug(err)
+                LOG.error("failed to archive completed stories, retrying in %ss", self.interval)
+
+    def close(self):
+        """
+        stops the thread after the batch it is writing
+        """
+
+        self._stop.set()
+
+
+def get_archiver(config):
+    """
+    returns the archiver of the current process, starting it on first use
+
+    :param config: flask app configuration
+    :type config: flask.Config
+    :return: archiver
+    :rtype: Archiver
+    """
+
+    from .pool import get_pool
+
+    key = (os.getpid(), config['DATABASE'])
+    archiver = _ARCHIVERS.get(key)
+    if archiver is not None:
+        return archiver
+
+    with _ARCHIVERS_LOCK:
+        archiver = _ARCHIVERS.get(key)
+        if archiver is None:
+            archiver = Archiver(
+                get_pool(config),
+                config['ARCHIVE_LOCK'],
+                interval=config.get('ARCHIVE_INTERVAL', 30.0),
+                batch=config.get('ARCHIVE_BATCH', 100),
+                level=config.get('ARCHIVE_LEVEL', 9)
+            )
+            atexit.register(archiver.close)
+            _ARCHIVERS[key] = archiver
+            LOG.info("archiver enabled (batch=%s, interval=%ss)", archiver.batch, archiver.interval)
+    return archiver
+
+
+@click.command("compact-db")
+@click.option("--batch", type=int, default=500, show_default=True, help="stories archived per transaction")
+@click.option("--vacuum/--no-vacuum", default=True, show_default=True, help="rebuild the database file")
+@with_appcontext
+def compact_command(batch, vacuum):
+    """
+    moves every completed story to the archive and shrinks the database
+    """
+
+    from flask import current_app
+    from .storage import get_storage
+    from .pool import get_pool
+
+    if get_storage(current_app.config) is not None:
+        raise click.ClickException("compaction is only done on SQLite, the {} storage compresses large rows itself".format(
+            current_app.config['STORAGE']
+        ))
+    with get_pool(current_app.config).connection() as conn:
+        counts = compact(conn, batch, current_app.config.get('ARCHIVE_LEVEL', 9), vacuum)
+    click.echo("archived {archived} stories, {bytes_before} -> {bytes_after} bytes".format(**counts))
@@ -0,0 +1,280 @@
+"""
+manages the application launch on an ASGI server, e.g. uvicorn:
+
+    uvicorn collab.asgi:app
+
+Connections are held by the server's event loop, so idle keep-alive
+clients do not occupy a thread. Requests are handed to the same flask app
+that gunicorn serves: requests that change stories run one at a time on a
+dedicated writer thread, which removes SQLite lock contention, while
+reads run concurrently on a pool of reader threads.
+
+Event streams and long-polls only take a reader thread while the view
+subscribes to the story. The view leaves its EventStream in the WSGI
+environment, and the adapter waits for the events on the event loop, so
+an idle subscriber holds no thread however many are connected. Exports
+are sent chunk by chunk from threads of their own as they are produced.
+"""
+
+import io
+import sys
+import asyncio
+import logging
+
+from concurrent.futures import ThreadPoolExecutor
+
+from .events import ASYNC_ENVIRON, STREAM_ENVIRON
+from . import create_app
+
+
+LOG = logging.getLogger(__name__)
+
+# methods that only read stories and can run concurrently
+READ_METHODS = ("GET", "HEAD", "OPTIONS")
+# exports hold their thread for as long as they run, so they get threads
+# of their own rather than starving the readers
+STREAM_SUFFIXES = ("/export",)
+# responses of these types are sent as they are produced
+STREAM_TYPES = (b"text/event-stream", b"application/x-ndjson")
+
+
+class AsgiAdapter:
+    """
+    ASGI application running a WSGI app on a writer thread and a pool of
+    reader threads
+    """
+
+    def __init__(self, wsgi_app, readers=16, streams=256):
+        """
+        :param wsgi_app: flask app
+        :type wsgi_app: flask.Flask
+        :param readers: number of reader threads
+        :type readers: int
+        :param streams: number of threads for exports
+        :type streams: int
+        """
+
+        self.wsgi_app = wsgi_app
+        self.writer = ThreadPoolExecutor(max_workers=1, thread_name_prefix="collab-writer")
+        self.readers = ThreadPoolExecutor(max_workers=readers, thread_name_prefix="collab-reader")
+        self.streams = ThreadPoolExecutor(max_workers=streams, thread_name_prefix="collab-stream")
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "http":
+            await self._http(scope, receive, send)
+        elif scope["type"] == "lifespan":
+            await self._lifespan(receive, send)
+
+    async def _lifespan(self, receive, send):
+        """
+        answers the server's startup and shutdown events
+        """
+
+        while True:
+            message = await receive()
+            if message["type"] == "lifespan.startup":
+                await send({"type": "lifespan.startup.complete"})
+            elif message["type"] == "lifespan.shutdown":
+                self.writer.shutdown(wait=True)
+                self.readers.shutdown(wait=True)
+                self.streams.shutdown(wait=False)
+                await send({"type": "lifespan.shutdown.complete"})
+                return
+
+    async def _http(self, scope, receive, send):
+        """
+        reads the request body, runs the WSGI app on the matching executor
+        and sends its response
+        """
+
+        body = bytearray()
+        while True:
+            message = await receive()
+            if message["type"] == "http.disconnect":
+                return
+            body.extend(message.get("body", b""))
+            if not message.get("more_body", False):
+                break
+
+        environ = self._environ(scope, bytes(body))
+        if scope["path"].endswith(STREAM_SUFFIXES):
+            executor = self.streams
+        elif scope["method"] in READ_METHODS:
+            executor = self.readers
+        else:
+            executor = self.writer
+        loop = asyncio.get_running_loop()
+        status, headers, result = await loop.run_in_executor(executor, self._run, environ)
+
+        await send({
+            "type": "http.response.start",
+            "status": status,
+            "headers": headers
+        })
+
+        events = environ.get(STREAM_ENVIRON)
+        if events is not None:
+            try:
+                await self._send_events(events, receive, send)
+            finally:
+                if hasattr(result, "close"):
+                    await loop.run_in_executor(self.readers, result.close)
+            return
+
+        if isinstance(result, list):
+            await send({
+                "type": "http.response.body",
+                "body": b"".join(result)
+            })
+            return
+
+        # streamed response, e.g. server-sent events or an export: chunks are
+        # sent as the app produces them until it is done or the client goes away
+        disconnected = asyncio.ensure_future(self._disconnect(receive))
+        chunks = iter(result)
+        try:
+            while not disconnected.done():
+                chunk = await loop.run_in_executor(executor, next, chunks, None)
+                if chunk is None:
+                    break
+                await send({"type": "http.response.body", "body": chunk, "more_body": True})
+            if not disconnected.done():
+                await send({"type": "http.response.body", "body": b""})
+        finally:
+            disconnected.cancel()
+            if hasattr(result, "close"):
+                await loop.run_in_executor(executor, result.close)
+
+    async def _send_events(self, events, receive, send):
+        """
+        sends an event stream or long-poll from the event loop, until it
+        ends or the client goes away
+
+        :param events: body of the response
+        :type events: collab.events.EventStream
+        """
+
+        disconnected = asyncio.ensure_future(self._disconnect(receive))
+        chunks = events.__aiter__()
+        try:
+            while True:
+                chunk = asyncio.ensure_future(chunks.__anext__())
+                await asyncio.wait([chunk, disconnected], return_when=asyncio.FIRST_COMPLETED)
+                if not chunk.done():
+                    # the generator must stop running before it is closed
+                    chunk.cancel()
+                    try:
+                        await chunk
+                    except (asyncio.CancelledError, StopAsyncIteration):
+                        pass
+                    break
+                try:
+                    body = chunk.result()
+                except StopAsyncIteration:
+                    await send({"type": "http.response.body", "body": b""})
+                    break
+                await send({"type": "http.response.body", "body": body, "more_body": True})
+        finally:
+            disconnected.cancel()
+            await chunks.aclose()
+            events.close()
+
+    @staticmethod
+    async def _disconnect(receive):
+        """
+        waits until the client closes the connection
+        """
+
+        while True:
+            message = await receive()
+            if message["type"] == "http.disconnect":
+                return
+
+    def _run(self, environ):
+        """
+        calls the WSGI app and collects its response, leaving streamed
+        responses to be read chunk by chunk
+
+        :param environ: WSGI environment
+        :type environ: dict
+        :return: status code, headers and body, a list of chunks unless the
+            response is streamed
+        :rtype: tuple
+        """
+
+        response = dict()
+
+        def start_response(status, headers, exc_info=None):
+            response["status"] = int(status.split(" ", 1)[0])
+            response["headers"] = [
+                (name.lower().encode("latin-1"), value.encode("latin-1")) for name, value in headers
+            ]
+
+        result = self.wsgi_app(environ, start_response)
+        if environ.get(STREAM_ENVIRON) is not None:
+            # sent by _send_events
+            return response["status"], response["headers"], result
+        if any(name == b"content-type" and value.startswith(STREAM_TYPES) for name, value in response["headers"]):
+            return response["status"], response["headers"], result
+        try:
+            chunks = list(result)
+        finally:
+            if hasattr(result, "close"):
+                result.close()
+        return response["status"], response["headers"], chunks
+
+    @staticmethod
+    def _environ(scope, body):
+        """
+        builds the WSGI environment of an ASGI HTTP request
+
+        :param scope: ASGI connection scope
+        :type scope: dict
+        :param body: complete request body
+        :type body: bytes
+        :return: WSGI environment
+        :rtype: dict
+        """
+
+        server = scope.get("server") or ("localhost", 80)
+        client = scope.get("client") or ("", 0)
+        environ = dict({
+            "REQUEST_METHOD": scope["method"],
+            "SCRIPT_NAME": scope.get("root_path", "").encode("utf-8").decode("latin-1"),
+            "PATH_INFO": scope["path"].encode("utf-8").decode("latin-1"),
+            "QUERY_STRING": scope.get("query_string", b"").decode("latin-1"),
+            "SERVER_NAME": server[0],
+            "SERVER_PORT": str(server[1]),
+            "SERVER_PROTOCOL": "HTTP/{}".format(scope.get("http_version", "1.1")),
+            "REMOTE_ADDR": client[0],
+            "REMOTE_PORT": str(client[1]),
+            "CONTENT_LENGTH": str(len(body)),
+            "wsgi.version": (1, 0),
+            "wsgi.url_scheme": scope.get("scheme", "http"),
+            "wsgi.input": io.BytesIO(body),
+            "wsgi.errors": sys.stderr,
+            "wsgi.multithread": True,
+            "wsgi.multiprocess": False,
+            "wsgi.run_once": False,
+            ASYNC_ENVIRON: True
+        })
+
+        for name, value in scope.get("headers", []):
+            name = name.decode("latin-1").upper().replace("-", "_")
+            value = value.decode("latin-1")
+            if name == "CONTENT_TYPE":
+                environ["CONTENT_TYPE"] = value
+                continue
+            if name == "CONTENT_LENGTH":
+                continue
+            key = "HTTP_" + name
+            environ[key] = environ[key] + "," + value if key in environ else value
+        return environ
+
+
+flask_app = create_app()
+app = AsgiAdapter(
+    flask_app,
+    readers=flask_app.config.get('ASGI_READERS', 16),
+    streams=flask_app.config.get('ASGI_STREAMS', 256)
+)
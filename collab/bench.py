@@ -0,0 +1,967 @@
+"""
+contains benchmarks for the collab API
+
+Run with ``python -m collab.bench <benchmark> [options]``. Every benchmark
+prints its results as JSON on stdout.
+
+``run``, ``replay`` and ``compare`` drive the load generator of
+collab/loadgen.py: synthetic mixes and recorded traces are sent either to
+a live server (``--url``) or to an app created in this process on a scratch
+directory, and two saved reports can be compared to catch regressions.
+
+``logging`` measures what logging adds to ``/add``, with records written
+by the request thread, through the queue, or not at all.
+
+``compression`` compares response sizes and CPU time per request of
+every installed content coding.
+
+``archive`` compares the size of the database file and read latencies
+before and after completed stories are moved to the compressed archive.
+
+``startup`` measures how long a worker takes to serve: a new interpreter
+creating the app, as every worker does without ``gunicorn --preload``,
+against a child forked from a process holding the app, as with it.
+"""
+
+import os
+import sys
+import time
+import json
+import sqlite3
+import random
+import logging
+import argparse
+import contextlib
+import tempfile
+import threading
+import statistics
+
+from http import client as httpclient
+from urllib import parse as urlparse
+from urllib import request as urlrequest
+from concurrent.futures import ThreadPoolExecutor
+
+from .story import ActiveStory
+from .log_handlers import log_handlers, stop_queue
+from .config import BasicConfig
+from .migrations import INIT_SQL, migrate
+from .trace import read_trace, write_trace
+from .loadgen import MIXES, Target, synthetic_mix, run_requests, seed_stories
+from .loadgen import last_story_id, check_stories, compare_reports, STORY_WORDS
+
+
+def _get_json(base_url, path):
+    """
+    fetches and decodes a JSON response from a running server
+
+    :param base_url: address of the server, e.g. http://127.0.0.1:8000
+    :type base_url: str
+    :param path: path with query string
+    :type path: str
+    :return: decoded response body
+    :rtype: dict
+    """
+
+    with urlrequest.urlopen(base_url + path) as resp:
+        return json.loads(resp.read().decode('utf-8'))
+
+
+def _post_word(base_url, word, room=None):
+    """
+    posts a single word to /add and returns the status code
+
+    :param base_url: address of the server
+    :type base_url: str
+    :param word: word to be added
+    :type word: str
+    :param room: room key sent along, None for the default room
+    :type room: str
+    :return: HTTP status code
+    :rtype: int
+    """
+
+    body = {"word": word} if room is None else {"word": word, "room": room}
+    req = urlrequest.Request(
+        base_url + "/add",
+        data=json.dumps(body).encode('utf-8'),
+        headers={"Content-Type": "application/json"},
+        method="POST"
+    )
+    try:
+        with urlrequest.urlopen(req) as resp:
+            return resp.status
+    except urlrequest.HTTPError as err:
+        return err.code
+
+
+def count_words(base_url, page_size=1000):
+    """
+    counts all the words stored on the server, titles included
+
+    :param base_url: address of the server
+    :type base_url: str
+    :param page_size: number of stories fetched per listing request
+    :type page_size: int
+    :return: total number of words
+    :rtype: int
+    """
+
+    total = 0
+    offset = 0
+    while True:
+        page = _get_json(base_url, "/stories?limit={}&offset={}".format(page_size, offset))
+        for item in page["results"]:
+            story = _get_json(base_url, "/stories/{}".format(item["id"]))
+            total += len(story["title"].split())
+            for para in story["paragraphs"]:
+                total += sum(len(sent.split()) for sent in para["sentences"])
+        if page["count"] < page_size:
+            return total
+        offset += page_size
+
+
+def add_concurrency(base_url, workers, requests, rooms=0):
+    """
+    hammers /add from concurrent workers and checks that no word is lost
+
+    :param base_url: address of the server
+    :type base_url: str
+    :param workers: number of concurrent clients
+    :type workers: int
+    :param requests: total number of words to post
+    :type requests: int
+    :param rooms: number of room keys the words are spread over, 0 sends
+        every word to the default room; needs a server with ROOMS enabled
+    :type rooms: int
+    :return: benchmark report
+    :rtype: dict
+    """
+
+    before = count_words(base_url)
+
+    def post(i):
+        return _post_word(base_url, "w{}".format(i), "room{}".format(i % rooms) if rooms else None)
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        statuses = list(pool.map(post, range(requests)))
+    elapsed = time.perf_counter() - start
+
+    after = count_words(base_url)
+    failed = sum(1 for status in statuses if status not in (200, 201))
+
+    return dict({
+        "workers": workers,
+        "requests": requests,
+        "rooms": rooms,
+        "failed": failed,
+        "seconds": round(elapsed, 4),
+        "requests_per_second": round(requests / elapsed, 2) if elapsed else None,
+        "words_added": after - before,
+        "consistent": after - before == requests - failed
+    })
+
+
+def _percentiles(timings):
+    """
+    summarizes request timings
+
+    :param timings: seconds per request
+    :type timings: list
+    :return: count with p50, p95 and p99 latency in milliseconds
+    :rtype: dict
+    """
+
+    if not timings:
+        return dict({"count": 0})
+    ordered = sorted(timings)
+
+    def pick(q):
+        return round(ordered[min(len(ordered) - 1, int(q * len(ordered)))] * 1e3, 3)
+
+    return dict({"count": len(ordered), "p50_ms": pick(0.50), "p95_ms": pick(0.95), "p99_ms": pick(0.99)})
+
+
+def load(base_url, clients, requests, read_ratio):
+    """
+    runs a mix of /add and GET /stories/<id> on the active story from
+    keep-alive clients, e.g. to compare gunicorn sync workers against the
+    ASGI entry point
+
+    :param base_url: address of the server
+    :type base_url: str
+    :param clients: number of concurrent keep-alive clients
+    :type clients: int
+    :param requests: requests sent by each client
+    :type requests: int
+    :param read_ratio: share of requests that read the active story
+    :type read_ratio: float
+    :return: benchmark report
+    :rtype: dict
+    """
+
+    address = urlparse.urlsplit(base_url)
+    story = dict({"id": 1})
+    timings = dict({"add": [], "story": []})
+    errors = []
+    lock = threading.Lock()
+
+    def client(seed):
+        rand = random.Random(seed)
+        conn = httpclient.HTTPConnection(address.hostname, address.port or 80, timeout=60)
+        local = dict({"add": [], "story": []})
+        failed = 0
+        for i in range(requests):
+            if rand.random() < read_ratio:
+                endpoint = "story"
+                start = time.perf_counter()
+                conn.request("GET", "/stories/{}".format(story["id"]))
+            else:
+                endpoint = "add"
+                start = time.perf_counter()
+                conn.request("POST", "/add", body=json.dumps({"word": "c{}w{}".format(seed, i)}),
+                             headers={"Content-Type": "application/json"})
+            resp = conn.getresponse()
+            data = resp.read()
+            local[endpoint].append(time.perf_counter() - start)
+            if resp.status >= 500 or (endpoint == "add" and resp.status not in (200, 201)):
+                failed += 1
+            elif endpoint == "add":
+                story["id"] = json.loads(data.decode('utf-8'))["id"]
+        conn.close()
+        with lock:
+            for endpoint in local:
+                timings[endpoint].extend(local[endpoint])
+            errors.append(failed)
+
+    threads = [threading.Thread(target=client, args=(n,)) for n in range(clients)]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - start
+
+    total = clients * requests
+    return dict({
+        "url": base_url,
+        "clients": clients,
+        "requests": total,
+        "failed": sum(errors),
+        "seconds": round(elapsed, 4),
+        "requests_per_second": round(total / elapsed, 2) if elapsed else None,
+        "endpoints": dict({endpoint: _percentiles(values) for endpoint, values in timings.items()})
+    })
+
+
+LEGACY_SCHEMA = '''
+CREATE TABLE stories (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    created_at TEXT DEFAULT (datetime('now')),
+    updated_at TEXT,
+    modifying TEXT DEFAULT "1|0|0",
+    title TEXT NOT NULL,
+    paragraphs TEXT DEFAULT '[{"sentences":[""]}]'
+);
+'''
+
+
+def _legacy_append(conn, word):
+    """
+    appends a word the way the JSON paragraphs schema required: decode the
+    whole story, add the word and write the whole story back
+
+    :param conn: connection to a database with the legacy schema
+    :type conn: sqlite3.Connection
+    :param word: word to be added
+    :type word: str
+    """
+
+    conn.execute("BEGIN IMMEDIATE;")
+    row = conn.execute("SELECT id, modifying, title, paragraphs FROM stories WHERE modifying != 'no' LIMIT 1;").fetchone()
+    if row is None:
+        conn.execute("INSERT INTO stories (title) VALUES (?);", (word,))
+    else:
+        story = ActiveStory(row[0], row[2], row[1], json.loads(row[3]))
+        story.append(word)
+        conn.execute(
+            "UPDATE stories SET updated_at = datetime('now'), modifying = ?, title = ?, paragraphs = ? WHERE id = ?;",
+            (str(story.cursor), story.title, json.dumps(story.paragraphs), story.id)
+        )
+    conn.commit()
+
+
+def _normalized_append(conn, word):
+    """
+    appends a word through the sentences table, as DBHandler.add_word does
+
+    :param conn: connection to a database with the current schema
+    :type conn: sqlite3.Connection
+    :param word: word to be added
+    :type word: str
+    """
+
+    from .db_hanlder import DBHandler
+
+    cursor = conn.cursor()
+    cursor.execute("BEGIN IMMEDIATE;")
+    DBHandler._append_word(cursor, word)
+    conn.commit()
+
+
+def append_cost(lengths, samples):
+    """
+    measures the cost of appending one word to a story that already holds
+    a given number of words, for the legacy JSON schema and the sentences
+    table
+
+    :param lengths: story lengths in words, at most 1030
+    :type lengths: list
+    :param samples: number of timed appends per length
+    :type samples: int
+    :return: benchmark report with median microseconds per append
+    :rtype: dict
+    """
+
+    report = dict()
+    schemas = dict({
+        "json_paragraphs": (lambda conn: conn.executescript(LEGACY_SCHEMA), _legacy_append),
+        "sentences_table": (lambda conn: migrate(conn, open(INIT_SQL, encoding="utf-8").read()), _normalized_append)
+    })
+
+    for name, (create, append) in schemas.items():
+        report[name] = dict()
+        for length in lengths:
+            with tempfile.TemporaryDirectory() as tmp:
+                conn = sqlite3.connect(os.path.join(tmp, "bench.sql"))
+                conn.row_factory = sqlite3.Row
+                conn.execute("PRAGMA journal_mode=WAL;")
+                conn.execute("PRAGMA synchronous=NORMAL;")
+                create(conn)
+
+                for i in range(length):
+                    append(conn, "w{}".format(i))
+                timings = []
+                for i in range(samples):
+                    start = time.perf_counter()
+                    append(conn, "s{}".format(i))
+                    timings.append(time.perf_counter() - start)
+                conn.close()
+            report[name][str(length)] = round(statistics.median(timings) * 1e6, 1)
+
+    return dict({"unit": "median microseconds per append", "samples": samples, "results": report})
+
+
+def pagination(rows, depths, limit, sort, order):
+    """
+    compares fetching a page at increasing depths with offset and with the
+    keyset cursor, on a table filled with the given number of stories
+
+    :param rows: number of stories in the table
+    :type rows: int
+    :param depths: positions of the first story of the measured pages
+    :type depths: list
+    :param limit: page size
+    :type limit: int
+    :param sort: column in ["created_at", "updated_at", "title"]
+    :type sort: str
+    :param order: order for sort from ["asc", "desc"]
+    :type order: str
+    :return: benchmark report with milliseconds per page
+    :rtype: dict
+    """
+
+    from .db_hanlder import DBHandler
+
+    report = dict()
+    with tempfile.TemporaryDirectory() as tmp:
+        conn = sqlite3.connect(os.path.join(tmp, "bench.sql"))
+        conn.row_factory = sqlite3.Row
+        migrate(conn, open(INIT_SQL, encoding="utf-8").read())
+        conn.executemany(
+            "INSERT INTO stories (created_at, updated_at, modifying, title) VALUES (?, ?, 'no', ?);",
+            (
+                (
+                    "2019-01-01 00:00:{:07d}".format(i),
+                    "2019-06-01 00:00:{:07d}".format((i * 7919) % rows),
+                    "title {:07d}".format((i * 104729) % rows)
+                )
+                for i in range(rows)
+            )
+        )
+        conn.commit()
+
+        offset_sql = DBHandler._stories_query(sort, order)
+        keyset_sql = DBHandler._stories_query(sort, order, after=("", 0))
+        for depth in depths:
+            if depth >= rows:
+                continue
+            entry = dict({"offset_ms": None, "cursor_ms": None})
+
+            start = time.perf_counter()
+            conn.execute(offset_sql, (limit, depth)).fetchall()
+            entry["offset_ms"] = round((time.perf_counter() - start) * 1e3, 3)
+
+            after = None
+            if depth > 0:
+                last = conn.execute(offset_sql, (1, depth - 1)).fetchone()
+                after = (last[sort], last["id"])
+            start = time.perf_counter()
+            if after is None:
+                conn.execute(offset_sql, (limit, 0)).fetchall()
+            else:
+                conn.execute(keyset_sql, after + (limit, 0)).fetchall()
+            entry["cursor_ms"] = round((time.perf_counter() - start) * 1e3, 3)
+
+            report[str(depth)] = entry
+        conn.close()
+
+    return dict({"rows": rows, "limit": limit, "sort": sort, "order": order, "results": report})
+
+
+def _overrides(tmp, config=None):
+    """
+    :param tmp: scratch directory
+    :type tmp: str
+    :param config: settings overriding the configuration
+    :type config: dict
+    :return: configuration moving every file of the app to tmp
+    :rtype: dict
+    """
+
+    overrides = dict({
+        key: getattr(BasicConfig, key).replace(BasicConfig.DIR, tmp, 1)
+        for key in dir(BasicConfig)
+        if key.isupper() and isinstance(getattr(BasicConfig, key), str)
+        and getattr(BasicConfig, key).startswith(BasicConfig.DIR)
+    })
+    overrides["TRACE_FILE"] = None
+    overrides.update(config or dict())
+    return overrides
+
+
+def _target(url, tmp, config=None, console=None):
+    """
+    :param url: address of a live server, None for an app in this process
+    :type url: str
+    :param tmp: scratch directory for the database of the in-process app
+    :type tmp: str
+    :param config: settings of the in-process app on top of the defaults
+    :type config: dict
+    :param console: stream of the console logs, default: stderr at WARNING
+    :type console: file
+    :return: target of the load
+    :rtype: collab.loadgen.Target
+    """
+
+    if url:
+        return Target(url=url)
+
+    from . import create_app
+
+    overrides = _overrides(tmp, config)
+    # console logs go to stderr so that they do not mix with the report,
+    # and only warnings are kept there
+    with contextlib.redirect_stdout(console or sys.stderr):
+        app = create_app(overrides)
+    if console is None:
+        for handler in log_handlers():
+            if getattr(handler, "stream", None) is sys.stderr:
+                handler.setLevel(logging.WARNING)
+    return Target(app=app)
+
+
+# settings of the app for each mode of the logging benchmark
+LOGGING_MODES = dict({
+    "off": dict({"LOG_QUEUE": False}),
+    "sync": dict({"LOG_QUEUE": False}),
+    "queue": dict({"LOG_QUEUE": True}),
+    "json": dict({"LOG_QUEUE": True, "LOG_FORMAT": "json"})
+})
+
+
+def logging_cost(modes, requests, clients):
+    """
+    measures /add latency of an app in this process with each logging mode
+
+    "off" disables logging, "sync" writes records from the request thread,
+    "queue" hands them to the listener thread and "json" does the same
+    with JSON lines in the log file. Console logs keep their level but are
+    written to /dev/null, the log file lives in a scratch directory.
+
+    :param modes: names of LOGGING_MODES to run
+    :type modes: list
+    :param requests: number of /add requests per mode
+    :type requests: int
+    :param clients: number of concurrent clients
+    :type clients: int
+    :return: /add latency and log file size per mode
+    :rtype: dict
+    """
+
+    adds = [
+        dict({
+            "method": "POST",
+            "path": "/add",
+            "headers": dict({"Content-Type": "application/json"}),
+            "body": json.dumps(dict({"word": "w{}".format(i)}))
+        })
+        for i in range(requests)
+    ]
+
+    report = dict()
+    with open(os.devnull, "w") as devnull:
+        for mode in modes:
+            with tempfile.TemporaryDirectory() as tmp:
+                target = _target(None, tmp, LOGGING_MODES[mode], console=devnull)
+                logging.disable(logging.CRITICAL if mode == "off" else logging.NOTSET)
+                try:
+                    result = run_requests(target, adds, clients)
+                finally:
+                    logging.disable(logging.NOTSET)
+                    stop_queue()
+                entry = result["endpoints"]["POST /add"]
+                entry["requests_per_second"] = result["requests_per_second"]
+                entry["failed"] = result["failed"]
+                logs = target.app.config["LOGS"]
+                entry["log_bytes"] = os.path.getsize(logs) if os.path.exists(logs) else 0
+                report[mode] = entry
+    return dict({"requests": requests, "clients": clients, "results": report})
+
+
+# run in a new interpreter by startup_cost, as a worker without --preload
+_COLD_START = """
+import sys, json, time, contextlib
+start = time.perf_counter()
+from collab import create_app
+imported = time.perf_counter()
+with contextlib.redirect_stdout(sys.stderr):
+    app = create_app(json.loads(sys.argv[1]))
+created = time.perf_counter()
+print(json.dumps(dict({
+    "import_ms": (imported - start) * 1000,
+    "create_app_ms": (created - imported) * 1000,
+    "phases_ms": app.extensions["collab_startup"]["phases_ms"]
+})))
+"""
+
+
+def _forked_start(app):
+    """
+    forks the process, as gunicorn --preload does for every worker, and
+    times the child until it has answered its first request
+
+    :param app: app created in this process
+    :type app: flask.Flask
+    :return: milliseconds from the fork to the first response
+    :rtype: float
+    """
+
+    read_end, write_end = os.pipe()
+    start = time.perf_counter()
+    pid = os.fork()
+    if pid == 0:
+        status = 1
+        try:
+            os.close(read_end)
+            app.test_client().get("/stories?limit=1")
+            os.write(write_end, str((time.perf_counter() - start) * 1000).encode('ascii'))
+            status = 0
+        finally:
+            os._exit(status)
+    os.close(write_end)
+    with os.fdopen(read_end, "rb") as f:
+        elapsed = f.read()
+    os.waitpid(pid, 0)
+    return float(elapsed)
+
+
+def startup_cost(runs):
+    """
+    measures how long a worker takes to start: a new interpreter creating
+    the app, first on an empty directory and then on the database it set
+    up, against a child forked from a process that created it already
+
+    :param runs: starts measured in each mode
+    :type runs: int
+    :return: median times in milliseconds per mode
+    :rtype: dict
+    """
+
+    import subprocess
+
+    def cold(overrides):
+        out = subprocess.run(
+            [sys.executable, "-c", _COLD_START, json.dumps(overrides)],
+            check=True, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL,
+            env=dict(os.environ, PYTHONPATH=os.pathsep.join(filter(None, [
+                os.path.dirname(os.path.dirname(os.path.realpath(__file__))), os.environ.get("PYTHONPATH")
+            ])))
+        )
+        return json.loads(out.stdout.decode('utf-8').splitlines()[-1])
+
+    def summary(samples):
+        return dict({
+            key: round(statistics.median(sample[key] for sample in samples), 3)
+            for key in samples[0] if key != "phases_ms"
+        }, phases_ms=dict({
+            name: round(statistics.median(sample["phases_ms"][name] for sample in samples), 3)
+            for name in samples[0].get("phases_ms", dict())
+        }))
+
+    report = dict({"runs": runs})
+    with tempfile.TemporaryDirectory() as tmp:
+        report["new_database"] = summary([cold(_overrides(tmp))])
+        report["cold"] = summary([cold(_overrides(tmp)) for _ in range(runs)])
+        with open(os.devnull, "w") as devnull:
+            app = _target(None, tmp, console=devnull).app
+            report["forked"] = dict({
+                "first_response_ms": round(statistics.median(_forked_start(app) for _ in range(runs)), 3)
+            })
+        stop_queue()
+    return report
+
+
+def _text_words(count):
+    """
+    :param count: number of words
+    :type count: int
+    :return: words drawn from a small vocabulary, so that stories made of
+        them compress about as well as text
+    :rtype: list
+    """
+
+    rng = random.Random(0)
+    syllables = ["ka", "lo", "mi", "ne", "ru", "sa", "to", "vi", "da", "pe", "shi", "gor"]
+    vocabulary = ["".join(rng.choice(syllables) for _ in range(rng.randint(1, 4))) for _ in range(2000)]
+    return [rng.choice(vocabulary) for _ in range(count)]
+
+
+def _add_words(client, words):
+    """
+    adds words through /add/batch of a test client, as large batches as
+    the app accepts
+    """
+
+    batch = client.application.config['ADD_BATCH_MAX_WORDS']
+    for start in range(0, len(words), batch):
+        client.post("/add/batch", json=dict({"words": words[start:start + batch]}))
+
+
+def compression_cost(stories, requests):
+    """
+    measures bytes on the wire and CPU time per request of GET responses
+    for every installed content coding, against uncompressed responses
+
+    The stories are made of words drawn from a small vocabulary, so that
+    they compress about as well as text. Completed stories are compressed
+    once and sent from the story cache afterwards, the active story and
+    the listing are compressed on every request.
+
+    :param stories: number of completed stories written first
+    :type stories: int
+    :param requests: requests per path and encoding
+    :type requests: int
+    :return: response size and CPU microseconds per request, by path and
+        encoding
+    :rtype: dict
+    """
+
+    from .compress import available
+
+    words = _text_words(stories * STORY_WORDS + STORY_WORDS // 2)
+    paths = dict({
+        "completed story": "/stories/1",
+        "active story": "/stories/{}".format(stories + 1),
+        "listing": "/stories?limit=100"
+    })
+
+    report = dict({"stories": stories, "requests": requests, "results": dict()})
+    with tempfile.TemporaryDirectory() as tmp, open(os.devnull, "w") as devnull:
+        client = _target(None, tmp, dict({"METRICS": False}), console=devnull).app.test_client()
+        _add_words(client, words)
+
+        for name, path in paths.items():
+            results = dict()
+            for encoding in ("identity",) + available():
+                headers = dict({"Accept-Encoding": encoding})
+                # fills the story cache and the kept compressed bodies
+                resp = client.get(path, headers=headers)
+                start = time.process_time()
+                for _ in range(requests):
+                    resp = client.get(path, headers=headers)
+                cpu = (time.process_time() - start) / requests * 1e6
+                results[encoding] = dict({
+                    "bytes": len(resp.get_data()),
+                    "content_encoding": resp.headers.get("Content-Encoding"),
+                    "cpu_us_per_request": round(cpu, 1),
+                    "cpu_us_over_identity": round(cpu - results["identity"]["cpu_us_per_request"], 1)
+                        if "identity" in results else 0.0
+                })
+            report["results"][name] = results
+        stop_queue()
+    return report
+
+
+def _table_bytes(conn):
+    """
+    :return: bytes of the largest tables and indexes, empty without the
+        dbstat virtual table
+    :rtype: dict
+    """
+
+    try:
+        return dict(conn.execute(
+            "SELECT name, SUM(pgsize) FROM dbstat GROUP BY name ORDER BY 2 DESC LIMIT 6;"
+        ).fetchall())
+    except sqlite3.OperationalError:
+        return dict()
+
+
+def archive_cost(stories, requests):
+    """
+    measures the database file and read latencies before and after the
+    completed stories are moved to the compressed archive by compact-db
+
+    The story cache is disabled, so that every GET /stories/<id> reads the
+    database.
+
+    :param stories: number of completed stories written first
+    :type stories: int
+    :param requests: requests per path, before and after
+    :type requests: int
+    :return: file sizes, and latency percentiles in milliseconds by path
+    :rtype: dict
+    """
+
+    from .archive import compact
+    from .pool import get_pool
+
+    rng = random.Random(0)
+    words = _text_words(stories * STORY_WORDS + STORY_WORDS // 2)
+    paths = dict({
+        "story": lambda: "/stories/{}".format(rng.randint(1, stories)),
+        "listing": lambda: "/stories?limit=100&offset={}".format(rng.randint(0, max(stories - 100, 0))),
+        "export": lambda: "/stories/export"
+    })
+
+    def measure(client):
+        results = dict()
+        for name, path in paths.items():
+            timings = []
+            for _ in range(requests if name != "export" else max(requests // 100, 1)):
+                start = time.perf_counter()
+                resp = client.get(path())
+                resp.get_data()
+                timings.append(time.perf_counter() - start)
+            results[name] = _percentiles(timings)
+        return results
+
+    report = dict({"stories": stories, "requests": requests})
+    with tempfile.TemporaryDirectory() as tmp, open(os.devnull, "w") as devnull:
+        config = dict({"METRICS": False, "STORY_CACHE_SIZE": 0, "COMPRESS": "off"})
+        app = _target(None, tmp, config, console=devnull).app
+        client = app.test_client()
+        _add_words(client, words)
+        with app.app_context(), get_pool(app.config).connection() as conn:
+            # the same rebuild as compaction, so that only the archive differs
+            conn.execute("VACUUM;")
+            conn.execute("PRAGMA wal_checkpoint(TRUNCATE);")
+            report["before"] = measure(client)
+            report["before"]["table_bytes"] = _table_bytes(conn)
+            report["compact"] = compact(conn, level=app.config['ARCHIVE_LEVEL'])
+            report["after"] = measure(client)
+            report["after"]["table_bytes"] = _table_bytes(conn)
+        stop_queue()
+    return report
+
+
+def run_load(target, requests, clients, speed=0, seed=0, check=True):
+    """
+    runs requests against a target, optionally after seeding it with
+    completed stories, and checks the stories written during the run
+
+    :param target: server the load is sent to
+    :type target: collab.loadgen.Target
+    :param requests: requests in the trace format
+    :type requests: list
+    :param clients: number of concurrent clients
+    :type clients: int
+    :param speed: replay speed, 0 sends requests as fast as possible
+    :type speed: float
+    :param seed: number of completed stories added before the run
+    :type seed: int
+    :param check: whether the stories written during the run are checked
+    :type check: bool
+    :return: report of collab.loadgen.run_requests with the check results
+    :rtype: dict
+    """
+
+    if seed > 0:
+        seed_stories(target, seed)
+    before = last_story_id(target)
+    if before == 0 and any("{active}" in entry["path"] for entry in requests):
+        # reads of the active story need a story to exist
+        seed_stories(target, 0, extra_words=1)
+        before = last_story_id(target)
+    report = run_requests(target, requests, clients, speed, active=before)
+    if check and any(entry["method"] == "POST" for entry in requests):
+        report["check"] = check_stories(target, max(before - 1, 0))
+    return report
+
+
+def _save(report, path):
+    print(json.dumps(report, indent=2))
+    if path:
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2)
+
+
+def main(argv=None):
+    """
+    command line entry point for the benchmarks
+
+    :param argv: command line arguments
+    :type argv: list
+    :return: exit status
+    :rtype: int
+    """
+
+    parser = argparse.ArgumentParser(prog="python -m collab.bench")
+    subparsers = parser.add_subparsers(dest="benchmark")
+    subparsers.required = True
+
+    add_parser = subparsers.add_parser("add", help="concurrent /add consistency benchmark")
+    add_parser.add_argument("--url", default="http://127.0.0.1:8000")
+    add_parser.add_argument("--workers", type=int, default=8)
+    add_parser.add_argument("--requests", type=int, default=1000)
+    add_parser.add_argument("--rooms", type=int, default=0, help="room keys to spread the words over")
+
+    append_parser = subparsers.add_parser("append", help="append cost against story length")
+    append_parser.add_argument("--lengths", type=int, nargs="+", default=[1, 100, 1000])
+    append_parser.add_argument("--samples", type=int, default=30)
+
+    load_parser = subparsers.add_parser("load", help="mixed read/write load from keep-alive clients")
+    load_parser.add_argument("--url", default="http://127.0.0.1:8000")
+    load_parser.add_argument("--clients", type=int, default=32)
+    load_parser.add_argument("--requests", type=int, default=200)
+    load_parser.add_argument("--read-ratio", type=float, default=0.9)
+
+    page_parser = subparsers.add_parser("pagination", help="offset vs cursor paging at increasing depth")
+    page_parser.add_argument("--rows", type=int, default=1000000)
+    page_parser.add_argument("--depths", type=int, nargs="+", default=[0, 1000, 100000, 900000])
+    page_parser.add_argument("--limit", type=int, default=100)
+    page_parser.add_argument("--sort", choices=["created_at", "updated_at", "title"], default="updated_at")
+    page_parser.add_argument("--order", choices=["asc", "desc"], default="asc")
+
+    run_parser = subparsers.add_parser("run", help="synthetic workload with per-endpoint latency")
+    run_parser.add_argument("mix", choices=MIXES)
+    run_parser.add_argument("--url", default=None, help="live server, default: app in this process")
+    run_parser.add_argument("--requests", type=int, default=2000)
+    run_parser.add_argument("--clients", type=int, default=8)
+    run_parser.add_argument("--seed", type=int, default=0, help="seed of the random choices")
+    run_parser.add_argument("--stories", type=int, default=0, help="completed stories added before the run")
+    run_parser.add_argument("--depth", type=int, default=1000, help="deepest offset of deep-pagination")
+    run_parser.add_argument("--record", default=None, help="also write the requests to this trace file")
+    run_parser.add_argument("--out", default=None, help="also write the report to this file")
+    run_parser.add_argument("--no-check", dest="check", action="store_false")
+
+    replay_parser = subparsers.add_parser("replay", help="replay a recorded trace")
+    replay_parser.add_argument("trace")
+    replay_parser.add_argument("--url", default=None, help="live server, default: app in this process")
+    replay_parser.add_argument("--clients", type=int, default=1)
+    replay_parser.add_argument("--speed", type=float, default=0, help="keep the recorded pace, scaled; 0 for no pauses")
+    replay_parser.add_argument("--out", default=None, help="also write the report to this file")
+    replay_parser.add_argument("--no-check", dest="check", action="store_false")
+
+    logging_parser = subparsers.add_parser("logging", help="/add latency with logging off, sync and queued")
+    logging_parser.add_argument("--modes", nargs="+", choices=LOGGING_MODES, default=list(LOGGING_MODES))
+    logging_parser.add_argument("--requests", type=int, default=2000)
+    logging_parser.add_argument("--clients", type=int, default=8)
+
+    startup_parser = subparsers.add_parser("startup", help="worker start in a new interpreter vs forked")
+    startup_parser.add_argument("--runs", type=int, default=5)
+
+    compression_parser = subparsers.add_parser("compression", help="response bytes and CPU per content coding")
+    compression_parser.add_argument("--stories", type=int, default=100)
+    compression_parser.add_argument("--requests", type=int, default=500)
+
+    archive_parser = subparsers.add_parser("archive", help="database size and reads before and after compact-db")
+    archive_parser.add_argument("--stories", type=int, default=2000)
+    archive_parser.add_argument("--requests", type=int, default=500)
+
+    compare_parser = subparsers.add_parser("compare", help="compare two saved reports")
+    compare_parser.add_argument("base")
+    compare_parser.add_argument("new")
+    compare_parser.add_argument("--threshold", type=float, default=0.1)
+
+    args = parser.parse_args(argv)
+
+    if args.benchmark in ("run", "replay"):
+        if args.benchmark == "run":
+            requests = synthetic_mix(args.mix, args.requests, args.seed, args.depth)
+            if args.record:
+                write_trace(args.record, requests)
+        else:
+            requests = read_trace(args.trace)
+        with tempfile.TemporaryDirectory() as tmp:
+            target = _target(args.url, tmp)
+            report = run_load(
+                target, requests, args.clients,
+                speed=getattr(args, "speed", 0),
+                seed=getattr(args, "stories", 0),
+                check=args.check
+            )
+        report["workload"] = args.mix if args.benchmark == "run" else args.trace
+        _save(report, args.out)
+        return 0 if report["failed"] == 0 and not report.get("check", dict()).get("invalid") else 1
+
+    if args.benchmark == "compare":
+        with open(args.base, encoding="utf-8") as f:
+            base = json.load(f)
+        with open(args.new, encoding="utf-8") as f:
+            new = json.load(f)
+        report = compare_reports(base, new, args.threshold)
+        print(json.dumps(report, indent=2))
+        return 0 if len(report["regressions"]) == 0 else 1
+
+    if args.benchmark == "add":
+        report = add_concurrency(args.url, args.workers, args.requests, args.rooms)
+        print(json.dumps(report, indent=2))
+        return 0 if report["consistent"] else 1
+
+    if args.benchmark == "load":
+        report = load(args.url, args.clients, args.requests, args.read_ratio)
+        print(json.dumps(report, indent=2))
+        return 0 if report["failed"] == 0 else 1
+
+    if args.benchmark == "pagination":
+        print(json.dumps(pagination(args.rows, args.depths, args.limit, args.sort, args.order), indent=2))
+        return 0
+
+    if args.benchmark == "logging":
+        report = logging_cost(args.modes, args.requests, args.clients)
+        print(json.dumps(report, indent=2))
+        return 0 if all(entry["failed"] == 0 for entry in report["results"].values()) else 1
+
+    if args.benchmark == "compression":
+        print(json.dumps(compression_cost(args.stories, args.requests), indent=2))
+        return 0
+
+    if args.benchmark == "archive":
+        print(json.dumps(archive_cost(args.stories, args.requests), indent=2))
+        return 0
+
+    if args.benchmark == "startup":
+        print(json.dumps(startup_cost(args.runs), indent=2))
+        return 0
+
+    if args.benchmark == "append":
+        print(json.dumps(append_cost(args.lengths, args.samples), indent=2))
+        return 0
+
+    return 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
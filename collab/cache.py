@@ -0,0 +1,290 @@
+"""
+contains the read-through cache of serialized story responses
+
+Completed stories never change, so their response bodies are kept until
+they are evicted by the LRU bound. The body of the active story is stamped
+with the write generation it was read at and dropped as soon as a word is
+added. With ``STORY_CACHE_SHARED`` the generation lives in a small memory
+mapped file, so a word added through one gunicorn worker invalidates the
+active story cached by every other worker.
+
+Completed stories also keep their bodies compressed with each content
+coding they were sent with (see collab/compress.py).
+
+The closed paragraphs of stories still being written are kept serialized
+as well. They never change, so a story body can be rebuilt around them
+once its last paragraph has been read again.
+"""
+
+import os
+import mmap
+import fcntl
+import struct
+import logging
+import threading
+
+from collections import OrderedDict
+
+
+LOG = logging.getLogger(__name__)
+
+_CACHES = dict()
+_CACHES_LOCK = threading.Lock()
+
+_COUNTER = struct.Struct("Q")
+
+
+class LocalGeneration:
+    """
+    write generation seen by the current process only
+    """
+
+    def __init__(self):
+        self._value = 0
+        self._lock = threading.Lock()
+
+    def value(self):
+        return self._value
+
+    def bump(self):
+        with self._lock:
+            self._value += 1
+
+
+class SharedGeneration:
+    """
+    write generation shared by every process through a memory mapped file
+    """
+
+    def __init__(self, path):
+        """
+        :param path: file holding the counter, created if missing
+        :type path: str
+        """
+
+        self._fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+        if os.fstat(self._fd).st_size < _COUNTER.size:
+            os.ftruncate(self._fd, _COUNTER.size)
+        self._map = mmap.mmap(self._fd, _COUNTER.size)
+        self._lock = threading.Lock()
+
+    def value(self):
+        return _COUNTER.unpack_from(self._map, 0)[0]
+
+    def bump(self):
+        # the file lock keeps concurrent increments from different workers
+        # from collapsing into one
+        with self._lock:
+            fcntl.lockf(self._fd, fcntl.LOCK_EX)
+            try:
+                _COUNTER.pack_into(self._map, 0, _COUNTER.unpack_from(self._map, 0)[0] + 1)
+            finally:
+                fcntl.lockf(self._fd, fcntl.LOCK_UN)
+
+
+class StoryCache:
+    """
+    size-bounded LRU of serialized story responses, keyed by story id
+    """
+
+    def __init__(self, size, generation):
+        """
+        :param size: maximum number of cached stories
+        :type size: int
+        :param generation: write generation used to expire the active story
+        :type generation: LocalGeneration or SharedGeneration
+        """
+
+        self.size = int(size)
+        self.generation = generation
+        self._entries = OrderedDict()
+        self._paragraphs = OrderedDict()
+        self._lock = threading.Lock()
+        self._metrics = dict({
+            "hits": 0,
+            "misses": 0,
+            "evictions": 0,
+            "invalidations": 0,
+            "encoded_hits": 0,
+            "encoded_misses": 0
+        })
+
+    def get(self, id):
+        """
+        :param id: id of the story
+        :type id: int
+        :return: cached value, or None on a miss
+        """
+
+        with self._lock:
+            entry = self._entries.get(id)
+            if entry is not None:
+                value, generation, _ = entry
+                if generation is None or generation == self.generation.value():
+                    self._entries.move_to_end(id)
+                    self._metrics["hits"] += 1
+                    return value
+                del self._entries[id]
+                self._metrics["invalidations"] += 1
+            self._metrics["misses"] += 1
+            return None
+
+    def put(self, id, value, generation=None):
+        """
+        caches a serialized response along with anything needed to serve it
+
+        :param id: id of the story
+        :type id: int
+        :param value: serialized response and its metadata
+        :param generation: generation read before the story was loaded, None
+            for completed stories which never expire
+        :type generation: int
+        """
+
+        if self.size <= 0:
+            return
+        with self._lock:
+            # compressed bodies of completed stories are added to the dict
+            self._entries[id] = (value, generation, dict())
+            self._entries.move_to_end(id)
+            while len(self._entries) > self.size:
+                self._entries.popitem(last=False)
+                self._metrics["evictions"] += 1
+
+    def encoded(self, id, value, encoding):
+        """
+        :param id: id of the story
+        :type id: int
+        :param value: value returned by get, or just cached by put
+        :param encoding: content coding of the body
+        :type encoding: str
+        :return: the compressed body kept for the value, None if there is
+            none, and whether one would be kept: only completed stories,
+            which never expire, keep compressed bodies
+        :rtype: tuple
+        """
+
+        with self._lock:
+            entry = self._entries.get(id)
+            if entry is None or entry[0] is not value or entry[1] is not None:
+                return None, False
+            body = entry[2].get(encoding)
+            self._metrics["encoded_hits" if body is not None else "encoded_misses"] += 1
+            return body, True
+
+    def put_encoded(self, id, value, encoding, body):
+        """
+        keeps the compressed body of a completed story along with its entry
+
+        :param id: id of the story
+        :type id: int
+        :param value: cached value the body was compressed from
+        :param encoding: content coding of the body
+        :type encoding: str
+        :param body: compressed body
+        :type body: bytes
+        """
+
+        with self._lock:
+            entry = self._entries.get(id)
+            if entry is not None and entry[0] is value and entry[1] is None:
+                entry[2][encoding] = body
+
+    def closed_paragraphs(self, id):
+        """
+        :param id: id of the story
+        :type id: int
+        :return: serialized paragraphs of the story before its last one,
+            as far as they are cached
+        :rtype: list
+        """
+
+        with self._lock:
+            paragraphs = self._paragraphs.get(id)
+            if paragraphs is None:
+                return []
+            self._paragraphs.move_to_end(id)
+            return list(paragraphs)
+
+    def put_closed_paragraphs(self, id, paragraphs):
+        """
+        :param id: id of the story
+        :type id: int
+        :param paragraphs: serialized paragraphs of the story before its
+            last one, from the first paragraph on
+        :type paragraphs: list
+        """
+
+        if self.size <= 0:
+            return
+        with self._lock:
+            if len(paragraphs) > len(self._paragraphs.get(id, ())):
+                self._paragraphs[id] = tuple(paragraphs)
+            if id in self._paragraphs:
+                self._paragraphs.move_to_end(id)
+            while len(self._paragraphs) > self.size:
+                self._paragraphs.popitem(last=False)
+
+    def drop_closed_paragraphs(self, id):
+        """
+        :param id: id of a story that is completed or no longer exists
+        :type id: int
+        """
+
+        with self._lock:
+            self._paragraphs.pop(id, None)
+
+    def invalidate(self, id=None):
+        """
+        expires the active story in this and, if shared, every other process
+
+        :param id: id of the story to drop from this process right away
+        :type id: int
+        """
+
+        self.generation.bump()
+        if id is None:
+            return
+        with self._lock:
+            if self._entries.pop(id, None) is not None:
+                self._metrics["invalidations"] += 1
+
+    def stats(self):
+        """
+        :return: hit, miss, eviction and invalidation counters with the current size
+        :rtype: dict
+        """
+
+        with self._lock:
+            stats = dict(self._metrics)
+            stats["entries"] = len(self._entries)
+        stats["size"] = self.size
+        return stats
+
+
+def get_story_cache(config):
+    """
+    returns the story cache of the current process, creating it on first use
+
+    :param config: flask app configuration
+    :type config: flask.Config
+    :return: story cache
+    :rtype: StoryCache
+    """
+
+    key = (os.getpid(), config['DATABASE'])
+    cache = _CACHES.get(key)
+    if cache is not None:
+        return cache
+
+    with _CACHES_LOCK:
+        cache = _CACHES.get(key)
+        if cache is None:
+            if config.get('STORY_CACHE_SHARED', True):
+                generation = SharedGeneration(config['STORY_CACHE_GENERATION'])
+            else:
+                generation = LocalGeneration()
+            cache = StoryCache(config.get('STORY_CACHE_SIZE', 1024), generation)
+            _CACHES[key] = cache
+            LOG.debug("initialized story cache (size=%s) for process %s", cache.size, key[0])
+    return cache
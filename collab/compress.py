@@ -0,0 +1,192 @@
+"""
+contains the compression of response bodies negotiated with Accept-Encoding
+
+gzip is always available, brotli ("br") with the brotli package and zstd
+with the zstandard package. ``COMPRESS`` lists the encodings offered,
+"auto" (the default) offers every installed one and "off" none. The
+client's preference decides, ties go to the order of ENCODINGS. JSON
+responses of at least ``COMPRESS_MIN_SIZE`` bytes are compressed after the
+view ran, at ``COMPRESS_LEVELS``.
+
+Completed stories never change: GET /stories/<id> compresses their body
+once per encoding, at ``COMPRESS_STATIC_LEVELS``, and the story cache keeps
+the result, so repeated reads send the stored bytes without compressing
+anything (see DBHandler.get_story_encoded).
+
+A compressed response carries a weak ETag, the entity tag of the
+uncompressed body, which conditional requests compare weakly anyway.
+"""
+
+import gzip
+import logging
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+
+LOG = logging.getLogger(__name__)
+
+# content codings by server preference, for clients accepting several
+ENCODINGS = ("br", "zstd", "gzip")
+
+
+def available():
+    """
+    :return: encodings whose library is installed
+    :rtype: tuple
+    """
+
+    return tuple(
+        encoding for encoding in ENCODINGS
+        if encoding == "gzip" or (encoding == "br" and brotli is not None)
+        or (encoding == "zstd" and zstandard is not None)
+    )
+
+
+def _setting(config):
+    """
+    :return: words of COMPRESS, without "off"
+    :rtype: list
+    """
+
+    return [word for word in str(config.get('COMPRESS') or "off").replace(",", " ").split() if word != "off"]
+
+
+def offered(config):
+    """
+    :param config: flask app configuration
+    :type config: flask.Config
+    :return: encodings enabled by COMPRESS and installed, by preference
+    :rtype: tuple
+    """
+
+    enabled = _setting(config)
+    if enabled == ["auto"]:
+        return available()
+    return tuple(encoding for encoding in available() if encoding in enabled)
+
+
+def negotiate(accept_encodings, encodings):
+    """
+    picks the content coding of a response
+
+    :param accept_encodings: Accept-Encoding of the request
+    :type accept_encodings: werkzeug.datastructures.Accept
+    :param encodings: encodings that may be used, by preference
+    :type encodings: tuple
+    :return: encoding to use, None to send the body as it is
+    :rtype: str
+    """
+
+    # an entry naming the encoding wins over "*", whatever their order
+    qualities = dict((value.lower(), quality) for value, quality in accept_encodings)
+    best, best_quality = None, 0
+    for encoding in encodings:
+        quality = qualities.get(encoding, qualities.get("*", 0))
+        if quality > best_quality:
+            best, best_quality = encoding, quality
+    return best
+
+
+def compress(body, encoding, level):
+    """
+    :param body: response body
+    :type body: bytes
+    :param encoding: one of ENCODINGS
+    :type encoding: str
+    :param level: compression level of the encoding
+    :type level: int
+    :return: compressed body
+    :rtype: bytes
+    """
+
+    if encoding == "gzip":
+        # no timestamp, so the same body always compresses to the same bytes
+        return gzip.compress(body, compresslevel=level, mtime=0)
+    if encoding == "br":
+        return brotli.compress(body, quality=level)
+    if encoding == "zstd":
+        return zstandard.ZstdCompressor(level=level).compress(body)
+    raise ValueError("unknown encoding {}".format(encoding))
+
+
+def encode_response(response, encoding, body):
+    """
+    sets a compressed body on a response
+
+    :param response: response with the uncompressed body
+    :type response: flask.Response
+    :param encoding: content coding of body
+    :type encoding: str
+    :param body: compressed body
+    :type body: bytes
+    """
+
+    response.set_data(body)
+    response.headers["Content-Encoding"] = encoding
+    etag, weak = response.get_etag()
+    if etag is not None and not weak:
+        response.set_etag(etag, weak=True)
+
+
+def vary(response):
+    """
+    marks a response as depending on Accept-Encoding
+    """
+
+    response.vary.add("Accept-Encoding")
+
+
+def _after_request(response):
+    from flask import current_app, request
+    from .metrics import get_registry
+
+    if response.status_code == 304:
+        vary(response)
+    if response.mimetype not in current_app.config['COMPRESS_MIMETYPES']:
+        return response
+    vary(response)
+    if response.status_code != 200 or response.is_streamed or response.direct_passthrough \
+            or "Content-Encoding" in response.headers:
+        return response
+
+    body = response.get_data()
+    if len(body) < current_app.config['COMPRESS_MIN_SIZE']:
+        return response
+    encoding = negotiate(request.accept_encodings, offered(current_app.config))
+    if encoding is None:
+        return response
+
+    with get_registry().time("collab_compress_duration_seconds", (("encoding", encoding),)):
+        compressed = compress(body, encoding, current_app.config['COMPRESS_LEVELS'][encoding])
+    encode_response(response, encoding, compressed)
+    return response
+
+
+def init_app(app):
+    """
+    compresses the JSON responses of the app, if COMPRESS is enabled
+
+    :param app: flask app
+    :type app: flask.Flask
+    :raises ValueError: COMPRESS names an unknown encoding
+    """
+
+    enabled = _setting(app.config)
+    unknown = [encoding for encoding in enabled if encoding not in ENCODINGS + ("auto",)]
+    if unknown:
+        raise ValueError("unknown COMPRESS encodings {}".format(", ".join(unknown)))
+    encodings = offered(app.config)
+    missing = [encoding for encoding in enabled if encoding in ENCODINGS and encoding not in encodings]
+    if missing:
+        LOG.warning("compression with %s is not installed", ", ".join(missing))
+    if len(encodings) != 0:
+        LOG.debug("response compression: %s", ", ".join(encodings))
+        app.after_request(_after_request)
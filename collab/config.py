@@ -10,6 +10,115 @@ class BasicConfig:
     DATABASE = os.path.join(DIR, "collab.sql")
     LOGS = os.path.join(DIR, "collab.logs")
     LOGGING_CONFIG = os.path.join(os.path.dirname(os.path.realpath(__file__)), "log_config.yaml")
+    # records are handed to one writer thread per process instead of being
+    # written by the request thread
+    LOG_QUEUE = os.environ.get("COLLAB_LOG_QUEUE", "1").lower() not in ("0", "false", "no")
+    # "text" or "json" (one JSON object per line) for the log file
+    LOG_FORMAT = os.environ.get("COLLAB_LOG_FORMAT", "text")
+    # the log file is rotated past LOG_MAX_BYTES and, if set, every
+    # LOG_ROTATE_INTERVAL seconds (e.g. 86400 for daily); 0 disables either
+    LOG_MAX_BYTES = 10 * 1024 * 1024
+    LOG_BACKUPS = 5
+    LOG_ROTATE_INTERVAL = 0
+    # a warning or error repeated from the same line is logged at most
+    # LOG_RATE_LIMIT times per LOG_RATE_PERIOD seconds; 0 disables
+    LOG_RATE_LIMIT = 10
+    LOG_RATE_PERIOD = 60.0
+    # "orjson", "json" or "auto" for orjson when it is installed
+    JSON_BACKEND = os.environ.get("COLLAB_JSON", "auto")
+    # sentence rows fetched at a time by /stories/export
+    EXPORT_BATCH = 1000
+    # stories indexed for /stories/search: "completed" (indexed once, when
+    # their last word is added), "all" (indexed again on every word) or "off"
+    SEARCH_INDEX = os.environ.get("COLLAB_SEARCH_INDEX", "completed")
+    SEARCH_TITLE_WEIGHT = 10.0
+    SEARCH_SNIPPET_TOKENS = 16
+    SEARCH_HIGHLIGHT = ("<mark>", "</mark>")
+    # "sqlite" keeps stories in DATABASE, "postgres" in the database at
+    # POSTGRES_DSN, shared by workers on any number of hosts
+    STORAGE = os.environ.get("COLLAB_STORAGE", "sqlite")
+    POSTGRES_DSN = os.environ.get("COLLAB_POSTGRES_DSN", None)
+    # stories written at the same time: "off" (one active story), "keys"
+    # (one per room key sent to /add) or "shards" (keys hashed into
+    # ROOM_SHARDS rooms), see helpers.resolve_room
+    ROOMS = os.environ.get("COLLAB_ROOMS", "off")
+    ROOM_SHARDS = 8
+    ROOM_MAX_LENGTH = 64
+    # content codings of JSON responses: "auto" (every installed one of
+    # br, zstd and gzip), a list such as "gzip br", or "off"
+    COMPRESS = os.environ.get("COLLAB_COMPRESS", "auto")
+    COMPRESS_MIN_SIZE = 1024  # bytes, smaller bodies are sent as they are
+    COMPRESS_MIMETYPES = ("application/json",)
+    COMPRESS_LEVELS = dict({"gzip": 6, "br": 5, "zstd": 3})
+    # levels of completed stories, compressed once and kept by the story cache
+    COMPRESS_STATIC_LEVELS = dict({"gzip": 9, "br": 11, "zstd": 19})
+    # completed stories moved by a background thread from the sentences
+    # table to the compressed story_archive table, ARCHIVE_BATCH stories
+    # per transaction every ARCHIVE_INTERVAL seconds, see collab/archive.py
+    ARCHIVE = os.environ.get("COLLAB_ARCHIVE", "").lower() in ("1", "true", "yes")
+    ARCHIVE_INTERVAL = 30.0
+    ARCHIVE_BATCH = 100
+    ARCHIVE_LEVEL = 9  # zlib
+    ARCHIVE_LOCK = os.path.join(DIR, "collab.archive.lock")
+    # responses of /add and /add/batch kept by idempotency key, for clients
+    # retrying with an Idempotency-Key header or a "request_id" field
+    IDEMPOTENCY = os.environ.get("COLLAB_IDEMPOTENCY", "true").lower() in ("1", "true", "yes")
+    IDEMPOTENCY_DATABASE = os.path.join(DIR, "collab.idempotency")
+    IDEMPOTENCY_TTL = 86400.0  # seconds a key is kept
+    IDEMPOTENCY_MAX_KEYS = 100000
+    IDEMPOTENCY_LOCK_TIMEOUT = 60.0  # seconds before an unfinished request's key is taken over
+    IDEMPOTENCY_KEY_MAX_LENGTH = 255
+    # days reported by /stats by default, and at most
+    STATS_DAYS = 30
+    STATS_MAX_DAYS = 366
+    # per-process connection pool and connection tuning, DB_POOL_SIZE and
+    # DB_POOL_TIMEOUT also apply to postgres
+    DB_POOL_SIZE = 8
+    DB_POOL_TIMEOUT = 10.0
+    DB_MMAP_SIZE = 256 * 1024 * 1024
+    DB_CACHE_SIZE = -16000  # negative values are in KiB
+    DB_STATEMENT_CACHE = 256
+    # write-behind buffer for the active story, needs a single worker process
+    WRITE_BEHIND = os.environ.get("COLLAB_WRITE_BEHIND", "").lower() in ("1", "true", "yes")
+    WRITE_BEHIND_MAX_WORDS = 500
+    WRITE_BEHIND_INTERVAL = 0.5
+    WRITE_BEHIND_FSYNC = False
+    WORD_LOG = os.path.join(DIR, "collab.wordlog")
+    # reader threads of the ASGI entry point, writes always use one thread
+    ASGI_READERS = 16
+    # threads of the ASGI entry point for exports
+    ASGI_STREAMS = 256
+    # largest number of words accepted by /add/batch
+    ADD_BATCH_MAX_WORDS = 10000
+    # cache of serialized GET /stories/<id> responses, 0 disables it
+    STORY_CACHE_SIZE = 1024
+    # share invalidations of the active story across worker processes
+    STORY_CACHE_SHARED = True
+    STORY_CACHE_GENERATION = os.path.join(DIR, "collab.cachegen")
+    # single writer process owning all story mutations, with a bounded queue
+    WRITER = os.environ.get("COLLAB_WRITER", "").lower() in ("1", "true", "yes")
+    WRITER_SOCKET = os.path.join(DIR, "collab.writer.sock")
+    WRITER_LOCK = os.path.join(DIR, "collab.writer.lock")
+    WRITER_QUEUE_SIZE = 1024
+    WRITER_BATCH = 64  # queued writes applied per transaction
+    WRITER_TIMEOUT = 10.0
+    WRITER_RETRY_AFTER = 1  # seconds, sent with 503 when the queue is full
+    # live story events, /stories/<id>/events
+    EVENTS_POLL_INTERVAL = 0.05  # seconds between checks for new words
+    EVENTS_BACKLOG = 1024  # recent events kept in memory per followed story
+    EVENTS_KEEPALIVE = 15  # seconds between SSE comments on an idle stream
+    EVENTS_LONG_POLL_TIMEOUT = 25  # longest wait of a long-poll, in seconds
+    # per-process metrics, merged on /metrics in the Prometheus format
+    METRICS = os.environ.get("COLLAB_METRICS", "true").lower() in ("1", "true", "yes")
+    METRICS_DIR = os.path.join(DIR, "metrics")
+    METRICS_FLUSH_INTERVAL = 1.0
+    METRICS_DB_TIMING = True  # time every SQL statement and commit
+    # sampling profiler for requests carrying ?profile=1
+    PROFILE_REQUESTS = os.environ.get("COLLAB_PROFILE", "").lower() in ("1", "true", "yes")
+    PROFILE_INTERVAL = 0.001
+    PROFILE_DIR = os.path.join(DIR, "profiles")
+    # JSON lines file every request is recorded to, see collab/trace.py
+    TRACE_FILE = os.environ.get("COLLAB_TRACE", None)
 
 class ProdConfig(BasicConfig):
     SECRET_KEY = 'skj123'
\ No newline at end of file
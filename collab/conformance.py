@@ -0,0 +1,316 @@
+"""
+contains the conformance checks of the storage backends
+
+The same scripted session is played against a fresh app on every backend
+given, through the flask test client. It covers story rollover, the
+listing with offsets and cursors, conditional reads, unknown ids, export and
+import, the id sequence after an import, retried writes and concurrent
+writers. Each backend must pass every check, and the responses it gave,
+with timestamps and ETags left out, must be identical to those of the first
+backend:
+
+    python -m collab.conformance sqlite postgres --dsn postgresql://collab@localhost/collab_test
+
+The postgres database must not hold stories yet, or ``--reset`` drops them.
+"""
+
+import re
+import sys
+import json
+import argparse
+import tempfile
+import threading
+
+from .bench import _target
+from .loadgen import STORY_WORDS, check_stories
+from .storage import STORAGE_BACKENDS
+
+
+# keys of values that depend on the time a check ran
+_TIMED_KEYS = ("created_at", "updated_at", "next", "day")
+# id given to an imported copy of a story
+IMPORT_OFFSET = 1000
+
+
+def _normalize(value):
+    """
+    :param value: decoded response body
+    :return: the body without timestamps and cursors
+    """
+
+    if isinstance(value, dict):
+        return dict({key: _normalize(item) for key, item in value.items() if key not in _TIMED_KEYS})
+    if isinstance(value, list):
+        return [_normalize(item) for item in value]
+    return value
+
+
+class Session:
+    """
+    scripted client recording the responses of one backend
+    """
+
+    def __init__(self, app):
+        """
+        :param app: app of the backend under test
+        :type app: flask.Flask
+        """
+
+        self.app = app
+        self.client = app.test_client()
+        self.transcript = []
+        self.failures = []
+
+    def request(self, method, path, body=None, headers=None, record=True):
+        """
+        :return: status code and decoded JSON body, None if there is none
+        :rtype: tuple
+        """
+
+        resp = self.client.open(path, method=method, json=body, headers=headers or dict())
+        data = resp.get_json(silent=True)
+        if record:
+            self.transcript.append([method, re.sub(r"cursor=[^&]*", "cursor=...", path), resp.status_code, _normalize(data)])
+        return resp.status_code, data, resp.headers
+
+    def expect(self, name, condition, detail=None):
+        if not condition:
+            self.failures.append(dict({"check": name, "detail": detail}))
+
+
+def _listing(session, sort, order, limit):
+    """
+    walks the listing with offsets and with cursors
+
+    :return: ids in the order of the offset pages
+    :rtype: list
+    """
+
+    by_offset = []
+    while True:
+        _, page, _ = session.request("GET", "/stories?limit={}&offset={}&sort={}&order={}".format(
+            limit, len(by_offset), sort, order
+        ))
+        by_offset.extend(item["id"] for item in page["results"])
+        if page["count"] < limit:
+            break
+
+    by_cursor = []
+    path = "/stories?limit={}&sort={}&order={}".format(limit, sort, order)
+    while path is not None:
+        _, page, _ = session.request("GET", path)
+        by_cursor.extend(item["id"] for item in page["results"])
+        path = "/stories?limit={}&sort={}&order={}&cursor={}".format(limit, sort, order, page["next"]) \
+            if page["next"] else None
+
+    session.expect("listing {} {}".format(sort, order), by_offset == by_cursor, dict({
+        "offset": by_offset, "cursor": by_cursor
+    }))
+    return by_offset
+
+
+def _concurrent_adds(session, clients, words):
+    """
+    adds words from concurrent clients and checks that none were lost
+
+    :param clients: number of threads
+    :type clients: int
+    :param words: words sent by every thread
+    :type words: int
+    """
+
+    from .db_hanlder import DBHandler
+
+    def total():
+        with session.app.app_context():
+            return sum(story["words"] for story in DBHandler.export_stories())
+
+    before = total()
+    statuses = []
+
+    def send(client):
+        local = session.app.test_client()
+        for i in range(words):
+            statuses.append(local.post("/add", json=dict({"word": "c{}x{}".format(client, i)})).status_code)
+
+    threads = [threading.Thread(target=send, args=(client,)) for client in range(clients)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    session.expect("concurrent adds answered", all(status in (200, 201) for status in statuses), statuses)
+    session.expect("concurrent adds kept", total() - before == clients * words, dict({
+        "before": before, "after": total(), "sent": clients * words
+    }))
+
+
+def run_checks(app, clients=8, words=50):
+    """
+    plays the scripted session against an app with an empty database
+
+    :param app: app of the backend under test
+    :type app: flask.Flask
+    :param clients: threads of the concurrent writers check
+    :type clients: int
+    :param words: words sent by each of them
+    :type words: int
+    :return: failed checks and the normalized responses of the session
+    :rtype: dict
+    """
+
+    from .db_hanlder import DBHandler
+    from .loadgen import Target
+
+    session = Session(app)
+    status, _, _ = session.request("GET", "/stories/1")
+    session.expect("unknown story", status == 400, status)
+
+    # a story started word by word, then two rollovers in one batch
+    for i in range(20):
+        status, body, _ = session.request("POST", "/add", dict({"word": "w{}".format(i)}))
+        session.expect("add", status in (200, 201), body)
+    status, body, _ = session.request(
+        "POST", "/add/batch", dict({"words": ["b{}".format(i) for i in range(2 * STORY_WORDS)]})
+    )
+    session.expect("batch", status == 200 and body["count"] == 2 * STORY_WORDS, status)
+    check = check_stories(Target(app=app))
+    session.expect("story shape", check["invalid"] == [] and check["completed"] == 2, check)
+
+    for id in (1, 2, 3):
+        status, story, headers = session.request("GET", "/stories/{}".format(id))
+        revalidated, _, _ = session.request(
+            "GET", "/stories/{}".format(id), headers=dict({"If-None-Match": headers.get("ETag", "")})
+        )
+        session.expect("etag of story {}".format(id), revalidated == 304, revalidated)
+    for query in ("tail=1", "para_from=1&sent_from=2&para_to=2", "para_to=1&sent_to=3&tail=4", "para_from=40"):
+        status, _, _ = session.request("GET", "/stories/3?{}".format(query))
+        session.expect("range {} of story 3".format(query), status == 200, status)
+    status, _, _ = session.request("GET", "/stories/999")
+    session.expect("unknown story", status == 400, status)
+
+    for sort in ("created_at", "updated_at", "title"):
+        for order in ("asc", "desc"):
+            _listing(session, sort, order, 2)
+
+    with app.app_context():
+        # what live events read after a word is added
+        session.transcript.append(["tail", DBHandler.get_story_tail(3, 0, 5)])
+        exported = list(DBHandler.export_stories())
+        session.transcript.append(["export", _normalize(exported)])
+        copies = [
+            dict(story, id=story["id"] + IMPORT_OFFSET, modifying="no")
+            for story in exported
+        ]
+        counts = DBHandler.import_stories(copies[:1], batch=1)
+        session.expect("import", counts == dict({"imported": 1, "skipped": 0, "closed": 0}), counts)
+        counts = DBHandler.import_stories(copies, batch=2)
+        session.expect("import skips taken ids", counts == dict({"imported": 2, "skipped": 1, "closed": 0}), counts)
+    for story in exported:
+        _, original, _ = session.request("GET", "/stories/{}".format(story["id"]), record=False)
+        _, copy, _ = session.request("GET", "/stories/{}".format(story["id"] + IMPORT_OFFSET))
+        session.expect("imported story {}".format(story["id"]), dict(copy, id=original["id"]) == original, copy)
+
+    # new stories carry on after the imported ids
+    _, story, _ = session.request("GET", "/stories/3", record=False)
+    missing = STORY_WORDS - (len(story["title"].split()) + sum(
+        len(text.split()) for paragraph in story["paragraphs"] for text in paragraph["sentences"]
+    ))
+    session.request("POST", "/add/batch", dict({"words": ["n{}".format(i) for i in range(missing + 1)]}))
+    status, body, _ = session.request("POST", "/add", dict({"word": "after"}))
+    session.expect(
+        "id after import", body is not None and body["id"] == IMPORT_OFFSET + exported[-1]["id"] + 1, body
+    )
+
+    # a retried write is answered from the first attempt, not applied twice
+    retry = dict({"Idempotency-Key": "conformance-retry"})
+    first = session.request("POST", "/add", dict({"word": "retried"}), headers=retry)
+    again = session.request("POST", "/add", dict({"word": "retried"}), headers=retry)
+    session.expect("idempotent retry", first[:2] == again[:2] and again[2].get("Idempotent-Replayed") == "true", [
+        first[:2], again[:2]
+    ])
+    status, _, _ = session.request("POST", "/add", dict({"word": "other"}), headers=retry)
+    session.expect("idempotency key reused", status == 422, status)
+
+    _concurrent_adds(session, clients, words)
+    # counters kept along with the writes, against a scan of the stories
+    status, stats, _ = session.request("GET", "/stats")
+    with app.app_context():
+        exported = list(DBHandler.export_stories())
+    totals = dict({
+        "stories": len(exported),
+        "completed": sum(1 for story in exported if story["modifying"] == "no"),
+        "words": sum(story["words"] for story in exported)
+    })
+    session.expect(
+        "stats", status == 200 and all(stats[key] == value for key, value in totals.items()), [stats, totals]
+    )
+    return dict({"failures": session.failures, "transcript": session.transcript})
+
+
+def _reset_postgres(dsn, reset):
+    """
+    :raises ValueError: the database holds stories and reset is not set
+    """
+
+    import psycopg
+
+    with psycopg.connect(dsn, autocommit=True) as conn:
+        exists = conn.execute("SELECT to_regclass('stories') IS NOT NULL;").fetchone()[0]
+        if not exists:
+            return
+        if not reset and conn.execute("SELECT count(*) FROM stories;").fetchone()[0] != 0:
+            raise ValueError("the postgres database holds stories, pass --reset to drop them")
+        conn.execute("DROP TABLE IF EXISTS stories, story_totals, story_daily, idempotency_keys;")
+
+
+def main(argv=None):
+    """
+    command line entry point of the conformance checks
+
+    :param argv: command line arguments
+    :type argv: list
+    :return: exit status
+    :rtype: int
+    """
+
+    parser = argparse.ArgumentParser(prog="python -m collab.conformance")
+    parser.add_argument("storages", nargs="+", choices=list(STORAGE_BACKENDS))
+    parser.add_argument("--dsn", default=None, help="database of the postgres backend, emptied first")
+    parser.add_argument("--reset", action="store_true", help="drop the stories of the postgres database")
+    parser.add_argument("--clients", type=int, default=8)
+    parser.add_argument("--words", type=int, default=50, help="words sent by each concurrent client")
+    args = parser.parse_args(argv)
+
+    report = dict()
+    reference = None
+    for storage in args.storages:
+        config = dict({"STORAGE": storage})
+        if storage == "postgres":
+            if not args.dsn:
+                parser.error("postgres needs --dsn")
+            _reset_postgres(args.dsn, args.reset)
+            config["POSTGRES_DSN"] = args.dsn
+        with tempfile.TemporaryDirectory() as tmp:
+            result = run_checks(_target(None, tmp, config).app, args.clients, args.words)
+        if reference is None:
+            reference = result["transcript"]
+        elif result["transcript"] != reference:
+            diverged = next(
+                index for index, (a, b) in enumerate(zip(reference + [None], result["transcript"] + [None])) if a != b
+            )
+            result["failures"].append(dict({
+                "check": "same responses as {}".format(args.storages[0]),
+                "detail": dict({
+                    "expected": reference[diverged] if diverged < len(reference) else None,
+                    "got": result["transcript"][diverged] if diverged < len(result["transcript"]) else None
+                })
+            }))
+        report[storage] = dict({"responses": len(result["transcript"]), "failures": result["failures"]})
+
+    print(json.dumps(report, indent=2))
+    return 0 if all(len(entry["failures"]) == 0 for entry in report.values()) else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
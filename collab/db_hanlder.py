@@ -4,21 +4,47 @@ contains methods to handle database and adjoining operations
 
 import sqlite3
 import logging
-import json
 
+from itertools import groupby
+from operator import itemgetter
 from contextlib import contextmanager
 
 from flask import current_app, g
 
-from .exceptions import IDNotFound
+from .exceptions import IDNotFound, StorageUnavailable
+from .pool import get_pool
+from .storage import get_storage
+from .cache import get_story_cache
+from .migrations import migrate, schema_version, SCHEMA_VERSION
+from .search import setup_search, rebuild_search, match_expression, FTS5_SUPPORTED
+from .story import StoryCursor, build_paragraphs, story_part, PARAGRAPH_END
+from .helpers import close_clashing_stories
+from .write_buffer import get_write_buffer
+from .writer import get_writer_client
+from .metrics import get_registry, JSON_ENCODE
+from .compress import compress
+from .archive import unpack, get_archiver
+from . import serialize
 
 
 LOG = logging.getLogger(__name__)
 
-# index of modifying table
-MOD_TITLE = 0
-MOD_PARA = 1
-MOD_SENT = 2
+# UPDATE ... RETURNING is available from SQLite 3.35.0 onwards
+RETURNING_SUPPORTED = sqlite3.sqlite_version_info >= (3, 35, 0)
+
+# sort columns and orders accepted by get_stories, mapped to their SQL
+SORT_COLUMNS = dict({"created_at": "created_at", "updated_at": "updated_at", "title": "title"})
+ORDERS = dict({"asc": "ASC", "desc": "DESC"})
+# filters accepted by export_stories, mapped to their SQL; windows include
+# their start and exclude their end
+EXPORT_FILTERS = dict({
+    "id_from": "stories.id >= ?",
+    "id_to": "stories.id <= ?",
+    "created_from": "created_at >= ?",
+    "created_to": "created_at < ?",
+    "updated_from": "updated_at >= ?",
+    "updated_to": "updated_at < ?"
+})
 
 class DBHandler:
     """
@@ -27,179 +53,464 @@ class DBHandler:
     
     def __init__(self):
         """
-        initialises database with instructions in init.sql        
+        initialises database with instructions in init.sql, migrating
+        databases created by older versions
+
+        A database already at SCHEMA_VERSION is left as it is, so starting
+        another worker only reads the schema version and the search
+        triggers, without taking the write lock.
+
+        :raises StorageUnavailable: the database could not be set up
         """
         LOG.info("initializing database...")
+        storage = DBHandler._storage()
+        if storage is not None:
+            try:
+                storage.setup()
+            except storage.errors as err:
+                LOG.debug(err)
+                raise StorageUnavailable("{} storage".format(current_app.config['STORAGE'])) from err
+            LOG.info("SUCCESS: %s storage initialized!", current_app.config['STORAGE'])
+            for key in ('WRITER', 'WRITE_BEHIND', 'ARCHIVE'):
+                if current_app.config.get(key):
+                    LOG.warning("%s is ignored by the %s storage", key, current_app.config['STORAGE'])
+            return
+
         try:
             with self.connect() as conn:
-                with current_app.open_resource('init.sql') as f:
-                    conn.executescript(f.read().decode('utf-8'))
+                version = schema_version(conn)
+                if version != SCHEMA_VERSION:
+                    with current_app.open_resource('init.sql') as f:
+                        migrate(conn, f.read().decode('utf-8'))
+                    LOG.info("database schema version %s -> %s", version, SCHEMA_VERSION)
+                setup_search(conn, current_app.config['SEARCH_INDEX'])
             LOG.info("SUCCESS: database initialized!")
+            if current_app.config.get('WRITE_BEHIND') and current_app.config.get('WRITER'):
+                LOG.warning("WRITE_BEHIND is ignored while WRITER is enabled")
+            # replays the word log of the write-behind buffer, if enabled
+            if DBHandler._write_behind():
+                get_write_buffer(current_app.config)
+            if current_app.config.get('ARCHIVE'):
+                get_archiver(current_app.config)
         except sqlite3.Error as err:
             LOG.debug(err)
-            LOG.fatal("FAILED TO INITIALIZE DATABASE AT %s", current_app.config['DATABASE'])
-            exit(1)
+            raise StorageUnavailable(current_app.config['DATABASE']) from err
 
     @staticmethod
     @contextmanager
     def connect():
         """
-        context manager that yields a connection to the database and closes
-        it as soon as the context ends
+        context manager that yields a pooled connection to the database and
+        returns it to the pool as soon as the context ends
+
+        Nested calls within the same app context reuse the connection that
+        is already checked out.
         """
 
-        if 'db' not in g:
-            LOG.debug("initializing DB connection...")
-            g.db = sqlite3.connect(
-                current_app.config['DATABASE'],
-                detect_types=sqlite3.PARSE_DECLTYPES
-            )
-            g.db.row_factory = sqlite3.Row
-        
-        LOG.debug("SUCCESS: DB connection established!")
-        yield g.db
-        
-        db = g.pop('db', None)
+        if 'db' in g:
+            yield g.db
+            return
+
+        pool = get_pool(current_app.config)
+        g.db = pool.acquire()
+        try:
+            yield g.db
+        finally:
+            pool.release(g.pop('db'))
+
+    @staticmethod
+    def _storage():
+        """
+        :return: backend every read and write is handed to, None when
+            stories are kept by SQLite
+        :rtype: collab.storage.Storage
+        """
+
+        return get_storage(current_app.config)
+
+    @staticmethod
+    def _write_behind():
+        """
+        :return: whether words go to the write-behind buffer of this process
+        :rtype: bool
+        """
+
+        # the writer already groups words into shared transactions, and a
+        # buffer in one worker would hide the active story from the others
+        return bool(current_app.config.get('WRITE_BEHIND')) and not current_app.config.get('WRITER') \
+            and DBHandler._storage() is None
+
+    @staticmethod
+    def _writer():
+        """
+        :return: whether writes are handed to the story writer
+        :rtype: bool
+        """
 
-        if db is not None:
-            db.close()
-            LOG.debug("SUCCESS: DB connection closed!")
+        return bool(current_app.config.get('WRITER')) and DBHandler._storage() is None
 
     @staticmethod
-    def add_word(word):
+    def pool_stats():
         """
-        adds a new word to existing story, or calls function to create a new story
+        reports checkout, wait and hit counters of this process' connection pool
+
+        :return: pool counters
+        :rtype: dict
+        """
+
+        storage = DBHandler._storage()
+        if storage is not None:
+            return storage.pool_stats()
+        return get_pool(current_app.config).stats()
+
+    @staticmethod
+    def writer_stats():
+        """
+        reports the queue depth and counters of the story writer
+
+        :raises WriterUnavailable: the writer could not be reached
+        :return: writer counters, or an empty dict if WRITER is disabled
+        :rtype: dict
+        """
+
+        if not DBHandler._writer():
+            return dict()
+        return get_writer_client(current_app._get_current_object()).submit("stats", [])
+
+    @staticmethod
+    def add_word(word, room=""):
+        """
+        adds a new word to existing story, or creates a new story
+
+        The read of the active story, the mutation and the write happen
+        inside one ``BEGIN IMMEDIATE`` transaction on a single connection,
+        so concurrent workers are serialized by SQLite and cannot overwrite
+        each other's words. With ``WRITE_BEHIND`` enabled the word goes to
+        the in-memory write buffer instead, and with ``WRITER`` enabled it
+        is queued for the story writer.
+
+        Every room has an active story of its own, see helpers.resolve_room.
         
         :param word: word to be added
         :type word: str
+        :param room: room of the story, "" for the default one
+        :type room: str
+        :raises WriterBusy: the writer queue is full
+        :raises WriterUnavailable: the writer could not be reached
         :return: edited story as dictionary of the following format (with example values)
             {
                 "id": 1,
                 "title": "something",
                 "created_at": "timestamp",
                 "updated_at": "timestamp",
-                "paragraphs": "lorem potem ipsum"
+                "current_sentence": "lorem potem ipsum"
             }
         :rtype: dict
         """
 
+        if DBHandler._writer():
+            return get_writer_client(current_app._get_current_object()).submit("add_word", [word, room])
+        return DBHandler._add_word_local(word, room)
+
+    @staticmethod
+    def add_words(words, room=""):
+        """
+        adds an ordered list of words, following the same rules as add_word,
+        in a single transaction
+
+        A story completed in the middle of the batch is followed by a new
+        story, just as it would be with one add_word call per word.
+
+        :param words: words to be added, in order
+        :type words: list
+        :param room: room of the stories, "" for the default one
+        :type room: str
+        :raises WriterBusy: the writer queue is full
+        :raises WriterUnavailable: the writer could not be reached
+        :return: one entry per word in the format returned by add_word, or
+            an empty list if nothing was added
+        :rtype: list
+        """
+
+        if DBHandler._writer():
+            return get_writer_client(current_app._get_current_object()).submit("add_words", [words, room])
+        return DBHandler._add_words_local(words, room)
+
+    @staticmethod
+    def _add_word_local(word, room=""):
+        """
+        adds a word from this process, see add_word
+
+        :param word: word to be added
+        :type word: str
+        :param room: room of the story
+        :type room: str
+        :return: edited story in the format of add_word, or an empty dict
+        :rtype: dict
+        """
+
+        storage = DBHandler._storage()
+        if storage is not None:
+            resp = storage.add_word(word, room)
+            if len(resp) != 0:
+                get_story_cache(current_app.config).invalidate(resp["id"])
+            return resp
+
+        if DBHandler._write_behind():
+            try:
+                resp = get_write_buffer(current_app.config).add_word(word, room)
+            except sqlite3.Error as err:
+                LOG.debug(err)
+                LOG.error("unable to add word %s to database", word)
+                return dict()
+            get_story_cache(current_app.config).invalidate(resp["id"])
+            return resp
+
         try:
             with DBHandler.connect() as conn:
-                cursor = conn.cursor()
-                cursor.execute("SELECT id, modifying, title, paragraphs FROM stories WHERE modifying != 'no';")
-                resp = [dict(row) for row in cursor.fetchall()]
-                print(resp)
+                try:
+                    cursor = conn.cursor()
+                    # take the write lock before reading so the active story
+                    # cannot change between the read and the update
+                    cursor.execute("BEGIN IMMEDIATE;")
+                    resp = DBHandler._append_word(cursor, word, room)
+                    conn.commit()
+                except sqlite3.Error:
+                    conn.rollback()
+                    raise
         except sqlite3.Error as err:
             LOG.debug(err)
             LOG.error("unable to add word %s to database", word)
             return dict()
 
-        if len(resp) == 0:
-            resp = DBHandler.create_new_story(word)
-        else:
-            # gives only the story on which editing is allowed
-            sql_cmd = '''
-            UPDATE stories
-            SET updated_at = (datetime('now')),
-                modifying = ?,
-                title = ?,
-                paragraphs = ?
-            WHERE id = ?
-            '''
-
-            entry = resp[0]
-            paragraphs = json.loads(entry["paragraphs"])
-            modifying = [int(x) for x in entry["modifying"].split('|')]
-            print(modifying)
-            if int(modifying[MOD_TITLE]):
-                entry["title"] = entry["title"] + " " + word
-                modifying[MOD_TITLE] = 0
-            else:
-                cur_para_index = modifying[MOD_PARA]
-                cur_sent_index = modifying[MOD_SENT]
-                 
-                added = False
-                while(not added):
-                    try:
-                        cur_sent = paragraphs[cur_para_index]["sentences"][cur_sent_index]
-                    except IndexError as _:
-                        paragraphs[cur_para_index]["sentences"].append("")
-                        cur_sent = paragraphs[cur_para_index]["sentences"][cur_sent_index]
-
-                    if len(cur_sent.split()) < 15:
-                        paragraphs[cur_para_index]["sentences"][cur_sent_index] = cur_sent + (" " if cur_sent!="" else "") + word
-                        added = True
-                    else:
-                        if cur_sent_index < 9:
-                            cur_sent_index += 1
-                        else:
-                            cur_sent_index = 0
-                            cur_para_index += 1
-                            paragraphs.append(dict({
-                                "sentences": []
-                            }))
-                
-                # corner case for changing modifying entry in DB to "0|6|9" before next time to trigger change
-                if (cur_para_index==6 and cur_sent_index==8) and len(paragraphs[cur_para_index]["sentences"][cur_sent_index].split()) >= 15:
-                    cur_sent_index += 1
-
-                modifying[MOD_PARA] = cur_para_index
-                modifying[MOD_SENT] = cur_sent_index
+        get_story_cache(current_app.config).invalidate(resp["id"])
+        return resp
+
+    @staticmethod
+    def _add_words_local(words, room=""):
+        """
+        adds a batch of words from this process, see add_words
 
+        :param words: words to be added, in order
+        :type words: list
+        :param room: room of the stories
+        :type room: str
+        :return: one entry per word in the format of add_word, or an empty list
+        :rtype: list
+        """
+
+        storage = DBHandler._storage()
+        if storage is not None:
+            results = storage.add_words(words, room)
+        elif DBHandler._write_behind():
+            try:
+                results = get_write_buffer(current_app.config).add_words(words, room)
+            except sqlite3.Error as err:
+                LOG.debug(err)
+                LOG.error("unable to add batch of %s words to database", len(words))
+                return []
+        else:
             try:
                 with DBHandler.connect() as conn:
+                    try:
+                        cursor = conn.cursor()
+                        cursor.execute("BEGIN IMMEDIATE;")
+                        results = [DBHandler._append_word(cursor, word, room) for word in words]
+                        conn.commit()
+                    except sqlite3.Error:
+                        conn.rollback()
+                        raise
+            except sqlite3.Error as err:
+                LOG.debug(err)
+                LOG.error("unable to add batch of %s words to database", len(words))
+                return []
+
+        cache = get_story_cache(current_app.config)
+        for id in sorted(set(result["id"] for result in results)):
+            cache.invalidate(id)
+        return results
+
+    @staticmethod
+    def _apply_mutations(mutations):
+        """
+        applies mutations queued for the story writer, in order, in a single
+        transaction
+
+        If the transaction fails, every mutation is retried in a transaction
+        of its own so that one failing request does not fail the others.
+
+        :param mutations: (op, args) pairs, op being "add_word" or "add_words"
+            and args the arguments of that method
+        :type mutations: list
+        :return: one result per mutation, in the format of add_word or add_words
+        :rtype: list
+        """
+
+        local = dict({"add_word": DBHandler._add_word_local, "add_words": DBHandler._add_words_local})
+        if len(mutations) == 1:
+            op, args = mutations[0]
+            return [local[op](*args)]
+
+        results = []
+        try:
+            with DBHandler.connect() as conn:
+                try:
                     cursor = conn.cursor()
-                    cursor.execute(sql_cmd, (
-                        str("|".join(map(str, modifying))),
-                        entry["title"],
-                        json.dumps(paragraphs),
-                        entry["id"]
-                    ))
+                    cursor.execute("BEGIN IMMEDIATE;")
+                    for op, args in mutations:
+                        if op == "add_word":
+                            results.append(DBHandler._append_word(cursor, *args))
+                        else:
+                            results.append([DBHandler._append_word(cursor, word, *args[1:]) for word in args[0]])
                     conn.commit()
-                    cursor.execute("SELECT id, title, created_at, updated_at, paragraphs FROM stories WHERE id={};".format(entry["id"]))
-                    resp = [dict(row) for row in cursor.fetchall()]
-                    resp = resp[0]
+                except sqlite3.Error:
+                    conn.rollback()
+                    raise
+        except sqlite3.Error as err:
+            LOG.debug(err)
+            LOG.warning("group of %s writes failed, retrying them one by one", len(mutations))
+            return [local[op](*args) for op, args in mutations]
 
-            except sqlite3.Error as err:
-                LOG.debug(err)
-                LOG.error("unable to retrieve (id=%s) from database", entry["id"])
-                return dict()
+        ids = set()
+        for result in results:
+            ids.update(entry["id"] for entry in (result if isinstance(result, list) else [result]))
+        cache = get_story_cache(current_app.config)
+        for id in sorted(ids):
+            cache.invalidate(id)
+        return results
+
+    @staticmethod
+    def _append_word(cursor, word, room=""):
+        """
+        appends word to the active story of a room, or inserts a new story,
+        using the cursor of an already open transaction
+
+        Only the story row and the row of the sentence under the cursor are
+        read and written, whatever the length of the story.
+
+        :param cursor: cursor inside an open transaction
+        :type cursor: sqlite3.Cursor
+        :param word: word to be added
+        :type word: str
+        :param room: room of the story
+        :type room: str
+        :return: updated story row with the sentence the word went to
+        :rtype: dict
+        """
+
+        cursor.execute("SELECT id, modifying, title FROM stories WHERE modifying != 'no' AND room = ? LIMIT 1;", (room,))
+        entry = cursor.fetchone()
+        if entry is None:
+            return DBHandler._insert_story(cursor, word, room)
+
+        story_id = entry["id"]
+        title = entry["title"]
+        story_cursor = StoryCursor(entry["modifying"])
+
+        if story_cursor.title:
+            title = title + " " + word
+            story_cursor.title_written()
+            # the title is only written right after a story is created
+            current_sentence = ""
+        else:
+            cursor.execute(
+                "SELECT text, word_count FROM sentences WHERE story_id = ? AND para_idx = ? AND sent_idx = ?;",
+                (story_id, story_cursor.para, story_cursor.sent)
+            )
+            sentence = cursor.fetchone()
+            if sentence is not None:
+                story_cursor.sent_words = sentence["word_count"]
+
+            if story_cursor.next_sentence() or sentence is None:
+                current_sentence = word
+                cursor.execute(
+                    "INSERT INTO sentences (story_id, para_idx, sent_idx, text, word_count) VALUES (?, ?, ?, ?, 1);",
+                    (story_id, story_cursor.para, story_cursor.sent, word)
+                )
+            else:
+                current_sentence = sentence["text"] + (" " if sentence["text"] != "" else "") + word
+                cursor.execute(
+                    "UPDATE sentences SET text = ?, word_count = word_count + 1 WHERE story_id = ? AND para_idx = ? AND sent_idx = ?;",
+                    (current_sentence, story_id, story_cursor.para, story_cursor.sent)
+                )
+            story_cursor.word_written()
+
+        params = (str(story_cursor), title, story_id)
+        sql_cmd = '''
+        UPDATE stories
+        SET updated_at = (datetime('now')),
+            modifying = ?,
+            title = ?,
+            words = words + 1
+        WHERE id = ?
+        '''
+
+        if RETURNING_SUPPORTED:
+            cursor.execute(sql_cmd + "RETURNING id, title, created_at, updated_at, words;", params)
+        else:
+            # older SQLite builds: read back on the same connection and transaction
+            cursor.execute(sql_cmd, params)
+            cursor.execute("SELECT id, title, created_at, updated_at, words FROM stories WHERE id = ?;", (story_id,))
+        resp = dict(cursor.fetchone())
+        resp["current_sentence"] = current_sentence
+        return resp
+
+    @staticmethod
+    def _insert_story(cursor, word, room=""):
+        """
+        inserts a new story using the cursor of an already open transaction
 
-        if len(resp.keys()):
-            resp["paragraphs"] = json.loads(resp["paragraphs"])
+        :param cursor: cursor inside an open transaction
+        :type cursor: sqlite3.Cursor
+        :param word: first word of the title
+        :type word: str
+        :param room: room of the story
+        :type room: str
+        :return: inserted story row
+        :rtype: dict
+        """
+
+        cursor.execute("INSERT INTO stories (title, room) VALUES (?, ?);", (word, room))
+        # updated_at is filled by an AFTER INSERT trigger, which RETURNING would miss
+        cursor.execute("SELECT id, title, created_at, updated_at, words FROM stories WHERE id = ?;", (cursor.lastrowid,))
+        resp = dict(cursor.fetchone())
+        resp["current_sentence"] = ""
         return resp
             
     @staticmethod
-    def create_new_story(word):
+    def create_new_story(word, room=""):
         """
         adds a new story entry in the table
         
         :param word: word to be added
         :type word: str
+        :param room: room of the story
+        :type room: str
         :return: added story as dictionary of the following format (with example values)
             {
                 "id": 1,
                 "title": "something",
                 "created_at": "timestamp",
                 "updated_at": "timestamp",
-                "paragraphs": "lorem potem ipsum"
+                "current_sentence": ""
             }
         :rtype: dict
         """
 
-        sql_cmd = '''
-        INSERT INTO stories (title)
-        VALUES (?)
-        '''
-        try:
-            with DBHandler.connect()  as conn:
-                cursor = conn.cursor()
-                cursor.execute(sql_cmd, (word,))
-                conn.commit()
+        storage = DBHandler._storage()
+        if storage is not None:
+            return storage.create_new_story(word, room)
 
-                cursor.execute("SELECT id, title, created_at, updated_at, paragraphs FROM stories WHERE modifying!='no';")
-                resp = [dict(row) for row in cursor.fetchall()]
-                resp = resp[0]
+        try:
+            with DBHandler.connect() as conn:
+                try:
+                    cursor = conn.cursor()
+                    cursor.execute("BEGIN IMMEDIATE;")
+                    resp = DBHandler._insert_story(cursor, word, room)
+                    conn.commit()
+                except sqlite3.Error:
+                    conn.rollback()
+                    raise
         except sqlite3.Error as err:
             LOG.debug(err)
             LOG.error("failed to add data")
@@ -208,7 +519,44 @@ class DBHandler:
         return resp
 
     @staticmethod
-    def get_stories(limit, offset, sort, order):
+    def _stories_query(sort, order, after=None):
+        """
+        builds the listing query for a sort column and order
+
+        Rows are ordered by the sort column with the id as tiebreaker, which
+        matches the (column, id) indexes in init.sql. Given the sort value
+        and id of the last row of the previous page, the query seeks
+        directly to the next page instead of skipping rows.
+
+        :param sort: column in ["created_at", "updated_at", "title"]
+        :type sort: str
+        :param order: order for sort from ["asc", "desc"]
+        :type order: str
+        :param after: (sort value, id) of the last row already returned
+        :type after: tuple
+        :return: query with placeholders for the keyset (if any), limit and offset
+        :rtype: str
+        """
+
+        sort_by = SORT_COLUMNS[sort.lower()]
+        order = ORDERS[order.lower()]
+        where = ""
+        if after is not None:
+            where = "WHERE ({sort_by}, id) {op} (?, ?)".format(
+                sort_by=sort_by,
+                op=">" if order == "ASC" else "<"
+            )
+
+        return '''
+        SELECT id, title, created_at, updated_at
+        FROM stories
+        {where}
+        ORDER BY {sort_by} {order}, id {order}
+        LIMIT ? OFFSET ?
+        '''.format(where=where, sort_by=sort_by, order=order)
+
+    @staticmethod
+    def get_stories(limit, offset, sort, order, after=None):
         """
         fetch list of stories from the database and return
         
@@ -220,6 +568,8 @@ class DBHandler:
         :type sort: str 
         :param order: order for sort from ["asc", "desc"]
         :type order: str
+        :param after: (sort value, id) of the last story of the previous page
+        :type after: tuple
         :return: stories in a list as following format
                 [
                     {
@@ -232,22 +582,17 @@ class DBHandler:
         :rtype: list
         """
 
-        sql_cmd = '''
-        SELECT id, title, created_at, updated_at
-        FROM stories
-        ORDER BY {sort_by} {order}
-        LIMIT {limit} OFFSET {offset}
-        '''.format(
-            sort_by = sort.lower(),
-            order = order.upper(),
-            limit = int(limit),
-            offset = int(offset)
-        )
+        storage = DBHandler._storage()
+        if storage is not None:
+            return storage.get_stories(limit, offset, sort, order, after)
+
+        sql_cmd = DBHandler._stories_query(sort, order, after)
+        params = (tuple(after) if after is not None else ()) + (int(limit), int(offset))
 
         try:
             with DBHandler.connect() as conn:
                 cursor = conn.cursor()
-                cursor.execute(sql_cmd)
+                cursor.execute(sql_cmd, params)
                 results = [dict(row) for row in cursor.fetchall()]
         except sqlite3.Error as err:
             LOG.debug(err)
@@ -280,25 +625,777 @@ class DBHandler:
         :rtype: dict
         """
 
+        return DBHandler._load_story(id)[0]
+
+    @staticmethod
+    def get_story_version(id):
+        """
+        get the version of a story without loading its sentences
+
+        Stories only ever grow, so the word count together with updated_at
+        identifies the content of a story even within the one second
+        resolution of updated_at.
+
+        :param id: id of the story
+        :type id: int
+        :raises IDNotFound: id not present in the database
+        :return: version in the following format:
+                {
+                    "updated_at": "2018-12-01T00:01:00Z",
+                    "words": 42
+                }
+        :rtype: dict
+        """
+
+        cached = get_story_cache(current_app.config).get(id)
+        if cached is not None:
+            return cached[1]
+
+        storage = DBHandler._storage()
+        if storage is not None:
+            return storage.get_story_version(id)
+
+        if DBHandler._write_behind():
+            buffered = get_write_buffer(current_app.config).get_version(id)
+            if buffered is not None:
+                return buffered
+
+        try:
+            with DBHandler.connect() as conn:
+                cursor = conn.cursor()
+                cursor.execute("SELECT updated_at, words FROM stories WHERE id = ?;", (id,))
+                row = cursor.fetchone()
+        except sqlite3.Error as err:
+            LOG.debug(err)
+            LOG.error("failed to fetch version of story (id=%s) from database", id)
+            row = None
+
+        if row is None:
+            raise IDNotFound(id)
+        return dict(row)
+
+    @staticmethod
+    def _load_story(id):
+        """
+        loads a story from the write buffer or the database
+
+        :param id: id of the story to fetch
+        :type id: int
+        :raises IDNotFound: id not present in the database
+        :return: story in the format of get_story, its version as returned
+            by get_story_version and whether it is completed
+        :rtype: tuple
+        """
+
+        storage = DBHandler._storage()
+        if storage is not None:
+            return storage.load_story(id)
+
+        if DBHandler._write_behind():
+            buffered = get_write_buffer(current_app.config).get_story(id)
+            if buffered is not None:
+                return buffered + (False,)
+
         sql_cmd = '''
-        SELECT id, title, created_at, updated_at, paragraphs
-        FROM stories
-        WHERE id = ?
+        SELECT stories.id, title, created_at, updated_at, modifying, words, para_idx, sent_idx, text,
+            story_archive.body AS archive
+        FROM stories LEFT JOIN sentences ON sentences.story_id = stories.id
+        LEFT JOIN story_archive ON story_archive.story_id = stories.id
+        WHERE stories.id = ?
+        ORDER BY para_idx, sent_idx
         '''
         try:
             with DBHandler.connect() as conn:
                 cursor = conn.cursor()
                 cursor.execute(sql_cmd, (id,))
-                results = [dict(row) for row in cursor.fetchall()]
-                results = results[0]
-                results["paragraphs"] = json.loads(results["paragraphs"])
+                rows = cursor.fetchall()
         except sqlite3.Error as err:
             LOG.debug(err)
             LOG.error("failed to fetch story (id=%s) from database", id)
-            results = dict({})
+            rows = []
         
-        if len(results) == 0:
+        if len(rows) == 0:
             raise IDNotFound(id)
-               
+
+        results = dict({
+            "id": rows[0]["id"],
+            "title": rows[0]["title"],
+            "created_at": rows[0]["created_at"],
+            "updated_at": rows[0]["updated_at"],
+            "paragraphs": build_paragraphs((para_idx, text) for para_idx, _, text in DBHandler._sentences(rows))
+        })
+        version = dict({"updated_at": rows[0]["updated_at"], "words": rows[0]["words"]})
+        return results, version, rows[0]["modifying"] == "no"
+
+    @staticmethod
+    def _sentences(rows, para=0, sent=0):
+        """
+        :param rows: rows of one story joined with its sentences and its
+            archived body, selected from the given position onwards
+        :type rows: list
+        :param para: paragraph index of the first sentence selected
+        :type para: int
+        :param sent: sentence index of the first sentence selected
+        :type sent: int
+        :return: (para_idx, sent_idx, text) of the sentences, read from
+            whichever tier holds the story
+        :rtype: list
+        """
+
+        if len(rows) != 0 and rows[0]["archive"] is not None:
+            return unpack(rows[0]["archive"], para, sent)
+        return [(row["para_idx"], row["sent_idx"], row["text"]) for row in rows if row["para_idx"] is not None]
+
+    @staticmethod
+    def get_story_json(id):
+        """
+        get story with the given id as a serialized response body, served
+        from the story cache when possible
+
+        :param id: id of the story to fetch
+        :type id: int
+        :raises IDNotFound: id not present in the database
+        :return: story in the format of get_story as UTF-8 JSON, and its
+            version as returned by get_story_version
+        :rtype: tuple
+        """
+
+        cache = get_story_cache(current_app.config)
+        cached = cache.get(id)
+        if cached is not None:
+            return cached
+
+        generation = cache.generation.value()
+        storage = DBHandler._storage()
+        if storage is not None:
+            # words may be added from other hosts, so only completed
+            # stories are cached
+            with get_registry().time("collab_json_duration_seconds", JSON_ENCODE):
+                body, version, completed = storage.get_story_json(id)
+            cached = (body, version)
+            if completed:
+                cache.put(id, cached)
+            return cached
+
+        if DBHandler._write_behind():
+            buffered = get_write_buffer(current_app.config).get_story(id)
+            if buffered is not None:
+                story, version = buffered
+                with get_registry().time("collab_json_duration_seconds", JSON_ENCODE):
+                    cached = (serialize.dumps(story), version)
+                cache.put(id, cached, generation)
+                return cached
+
+        closed = cache.closed_paragraphs(id)
+        # the closed paragraphs are cached already, only the ones after
+        # them are read and encoded
+        sql_cmd = '''
+        SELECT stories.id, title, created_at, updated_at, modifying, words, para_idx, sent_idx, text,
+            story_archive.body AS archive
+        FROM stories LEFT JOIN sentences
+            ON sentences.story_id = stories.id AND para_idx >= ?
+        LEFT JOIN story_archive ON story_archive.story_id = stories.id
+        WHERE stories.id = ?
+        ORDER BY para_idx, sent_idx
+        '''
+        try:
+            with DBHandler.connect() as conn:
+                cursor = conn.cursor()
+                cursor.execute(sql_cmd, (len(closed), id))
+                rows = cursor.fetchall()
+        except sqlite3.Error as err:
+            LOG.debug(err)
+            LOG.error("failed to fetch story (id=%s) from database", id)
+            rows = []
+
+        if len(rows) == 0:
+            raise IDNotFound(id)
+
+        first = rows[0]
+        header = dict({
+            "id": first["id"],
+            "title": first["title"],
+            "created_at": first["created_at"],
+            "updated_at": first["updated_at"]
+        })
+        with get_registry().time("collab_json_duration_seconds", JSON_ENCODE):
+            paragraphs = closed + [
+                serialize.paragraph_json([sentence[2] for sentence in group])
+                for para_idx, group in groupby(DBHandler._sentences(rows, len(closed)), key=itemgetter(0))
+            ]
+            body = serialize.story_json(header, paragraphs)
+        version = dict({"updated_at": first["updated_at"], "words": first["words"]})
+        completed = first["modifying"] == "no"
+
+        cached = (body, version)
+        cache.put(id, cached, None if completed else generation)
+        if completed:
+            cache.drop_closed_paragraphs(id)
+        else:
+            cache.put_closed_paragraphs(id, paragraphs[:-1])
+        return cached
+
+    @staticmethod
+    def get_story_encoded(id, encoding=None):
+        """
+        get the serialized story along with its version, as get_story_json
+        does, compressed with the given content coding
+
+        Bodies under COMPRESS_MIN_SIZE are sent as they are. The bodies of
+        completed stories are compressed once per encoding, at
+        COMPRESS_STATIC_LEVELS, and kept by the story cache; those of the
+        active story are compressed on every read, at COMPRESS_LEVELS.
+
+        :param id: id of the story
+        :type id: int
+        :param encoding: one of compress.ENCODINGS, None for no compression
+        :type encoding: str
+        :raises IDNotFound: id not present in the database
+        :return: body, version and the content coding of the body, None if
+            it is not compressed
+        :rtype: tuple
+        """
+
+        story = DBHandler.get_story_json(id)
+        body, version = story
+        if encoding is None or len(body) < current_app.config['COMPRESS_MIN_SIZE']:
+            return body, version, None
+
+        cache = get_story_cache(current_app.config)
+        encoded, kept = cache.encoded(id, story, encoding)
+        if encoded is None:
+            levels = current_app.config['COMPRESS_STATIC_LEVELS' if kept else 'COMPRESS_LEVELS']
+            with get_registry().time("collab_compress_duration_seconds", (("encoding", encoding),)):
+                encoded = compress(body, encoding, levels[encoding])
+            if kept:
+                cache.put_encoded(id, story, encoding, encoded)
+        return encoded, version, encoding
+
+    @staticmethod
+    def get_story_tail(id, para=0, sent=0):
+        """
+        get the sentences of a story from the given position onwards, along
+        with what is needed to number their words
+
+        :param id: id of the story
+        :type id: int
+        :param para: paragraph index of the first sentence to read
+        :type para: int
+        :param sent: sentence index of the first sentence to read
+        :type sent: int
+        :raises IDNotFound: id not present in the database
+        :return: story in the following format:
+                {
+                    "title": "verloop hiring",
+                    "words": 5,
+                    "completed": False,
+                    "sentences": [(0, 0, "lorem ipsum dolor")]
+                }
+        :rtype: dict
+        """
+
+        storage = DBHandler._storage()
+        if storage is not None:
+            return storage.get_story_tail(id, para, sent)
+
+        if DBHandler._write_behind():
+            buffered = get_write_buffer(current_app.config).get_story(id)
+            if buffered is not None:
+                story, version = buffered
+                return dict({
+                    "title": story["title"],
+                    "words": version["words"],
+                    "completed": False,
+                    "sentences": [
+                        (para_idx, sent_idx, text)
+                        for para_idx, paragraph in enumerate(story["paragraphs"])
+                        for sent_idx, text in enumerate(paragraph["sentences"])
+                        if (para_idx, sent_idx) >= (para, sent)
+                    ]
+                })
+
+        # a single statement, so the word count and sentences are read from
+        # the same snapshot
+        sql_cmd = '''
+        SELECT title, modifying, words, para_idx, sent_idx, text, story_archive.body AS archive
+        FROM stories LEFT JOIN sentences
+            ON sentences.story_id = stories.id AND (para_idx, sent_idx) >= (?, ?)
+        LEFT JOIN story_archive ON story_archive.story_id = stories.id
+        WHERE stories.id = ?
+        ORDER BY para_idx, sent_idx
+        '''
+        try:
+            with DBHandler.connect() as conn:
+                cursor = conn.cursor()
+                cursor.execute(sql_cmd, (para, sent, id))
+                rows = cursor.fetchall()
+        except sqlite3.Error as err:
+            LOG.debug(err)
+            LOG.error("failed to fetch sentences of story (id=%s) from database", id)
+            rows = []
+
+        if len(rows) == 0:
+            raise IDNotFound(id)
+
+        return dict({
+            "title": rows[0]["title"],
+            "words": rows[0]["words"],
+            "completed": rows[0]["modifying"] == "no",
+            "sentences": DBHandler._sentences(rows, para, sent)
+        })
+
+    @staticmethod
+    def get_story_part(id, start=(0, 0), end=None, tail=None):
+        """
+        get a range of the sentences of a story, reading only those rows
+
+        :param id: id of the story
+        :type id: int
+        :param start: (para_idx, sent_idx) of the first sentence of the range
+        :type start: tuple
+        :param end: (para_idx, sent_idx) of the last sentence of the range,
+            None for the end of the story
+        :type end: tuple
+        :param tail: number of sentences kept from the end of the range,
+            None for all of them
+        :type tail: int
+        :raises IDNotFound: id not present in the database
+        :return: story in the following format, offset being the position
+            of the first sentence returned (None if the range is empty), and
+            its version as returned by get_story_version:
+                {
+                    "id": 1,
+                    "title": "verloop hiring",
+                    "created_at": "2018-12-01T00:00:00Z",
+                    "updated_at": "2018-12-01T00:01:00Z",
+                    "offset": {"paragraph": 2, "sentence": 0},
+                    "paragraphs":[
+                        {
+                            "sentences":[
+                                "hi!"
+                            ]
+                        }
+                    ]
+                }
+        :rtype: tuple
+        """
+
+        storage = DBHandler._storage()
+        if storage is not None:
+            return storage.get_story_part(id, start, end, tail)
+
+        if DBHandler._write_behind():
+            buffered = get_write_buffer(current_app.config).get_story(id)
+            if buffered is not None:
+                story, version = buffered
+                offset, paragraphs = story_part([
+                    (para_idx, sent_idx, text)
+                    for para_idx, paragraph in enumerate(story["paragraphs"])
+                    for sent_idx, text in enumerate(paragraph["sentences"])
+                ], start, end, tail)
+                part = dict({key: story[key] for key in ("id", "title", "created_at", "updated_at")})
+                part.update({"offset": offset, "paragraphs": paragraphs})
+                return part, version
+
+        # the range is looked up on the primary key of sentences and a tail
+        # is read backwards from its end; archived stories are unpacked
+        sql_cmd = '''
+        SELECT stories.id, title, created_at, updated_at, words, para_idx, sent_idx, text,
+            story_archive.body AS archive
+        FROM stories LEFT JOIN sentences
+            ON sentences.story_id = stories.id AND (para_idx, sent_idx) >= (?, ?) AND (para_idx, sent_idx) <= (?, ?)
+        LEFT JOIN story_archive ON story_archive.story_id = stories.id
+        WHERE stories.id = ?
+        ORDER BY para_idx {0}, sent_idx {0}
+        LIMIT ?
+        '''.format("ASC" if tail is None else "DESC")
+        last = end if end is not None else (PARAGRAPH_END, PARAGRAPH_END)
+        try:
+            with DBHandler.connect() as conn:
+                cursor = conn.cursor()
+                cursor.execute(sql_cmd, tuple(start) + tuple(last) + (id, -1 if tail is None else tail))
+                rows = cursor.fetchall()
+        except sqlite3.Error as err:
+            LOG.debug(err)
+            LOG.error("failed to fetch sentences of story (id=%s) from database", id)
+            rows = []
+
+        if len(rows) == 0:
+            raise IDNotFound(id)
+
+        if tail is not None:
+            rows.reverse()
+        first = rows[0]
+        offset, paragraphs = story_part(DBHandler._sentences(rows), start, end, tail)
+        part = dict({
+            "id": first["id"],
+            "title": first["title"],
+            "created_at": first["created_at"],
+            "updated_at": first["updated_at"],
+            "offset": offset,
+            "paragraphs": paragraphs
+        })
+        return part, dict({"updated_at": first["updated_at"], "words": first["words"]})
+
+    @staticmethod
+    def get_stats(days=30):
+        """
+        get the totals of the stories and their statistics per day, read
+        from the counters the triggers of init.sql keep up to date, never
+        from the stories themselves
+
+        Words held by the write-behind buffer are counted once flushed.
+
+        :param days: number of most recent UTC days reported, today included
+        :type days: int
+        :return: statistics in the following format, most recent day first
+            and only days something was written on, or an empty dict if they
+            could not be read:
+                {
+                    "stories": 12,
+                    "completed": 11,
+                    "active": 1,
+                    "words": 1234,
+                    "days": [
+                        {
+                            "day": "2018-12-01",
+                            "started": 2,
+                            "completed": 1,
+                            "words": 180
+                        }
+                    ]
+                }
+        :rtype: dict
+        """
+
+        storage = DBHandler._storage()
+        if storage is not None:
+            return storage.get_stats(days)
+
+        try:
+            with DBHandler.connect() as conn:
+                cursor = conn.cursor()
+                cursor.execute("SELECT stories, completed, words FROM story_totals WHERE id = 0;")
+                totals = cursor.fetchone()
+                cursor.execute(
+                    "SELECT day, started, completed, words FROM story_daily WHERE day > date('now', ?) ORDER BY day DESC;",
+                    ("-{} days".format(int(days)),)
+                )
+                daily = [dict(row) for row in cursor.fetchall()]
+        except sqlite3.Error as err:
+            LOG.debug(err)
+            LOG.error("failed to fetch statistics from database")
+            return dict()
+
+        return dict({
+            "stories": totals["stories"],
+            "completed": totals["completed"],
+            "active": totals["stories"] - totals["completed"],
+            "words": totals["words"],
+            "days": daily
+        })
+
+    @staticmethod
+    def search_enabled():
+        """
+        :return: whether stories are indexed for search
+        :rtype: bool
+        """
+
+        storage = DBHandler._storage()
+        if storage is not None:
+            return storage.supports_search
+        return FTS5_SUPPORTED and current_app.config['SEARCH_INDEX'] != "off"
+
+    @staticmethod
+    def search_stories(query, limit, offset=0, after=None):
+        """
+        finds the stories containing every word of a query, best matches
+        first, with the title weighing SEARCH_TITLE_WEIGHT times the body
+
+        :param query: words to search for
+        :type query: str
+        :param limit: number of stories
+        :type limit: int
+        :param offset: number of top results to be skipped
+        :type offset: int
+        :param after: (rank, id) of the last story of the previous page
+        :type after: tuple
+        :return: stories in a list as following format, lower ranks first
+                [
+                    {
+                        "id": 1,
+                        "title": "verloop hiring",
+                        "created_at": "2018-12-01 00:00:00",
+                        "updated_at": "2018-12-01 00:01:00",
+                        "rank": -1.25,
+                        "snippet": "we are <mark>hiring</mark> engineers..."
+                    }
+                ]
+        :rtype: list
+        """
+
+        start, end = current_app.config['SEARCH_HIGHLIGHT']
+        weight = float(current_app.config['SEARCH_TITLE_WEIGHT'])
+        # the page is picked before the snippets are made, so only the
+        # stories returned get one
+        sql_cmd = '''
+        WITH page AS (
+            SELECT rowid AS id, bm25(story_search, :weight, 1.0) AS rank
+            FROM story_search
+            WHERE story_search MATCH :query AND (bm25(story_search, :weight, 1.0), rowid) > (:rank, :id)
+            ORDER BY rank, id
+            LIMIT :limit OFFSET :offset
+        )
+        SELECT stories.id, stories.title, created_at, updated_at, page.rank,
+            snippet(story_search, 1, :start, :end, '...', :tokens) AS snippet
+        FROM page
+            JOIN story_search ON story_search.rowid = page.id
+            JOIN stories ON stories.id = page.id
+        WHERE story_search MATCH :query
+        ORDER BY page.rank, page.id
+        '''
+        params = dict({
+            "query": match_expression(query),
+            "weight": weight,
+            "rank": after[0] if after is not None else float("-inf"),
+            "id": after[1] if after is not None else 0,
+            "limit": int(limit),
+            "offset": int(offset),
+            "start": start,
+            "end": end,
+            "tokens": int(current_app.config['SEARCH_SNIPPET_TOKENS'])
+        })
+
+        try:
+            with DBHandler.connect() as conn:
+                cursor = conn.cursor()
+                cursor.execute(sql_cmd, params)
+                results = [dict(row) for row in cursor.fetchall()]
+        except sqlite3.Error as err:
+            LOG.debug(err)
+            LOG.error("failed to search stories for %s", query)
+            results = []
         return results
-            
\ No newline at end of file
+
+    @staticmethod
+    def export_stories(filters=None, batch=1000):
+        """
+        yields every story matching the filters, in id order, reading the
+        rows in batches of a single statement so that memory use does not
+        grow with the number of stories
+
+        :param filters: values of EXPORT_FILTERS, e.g. {"id_from": 10}
+        :type filters: dict
+        :param batch: number of sentence rows fetched at a time
+        :type batch: int
+        :return: stories in the following format:
+                {
+                    "id": 1,
+                    "title": "verloop hiring",
+                    "created_at": "2018-12-01 00:00:00",
+                    "updated_at": "2018-12-01 00:01:00",
+                    "modifying": "no",
+                    "words": 1037,
+                    "room": "",
+                    "paragraphs": [{"sentences": ["hi!"]}]
+                }
+        :rtype: generator
+        """
+
+        storage = DBHandler._storage()
+        if storage is not None:
+            yield from storage.export_stories(filters, batch)
+            return
+
+        filters = dict({key: value for key, value in (filters or dict()).items() if value is not None})
+        where = " AND ".join(EXPORT_FILTERS[key] for key in filters) or "1"
+        # NOT INDEXED keeps the planner on the id order of the table, so no
+        # temporary b-tree of all matching stories is built to sort them
+        sql_cmd = '''
+        SELECT stories.id, title, created_at, updated_at, modifying, words, room, para_idx, sent_idx, text,
+            story_archive.body AS archive
+        FROM stories NOT INDEXED LEFT JOIN sentences ON sentences.story_id = stories.id
+        LEFT JOIN story_archive ON story_archive.story_id = stories.id
+        WHERE {}
+        ORDER BY stories.id, para_idx, sent_idx
+        '''.format(where)
+
+        story = None
+        try:
+            with DBHandler.connect() as conn:
+                cursor = conn.cursor()
+                cursor.execute(sql_cmd, tuple(filters.values()))
+                while True:
+                    rows = cursor.fetchmany(batch)
+                    if len(rows) == 0:
+                        break
+                    for row in rows:
+                        if story is None or story["id"] != row["id"]:
+                            if story is not None:
+                                yield story
+                            story = dict({
+                                "id": row["id"],
+                                "title": row["title"],
+                                "created_at": row["created_at"],
+                                "updated_at": row["updated_at"],
+                                "modifying": row["modifying"],
+                                "words": row["words"],
+                                "room": row["room"],
+                                "paragraphs": []
+                            })
+                            last_para = None
+                        for para_idx, _, text in DBHandler._sentences([row]):
+                            if para_idx != last_para:
+                                story["paragraphs"].append(dict({"sentences": []}))
+                                last_para = para_idx
+                            story["paragraphs"][-1]["sentences"].append(text)
+                cursor.close()
+        except sqlite3.Error as err:
+            LOG.debug(err)
+            LOG.error("failed to export stories from database")
+            return
+        if story is not None:
+            yield story
+
+    @staticmethod
+    def import_stories(stories, batch=10000):
+        """
+        inserts stories in the format of export_stories, keeping their ids
+
+        Stories whose id is taken already are skipped. A room has at most
+        one active story: an active story whose room has one already, in
+        the database or earlier in the import, is imported as completed.
+        The listing indexes are dropped for the import and built again
+        once at its end, and every batch of stories is written in one
+        transaction.
+
+        :param stories: stories to insert
+        :type stories: iterable
+        :param batch: number of stories per transaction
+        :type batch: int
+        :return: number of imported and skipped stories, and of imported
+            stories marked completed, empty if the import failed; stories of
+            the batches before the failure stay
+        :rtype: dict
+        """
+
+        storage = DBHandler._storage()
+        if storage is not None:
+            counts = storage.import_stories(stories, batch)
+            get_story_cache(current_app.config).invalidate()
+            return counts
+
+        counts = dict({"imported": 0, "skipped": 0, "closed": 0})
+        try:
+            with DBHandler.connect() as conn:
+                cursor = conn.cursor()
+                cursor.execute(
+                    "SELECT name, sql FROM sqlite_master WHERE type = 'index' AND tbl_name = 'stories' AND sql IS NOT NULL;"
+                )
+                indexes = cursor.fetchall()
+                for name, _ in indexes:
+                    cursor.execute('DROP INDEX IF EXISTS "{}";'.format(name.replace('"', '""')))
+                conn.commit()
+                try:
+                    pending = []
+                    for story in stories:
+                        pending.append(story)
+                        if len(pending) >= batch:
+                            DBHandler._import_batch(conn, pending, counts)
+                            pending = []
+                    if len(pending) != 0:
+                        DBHandler._import_batch(conn, pending, counts)
+                finally:
+                    conn.rollback()
+                    LOG.info("building %s indexes of the stories table", len(indexes))
+                    for _, sql in indexes:
+                        cursor.execute(sql)
+                    conn.commit()
+        except sqlite3.Error as err:
+            LOG.debug(err)
+            LOG.error("failed to import stories after %s of them", counts["imported"])
+            counts = dict({})
+
+        get_story_cache(current_app.config).invalidate()
+        return counts
+
+    @staticmethod
+    def _import_batch(conn, stories, counts):
+        """
+        inserts a batch of stories in one transaction
+
+        :param conn: connection to the database
+        :type conn: sqlite3.Connection
+        :param stories: stories in the format of export_stories
+        :type stories: list
+        :param counts: number of imported and skipped stories, updated
+        :type counts: dict
+        """
+
+        cursor = conn.cursor()
+        cursor.execute("BEGIN IMMEDIATE;")
+        try:
+            ids = [story["id"] for story in stories]
+            taken = set()
+            for start in range(0, len(ids), 500):
+                chunk = ids[start:start + 500]
+                cursor.execute(
+                    "SELECT id FROM stories WHERE id IN ({});".format(",".join("?" * len(chunk))), chunk
+                )
+                taken.update(row[0] for row in cursor.fetchall())
+            fresh = [story for story in stories if story["id"] not in taken]
+            rooms = list(set(story.get("room", "") for story in fresh if story["modifying"] != "no"))
+            active = set()
+            if len(rooms) != 0:
+                cursor.execute(
+                    "SELECT room FROM stories WHERE modifying <> 'no' AND room IN ({});".format(",".join("?" * len(rooms))),
+                    rooms
+                )
+                active.update(row[0] for row in cursor.fetchall())
+            fresh, closed = close_clashing_stories(fresh, active)
+
+            cursor.executemany(
+                "INSERT INTO stories (id, created_at, updated_at, modifying, title, words, room) VALUES (?, ?, ?, ?, ?, ?, ?);",
+                [
+                    (
+                        story["id"], story["created_at"], story["updated_at"], story["modifying"], story["title"],
+                        story["words"], story.get("room", "")
+                    )
+                    for story in fresh
+                ]
+            )
+            # replaces the empty first sentence added by the first_sentence trigger
+            cursor.executemany(
+                "INSERT OR REPLACE INTO sentences (story_id, para_idx, sent_idx, text, word_count) VALUES (?, ?, ?, ?, ?);",
+                [
+                    (story["id"], para_idx, sent_idx, text, len(text.split()))
+                    for story in fresh
+                    for para_idx, paragraph in enumerate(story["paragraphs"])
+                    for sent_idx, text in enumerate(paragraph["sentences"])
+                ]
+            )
+            # the search triggers fire on updates only, or before the sentences exist
+            rebuild_search(conn, current_app.config['SEARCH_INDEX'], [story["id"] for story in fresh])
+            conn.commit()
+        except sqlite3.Error:
+            conn.rollback()
+            raise
+        counts["imported"] += len(fresh)
+        counts["skipped"] += len(stories) - len(fresh)
+        counts["closed"] += closed
+        if closed:
+            LOG.warning("imported %s active stories as completed, their room has an active story", closed)
+        LOG.debug("imported %s stories, skipped %s", counts["imported"], counts["skipped"])
+
+    @staticmethod
+    def cache_stats():
+        """
+        reports hit, miss, eviction and invalidation counters of this
+        process' story cache
+
+        :return: cache counters
+        :rtype: dict
+        """
+
+        return get_story_cache(current_app.config).stats()
@@ -0,0 +1,490 @@
+"""
+contains the live event stream of stories
+
+Events are numbered by the word count of the story once they happened, so
+``n`` doubles as the SSE event id and the ``since`` of long-polls. For
+every word one of the following is produced, in order:
+
+    {"type": "title", "n": 2, "word": "hiring", "title": "verloop hiring"}
+    {"type": "paragraph", "n": 3, "para": 0}
+    {"type": "word", "n": 3, "para": 0, "sent": 0, "word": "lorem"}
+    {"type": "sentence", "n": 17, "para": 0, "sent": 0, "text": "lorem ..."}
+    {"type": "completed", "n": 1037}
+
+paragraph is only sent for the first word of a paragraph, sentence once a
+sentence holds its last word, and completed after the last word of the
+story.
+
+Each process runs one hub. Its poller thread watches the write generation
+of the story cache, which every worker bumps when it adds a word. When the
+generation moves, the poller reads only the newest sentences of each
+followed story, once for all of its subscribers. The new events go into a
+short in-memory backlog per story and every subscriber waiting on it is
+woken.
+
+Subscribers either wait in their own thread (EventHub.wait, under WSGI
+servers) or on an asyncio event loop (EventHub.wait_async). The ASGI entry
+point takes the EventStream of a request from its environment and sends
+it from the loop, so an idle stream or long-poll holds no thread.
+"""
+
+import os
+import time
+import asyncio
+import logging
+import threading
+
+from collections import deque
+
+from .story import SENTENCE_WORDS
+
+
+LOG = logging.getLogger(__name__)
+
+_HUBS = dict()
+_HUBS_LOCK = threading.Lock()
+
+# WSGI environment keys: set by servers that send EventStreams from an
+# asyncio loop, and holding the EventStream of the request
+ASYNC_ENVIRON = "collab.events.async"
+STREAM_ENVIRON = "collab.events.stream"
+
+
+def story_events(title, sentences, words, completed, since):
+    """
+    builds the events of the words a story received after the since-th one
+
+    :param title: title of the story
+    :type title: str
+    :param sentences: (para_idx, sent_idx, text) of the last sentences of
+        the story, in order, covering at least every word after since
+    :type sentences: list
+    :param words: word count of the story
+    :type words: int
+    :param completed: whether the story is completed
+    :type completed: bool
+    :param since: word count already seen by the client
+    :type since: int
+    :return: events in the format described above
+    :rtype: list
+    """
+
+    events = []
+    tail = [
+        (para, sent, index, word)
+        for para, sent, text in sentences
+        for index, word in enumerate(text.split())
+    ]
+    # word count of the story before the first word of the sentences given
+    first = words - len(tail)
+
+    title_words = title.split()
+    for n in range(since + 1, min(first, len(title_words)) + 1):
+        events.append(dict({
+            "type": "title",
+            "n": n,
+            "word": title_words[n - 1],
+            "title": " ".join(title_words[:n])
+        }))
+
+    for offset, (para, sent, index, word) in enumerate(tail):
+        n = first + offset + 1
+        if n <= since:
+            continue
+        if index == 0 and sent == 0:
+            events.append(dict({"type": "paragraph", "n": n, "para": para}))
+        events.append(dict({"type": "word", "n": n, "para": para, "sent": sent, "word": word}))
+        if index == SENTENCE_WORDS - 1:
+            text = " ".join(entry[3] for entry in tail[offset - index:offset + 1])
+            events.append(dict({"type": "sentence", "n": n, "para": para, "sent": sent, "text": text}))
+
+    if completed and words > since:
+        events.append(dict({"type": "completed", "n": words}))
+    return events
+
+
+class _Channel:
+    """
+    followed story with its recent events and waiting subscribers
+    """
+
+    def __init__(self, tail, backlog):
+        """
+        :param tail: story as returned by DBHandler.get_story_tail
+        :type tail: dict
+        :param backlog: number of recent events kept for subscribers
+        :type backlog: int
+        """
+
+        self.words = tail["words"]
+        self.completed = tail["completed"]
+        self.start = self._start(tail)
+        self.events = deque(maxlen=backlog)
+        self.subscribers = 0
+        self.condition = threading.Condition()
+        # (loop, asyncio.Event) of the subscribers waiting on event loops
+        self.waiters = set()
+
+    @staticmethod
+    def _start(tail):
+        """
+        :return: (para_idx, sent_idx) of the last sentence, from which the
+            next read starts
+        :rtype: tuple
+        """
+
+        if len(tail["sentences"]) == 0:
+            return (0, 0)
+        return tuple(tail["sentences"][-1][:2])
+
+    def extend(self, tail):
+        """
+        records the events of the words read since the last update and wakes
+        every subscriber
+
+        :param tail: story as returned by DBHandler.get_story_tail
+        :type tail: dict
+        """
+
+        events = story_events(tail["title"], tail["sentences"], tail["words"], tail["completed"], self.words)
+        with self.condition:
+            self.events.extend(events)
+            self.words = tail["words"]
+            self.completed = tail["completed"]
+            self.start = self._start(tail)
+            self.condition.notify_all()
+            for loop, waiter in self.waiters:
+                try:
+                    loop.call_soon_threadsafe(waiter.set)
+                except RuntimeError:
+                    # the loop was closed, its subscribers are gone
+                    pass
+
+    def since(self, n):
+        """
+        :param n: word count already seen by the subscriber
+        :type n: int
+        :return: buffered events after n, or None if some were already dropped
+        :rtype: list
+        """
+
+        if n >= self.words:
+            return []
+        if len(self.events) == 0 or self.events[0]["n"] > n + 1:
+            return None
+        return [event for event in self.events if event["n"] > n]
+
+
+class EventHub:
+    """
+    fans the events of followed stories out to the subscribers of this process
+    """
+
+    def __init__(self, app, poll_interval=0.05, backlog=1024):
+        """
+        :param app: flask app, used for an app context on the poller thread
+        :type app: flask.Flask
+        :param poll_interval: seconds between checks of the write generation
+        :type poll_interval: float
+        :param backlog: number of recent events kept per story
+        :type backlog: int
+        """
+
+        self.app = app
+        self.poll_interval = float(poll_interval)
+        self.backlog = int(backlog)
+        self._channels = dict()
+        self._lock = threading.Lock()
+        self._poller = None
+
+    def _read(self, id, start=(0, 0)):
+        from .db_hanlder import DBHandler
+
+        with self.app.app_context():
+            return DBHandler.get_story_tail(id, *start)
+
+    def subscribe(self, id):
+        """
+        starts following a story
+
+        :param id: id of the story
+        :type id: int
+        :raises IDNotFound: id not present in the database
+        :return: channel of the story, to be passed to wait and unsubscribe
+        :rtype: _Channel
+        """
+
+        with self._lock:
+            channel = self._channels.get(id)
+            if channel is None:
+                channel = _Channel(self._read(id), self.backlog)
+                self._channels[id] = channel
+            channel.subscribers += 1
+            if self._poller is None:
+                self._poller = threading.Thread(target=self._poll, name="collab-events", daemon=True)
+                self._poller.start()
+        return channel
+
+    def unsubscribe(self, id, channel):
+        """
+        stops following a story, forgetting it once nobody follows it
+
+        :param id: id of the story
+        :type id: int
+        :param channel: channel returned by subscribe
+        :type channel: _Channel
+        """
+
+        with self._lock:
+            channel.subscribers -= 1
+            if channel.subscribers <= 0 and self._channels.get(id) is channel:
+                del self._channels[id]
+
+    def wait(self, id, channel, since, timeout):
+        """
+        waits for events after the since-th word of a story
+
+        :param id: id of the story
+        :type id: int
+        :param channel: channel returned by subscribe
+        :type channel: _Channel
+        :param since: word count already seen by the subscriber
+        :type since: int
+        :param timeout: seconds to wait for new events
+        :type timeout: float
+        :return: events after since, empty if none came within timeout
+        :rtype: list
+        """
+
+        deadline = time.monotonic() + timeout
+        with channel.condition:
+            while True:
+                events = channel.since(since)
+                if events is None:
+                    break
+                if len(events) != 0 or channel.completed:
+                    return events
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return []
+                channel.condition.wait(remaining)
+
+        # the subscriber is further behind than the backlog reaches
+        tail = self._read(id)
+        return story_events(tail["title"], tail["sentences"], tail["words"], tail["completed"], since)
+
+    async def wait_async(self, id, channel, since, timeout):
+        """
+        waits for events like wait, on the running event loop instead of a
+        thread of its own
+
+        :return: events after since, empty if none came within timeout
+        :rtype: list
+        """
+
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + timeout
+        while True:
+            waiter = (loop, asyncio.Event())
+            with channel.condition:
+                events = channel.since(since)
+                if events is None:
+                    break
+                if len(events) != 0 or channel.completed:
+                    return events
+                # registered under the lock extend takes, so no wake-up is lost
+                channel.waiters.add(waiter)
+            try:
+                remaining = deadline - loop.time()
+                if remaining <= 0:
+                    return []
+                try:
+                    await asyncio.wait_for(waiter[1].wait(), remaining)
+                except asyncio.TimeoutError:
+                    pass
+            finally:
+                with channel.condition:
+                    channel.waiters.discard(waiter)
+
+        # the subscriber is further behind than the backlog reaches
+        tail = await loop.run_in_executor(None, self._read, id)
+        return story_events(tail["title"], tail["sentences"], tail["words"], tail["completed"], since)
+
+    def _poll(self):
+        """
+        poller loop: reads the newest sentences of every followed story
+        whenever a word was added by any worker
+        """
+
+        from .cache import get_story_cache
+        from .exceptions import IDNotFound
+
+        generation = get_story_cache(self.app.config).generation
+        seen = generation.value()
+        while True:
+            time.sleep(self.poll_interval)
+            # the thread serves every subscriber of the process, so it
+            # outlives any error and reads the stories again on the next tick
+            try:
+                current = generation.value()
+                if current == seen:
+                    continue
+
+                with self._lock:
+                    followed = [(id, channel) for id, channel in self._channels.items() if not channel.completed]
+                for id, channel in followed:
+                    try:
+                        tail = self._read(id, channel.start)
+                    except IDNotFound:
+                        continue
+                    if tail["words"] > channel.words or tail["completed"] != channel.completed:
+                        channel.extend(tail)
+                seen = current
+            except Exception as err:
+                LOG.debug(err)
+                LOG.error("failed to read new story events, retrying in %ss", self.poll_interval, exc_info=True)
+
+    def stats(self):
+        """
+        :return: followed stories and their subscriber counts
+        :rtype: dict
+        """
+
+        with self._lock:
+            return dict({str(id): channel.subscribers for id, channel in self._channels.items()})
+
+
+class EventStream:
+    """
+    body of an event stream or long-poll response, sent from a thread
+    (iterating it) or from an event loop (async iterating it)
+    """
+
+    def __init__(self, hub, id, channel, since, timeout=None, keepalive=15.0):
+        """
+        :param hub: event hub of the process
+        :type hub: EventHub
+        :param id: id of the story
+        :type id: int
+        :param channel: channel returned by hub.subscribe, unsubscribed when
+            the stream is closed
+        :type channel: _Channel
+        :param since: word count already seen by the subscriber
+        :type since: int
+        :param timeout: seconds a long-poll waits, None for server-sent events
+        :type timeout: float
+        :param keepalive: seconds between comments on an idle event stream
+        :type keepalive: float
+        """
+
+        self.hub = hub
+        self.id = id
+        self.channel = channel
+        self.since = since
+        self.timeout = timeout
+        self.keepalive = float(keepalive)
+        self._closed = False
+        self._close_lock = threading.Lock()
+
+    def _script(self):
+        """
+        steps of the response, shared by both ways of sending it: yields
+        ("wait", since, timeout) and is sent the events, or yields
+        ("chunk", bytes) to be sent to the client
+        """
+
+        from . import serialize
+
+        if self.timeout is not None:
+            events = yield ("wait", self.since, self.timeout)
+            yield ("chunk", serialize.dumps(dict({
+                "id": self.id,
+                "last": events[-1]["n"] if len(events) != 0 else self.since,
+                "completed": self.channel.completed,
+                "events": events
+            })))
+            return
+
+        last = self.since
+        while True:
+            events = yield ("wait", last, self.keepalive)
+            if len(events) == 0 and not self.channel.completed:
+                yield ("chunk", b": keep-alive\n\n")
+                continue
+            # events of one word go out in a single write
+            yield ("chunk", "".join(
+                "id: {}\nevent: {}\ndata: {}\n\n".format(event["n"], event["type"], serialize.dumps(event).decode('utf-8'))
+                for event in events
+            ).encode('utf-8'))
+            if len(events) != 0:
+                last = events[-1]["n"]
+            if self.channel.completed and last >= self.channel.words:
+                return
+
+    def __iter__(self):
+        try:
+            script = self._script()
+            step = next(script)
+            while True:
+                if step[0] == "wait":
+                    step = script.send(self.hub.wait(self.id, self.channel, step[1], step[2]))
+                else:
+                    yield step[1]
+                    step = next(script)
+        except StopIteration:
+            return
+        finally:
+            self.close()
+
+    async def __aiter__(self):
+        try:
+            script = self._script()
+            step = next(script)
+            while True:
+                if step[0] == "wait":
+                    step = script.send(await self.hub.wait_async(self.id, self.channel, step[1], step[2]))
+                else:
+                    yield step[1]
+                    step = next(script)
+        except StopIteration:
+            return
+        finally:
+            self.close()
+
+    def close(self):
+        """
+        stops following the story, once
+        """
+
+        with self._close_lock:
+            if self._closed:
+                return
+            self._closed = True
+        self.hub.unsubscribe(self.id, self.channel)
+
+
+def get_event_hub(app):
+    """
+    returns the event hub of the current process, creating it on first use
+
+    :param app: flask app
+    :type app: flask.Flask
+    :return: event hub
+    :rtype: EventHub
+    """
+
+    key = (os.getpid(), app.config['DATABASE'])
+    hub = _HUBS.get(key)
+    if hub is not None:
+        return hub
+
+    with _HUBS_LOCK:
+        hub = _HUBS.get(key)
+        if hub is None:
+            hub = EventHub(
+                app,
+                poll_interval=app.config.get('EVENTS_POLL_INTERVAL', 0.05),
+                backlog=app.config.get('EVENTS_BACKLOG', 1024)
+            )
+            _HUBS[key] = hub
+    return hub
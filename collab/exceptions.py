@@ -22,3 +22,59 @@ class IDNotFound(ValueError):
 
         LOG.error("id (=%s) parameter not found in database", str(id))
         super(IDNotFound, self).__init__()
+
+
+class WriterBusy(RuntimeError):
+    """
+    handles words turned away because the writer queue is full
+    """
+
+    def __init__(self, depth):
+        """
+        logs and invokes RuntimeError
+
+        :param depth: number of writes waiting in the queue
+        :type depth: int
+        """
+
+        LOG.warning("writer queue is full (depth=%s), rejecting write", depth)
+        self.depth = depth
+        super(WriterBusy, self).__init__()
+
+
+class WriterUnavailable(RuntimeError):
+    """
+    handles words that could not be handed to the writer
+    """
+
+    def __init__(self, path, sent=False):
+        """
+        logs and invokes RuntimeError
+
+        :param path: socket of the writer
+        :type path: str
+        :param sent: whether the writer got the words, and may still apply
+            them, before its reply was lost or timed out
+        :type sent: bool
+        """
+
+        LOG.error("unable to reach the story writer at %s", path)
+        self.sent = sent
+        super(WriterUnavailable, self).__init__()
+
+
+class StorageUnavailable(RuntimeError):
+    """
+    handles a database that could not be set up when the app starts
+    """
+
+    def __init__(self, target):
+        """
+        logs and invokes RuntimeError
+
+        :param target: database file or name of the storage
+        :type target: str
+        """
+
+        LOG.critical("FAILED TO INITIALIZE DATABASE (%s)", target)
+        super(StorageUnavailable, self).__init__(target)
@@ -3,17 +3,21 @@ contains all methods for endpoints that use GET method
 """
 
 import logging
-import json
 
-from flask import Blueprint, request, Response
+from flask import Blueprint, current_app, request, Response, stream_with_context
 
-from .helpers import sane_query_args
+from .helpers import sane_query_args, encode_cursor, decode_cursor
+from .helpers import story_etag, body_etag, parse_timestamp, not_modified, part_args
 from .exceptions import IDNotFound
-from .db_hanlder import DBHandler
+from .db_hanlder import DBHandler, EXPORT_FILTERS
+from .transfer import export_filters, export_lines
+from .events import get_event_hub, EventStream, ASYNC_ENVIRON, STREAM_ENVIRON
+from . import metrics, serialize, compress
 
 
 LOG = logging.getLogger(__name__)
 stories = Blueprint('get_story', __name__, url_prefix='/stories')
+monitoring = Blueprint('monitoring', __name__)
 
 @stories.route('', methods=["GET"])
 def get_story_list():
@@ -25,12 +29,18 @@ def get_story_list():
         offset: uint32 -
         sort: enum: created_at, updated_at, title
         order: enum: asc, desc
+        cursor: string - "next" token of the previous page
+
+    Pages fetched with cursor cost the same however deep they are, while
+    large offsets have to skip over every earlier row. Responses carry an
+    ETag of the body and a matching If-None-Match is answered with 304.
 
     The response format is as below:
     {
         "limit": 100,
         "offset": 0,
         "count": 1,
+        "next": "WyJjcmVhdGVkX2F0Ii...",
         "results":[
             {
                 "id": 1,
@@ -49,7 +59,8 @@ def get_story_list():
         "limit": request.args.get("limit", 100),
         "offset": request.args.get("offset", 0),
         "sort": request.args.get("sort", "created_at").lower(),
-        "order": request.args.get("order", "asc").lower()
+        "order": request.args.get("order", "asc").lower(),
+        "cursor": request.args.get("cursor", None)
     })
 
     # check for sanity of given input parameters
@@ -59,56 +70,404 @@ def get_story_list():
         response_dict = dict({"invalid parameters": sanity_check_resp, "error": "invalid parameter values"})
 
     else:
-        results = DBHandler.get_stories(query_dict["limit"], query_dict["offset"], query_dict["sort"], query_dict["order"])
+        after = None
+        if query_dict["cursor"] is not None:
+            after = decode_cursor(query_dict["cursor"], query_dict["sort"], query_dict["order"])
+
+        results = DBHandler.get_stories(query_dict["limit"], query_dict["offset"], query_dict["sort"], query_dict["order"], after)
         status_code = 200
+        next_cursor = None
+        if len(results) == int(query_dict["limit"]):
+            next_cursor = encode_cursor(query_dict["sort"], query_dict["order"], results[-1])
         response_dict = dict({
             "limit": query_dict["limit"],
             "offset": query_dict["offset"],
             "count": len(results),
+            "next": next_cursor,
             "results": results
         })
 
-    return Response(
+    with metrics.get_registry().time("collab_json_duration_seconds", metrics.JSON_ENCODE):
+        body = serialize.dumps(response_dict)
+    response = Response(
         status = status_code,
-        response=json.dumps(response_dict),
+        response=body,
         mimetype="application/json"
     )
+    if status_code == 200:
+        response.set_etag(body_etag(response.get_data()))
+        response.make_conditional(request)
+    return response
+
+@stories.route('/search', methods=["GET"])
+def search_stories():
+    """
+    finds the stories containing every word of the query parameter "q",
+    best matches first, with a snippet of the body around the matches
+
+    Pages are fetched with limit and offset, or with the "next" token of
+    the previous page passed back as cursor along with the same q.
+
+    {
+        "q": "hiring",
+        "limit": 100,
+        "offset": 0,
+        "count": 1,
+        "next": null,
+        "results":[
+            {
+                "id": 1,
+                "title": "verloop hiring",
+                "created_at": "2018-12-01 00:00:00",
+                "updated_at": "2018-12-01 00:01:00",
+                "rank": -1.25,
+                "snippet": "we are <mark>hiring</mark> engineers..."
+            }
+        ]
+    }
+
+    :return: response
+    :rtype: flask.Response
+    """
+
+    if not DBHandler.search_enabled():
+        return Response(status=404)
+
+    query = request.args.get("q", "")
+    query_dict = dict({
+        "limit": request.args.get("limit", 100),
+        "offset": request.args.get("offset", 0),
+        # a cursor carries the query in place of the order, so that it only
+        # continues the search it was issued for
+        "sort": "created_at",
+        "order": "asc",
+        "cursor": None
+    })
+    sanity_check_resp = sane_query_args(query_dict)
+    after = None
+    if request.args.get("cursor") is not None:
+        try:
+            after = decode_cursor(request.args["cursor"], "rank", query)
+        except ValueError as err:
+            LOG.debug(err)
+            sanity_check_resp["cursor"] = request.args["cursor"]
+    if len(query.split()) == 0:
+        sanity_check_resp["q"] = query
+
+    if len(sanity_check_resp.keys()) != 0:
+        return Response(
+            status=400,
+            response=serialize.dumps(dict({"invalid parameters": sanity_check_resp, "error": "invalid parameter values"})),
+            mimetype="application/json"
+        )
+
+    results = DBHandler.search_stories(query, query_dict["limit"], query_dict["offset"], after)
+    next_cursor = None
+    if len(results) == int(query_dict["limit"]):
+        next_cursor = encode_cursor("rank", query, results[-1])
+    with metrics.get_registry().time("collab_json_duration_seconds", metrics.JSON_ENCODE):
+        body = serialize.dumps(dict({
+            "q": query,
+            "limit": query_dict["limit"],
+            "offset": query_dict["offset"],
+            "count": len(results),
+            "next": next_cursor,
+            "results": results
+        }))
+    return Response(
+        status=200,
+        response=body,
+        mimetype="application/json"
+    )
+
+@stories.route('/export', methods=["GET"])
+def export_stories():
+    """
+    streams every story as newline-delimited JSON, one story per line in
+    the format of DBHandler.export_stories
+
+    Stories are read in batches of EXPORT_BATCH rows, so the export of any
+    number of stories takes the same memory. They can be narrowed down by
+    the query parameters id_from and id_to (inclusive), and by the windows
+    created_from/created_to and updated_from/updated_to, given as
+    "2018-12-01 00:01:00" (start included, end excluded).
+
+    :return: response
+    :rtype: flask.Response
+    """
+
+    try:
+        filters = export_filters(request.args)
+    except ValueError as err:
+        LOG.debug(err)
+        LOG.error("unsupported or invalid export filters provided")
+        return Response(
+            status=400,
+            response=serialize.dumps(dict({"error": "invalid filters", "filters": sorted(EXPORT_FILTERS)})),
+            mimetype="application/json"
+        )
+
+    LOG.info("exporting stories matching %s", filters)
+    return Response(
+        stream_with_context(export_lines(filters, current_app.config['EXPORT_BATCH'])),
+        mimetype="application/x-ndjson"
+    )
 
 @stories.route('/<id>')
 def get_story(id):
     """
     gets a story from the database provided it's id
+
+    The response carries a strong ETag and Last-Modified derived from the
+    story's id, word count and updated_at. Requests with a matching
+    If-None-Match, or an If-Modified-Since not older than the story, are
+    answered with 304 from the story's version alone, without loading its
+    sentences. The body is compressed with the best content coding the
+    client accepts; completed stories are compressed once and the bytes
+    kept, see DBHandler.get_story_encoded.
+
+    A range of the story is sent instead with the following query
+    parameters, reading only its sentences from the database:
+        para_from, sent_from: uint32 - position of the first sentence
+        para_to, sent_to: uint32 - position of the last sentence, the
+            whole paragraph para_to without sent_to
+        tail: uint32 - only the last sentences of the story, or of the range
+
+    The range carries the position of its first sentence, e.g. for tail=1:
+    {
+        "id": 1,
+        "title": "verloop hiring",
+        "created_at": "2018-12-01T00:00:00Z",
+        "updated_at": "2018-12-01T00:01:00Z",
+        "offset": {"paragraph": 2, "sentence": 4},
+        "paragraphs": [{"sentences": ["hi!"]}]
+    }
     
     :param id: id of the story
     :type id: int
     :return: response
     :rtype: flask.Response
     """
+    part, invalid = part_args(request.args)
+    if len(invalid) != 0:
+        return Response(
+            status=400,
+            response=serialize.dumps(dict({"invalid parameters": invalid, "error": "invalid parameter values"})),
+            mimetype="application/json"
+        )
+
     try:
         # raises ValueError if id is non-integer
         id = int(id)
         if id <= 0:
             raise ValueError("route parameter (id) is invalid (negative)")
         
-        # TODO: query database for the particular story, raise idNotFound Error
         try:
-            db_resp = DBHandler.get_story(id)
+            if request.if_none_match or request.if_modified_since:
+                version = DBHandler.get_story_version(id)
+                etag = story_etag(id, version, part)
+                last_modified = parse_timestamp(version["updated_at"])
+                if not_modified(etag, last_modified):
+                    response = Response(status=304)
+                    response.set_etag(etag)
+                    response.last_modified = last_modified
+                    return response
+
+            if part is not None:
+                # ranges are not cached, they are compressed after the view
+                story, version = DBHandler.get_story_part(id, *part)
+                with metrics.get_registry().time("collab_json_duration_seconds", metrics.JSON_ENCODE):
+                    body = serialize.dumps(story)
+                encoding = None
+            else:
+                encodings = compress.offered(current_app.config)
+                encoding = compress.negotiate(request.accept_encodings, encodings) if encodings else None
+                body, version, encoding = DBHandler.get_story_encoded(id, encoding)
         except IDNotFound as err:
             LOG.error(err)
             raise ValueError("route parameter (id) is invalid (not found)")
 
-        status_code = 200
-        response_dict = db_resp
+        response = Response(
+            status=200,
+            response=body,
+            mimetype="application/json"
+        )
+        # compressed bodies are a different representation of the story
+        response.set_etag(story_etag(id, version, part), weak=encoding is not None)
+        response.last_modified = parse_timestamp(version["updated_at"])
+        if encoding is not None:
+            response.headers["Content-Encoding"] = encoding
 
     except ValueError as err:
         LOG.debug(err)
         LOG.error("unsupported or invalid story id provided")
         LOG.error(str({"id": id}))
-        status_code = 400
-        response_dict = dict({"id": id, "error": "invalid id"})
+        response = Response(
+            status=400,
+            response=serialize.dumps(dict({"id": id, "error": "invalid id"})),
+            mimetype="application/json"
+        )
 
-    return Response(
-        status=status_code,
-        response=json.dumps(response_dict),
+    return response
+
+@stories.route('/<id>/events')
+def get_story_events(id):
+    """
+    streams the changes of a story as they are written
+
+    Clients accepting text/event-stream get server-sent events, one per
+    change, with the word count of the story as event id. Other clients
+    long-poll: the request waits until the story changes, at most
+    "timeout" seconds, and receives the changes as JSON. Either way the
+    changes after the "since" query parameter (or the Last-Event-ID
+    header) are sent, by default only those made after the request.
+
+    The long-poll response format is as below:
+    {
+        "id": 1,
+        "last": 18,
+        "completed": false,
+        "events": [
+            {"type": "word", "n": 17, "para": 0, "sent": 0, "word": "lorem"},
+            {"type": "sentence", "n": 17, "para": 0, "sent": 0, "text": "lorem ..."},
+            {"type": "word", "n": 18, "para": 0, "sent": 1, "word": "ipsum"}
+        ]
+    }
+
+    :param id: id of the story
+    :type id: int
+    :return: response
+    :rtype: flask.Response
+    """
+
+    try:
+        # raises ValueError if id, since or timeout are not integers
+        id = int(id)
+        if id <= 0:
+            raise ValueError("route parameter (id) is invalid (negative)")
+        since = request.args.get("since", request.headers.get("Last-Event-ID", None))
+        since = int(since) if since is not None else None
+        if since is not None and since < 0:
+            raise ValueError("query parameter (since) is invalid (negative)")
+        timeout = float(request.args.get("timeout", current_app.config['EVENTS_LONG_POLL_TIMEOUT']))
+        timeout = min(max(timeout, 0), current_app.config['EVENTS_LONG_POLL_TIMEOUT'])
+
+        hub = get_event_hub(current_app._get_current_object())
+        try:
+            channel = hub.subscribe(id)
+        except IDNotFound as err:
+            LOG.error(err)
+            raise ValueError("route parameter (id) is invalid (not found)")
+
+    except ValueError as err:
+        LOG.debug(err)
+        LOG.error("unsupported or invalid event stream parameters provided")
+        return Response(
+            status=400,
+            response=serialize.dumps(dict({"id": id, "error": "invalid parameters"})),
+            mimetype="application/json"
+        )
+
+    if since is None:
+        since = channel.words
+
+    if request.accept_mimetypes.best == "text/event-stream":
+        body = EventStream(hub, id, channel, since, keepalive=current_app.config['EVENTS_KEEPALIVE'])
+        LOG.info("streaming events of story (id=%s) from word %s", id, since)
+        response = Response(body, mimetype="text/event-stream")
+        response.headers["Cache-Control"] = "no-cache"
+        response.headers["X-Accel-Buffering"] = "no"
+    else:
+        body = EventStream(hub, id, channel, since, timeout=timeout)
+        if request.environ.get(ASYNC_ENVIRON):
+            response = Response(body, mimetype="application/json")
+        else:
+            # waits in this thread, the body is sent as a whole
+            response = Response(b"".join(body), status=200, mimetype="application/json")
+
+    # the server waits for the events on its event loop instead of a thread
+    if request.environ.get(ASYNC_ENVIRON):
+        request.environ[STREAM_ENVIRON] = body
+    return response
+
+@monitoring.route('/stats')
+def get_stats():
+    """
+    endpoint to send the totals of the stories and their statistics per
+    day, from counters updated along with every write
+
+    The following query parameter is valid:
+        days: uint32 - most recent UTC days reported, at most STATS_MAX_DAYS
+
+    The response format is as below, most recent day first:
+    {
+        "stories": 12,
+        "completed": 11,
+        "active": 1,
+        "words": 1234,
+        "days": [
+            {
+                "day": "2018-12-01",
+                "started": 2,
+                "completed": 1,
+                "words": 180
+            }
+        ]
+    }
+
+    :return: response
+    :rtype: flask.Response
+    """
+
+    days = request.args.get("days", current_app.config['STATS_DAYS'])
+    try:
+        days = int(days)
+        if days < 0 or days > current_app.config['STATS_MAX_DAYS']:
+            raise ValueError("query parameter (days) is invalid (out of range)")
+    except ValueError as err:
+        LOG.debug(err)
+        LOG.error("statistics requested with invalid parameter values!")
+        return Response(
+            status=400,
+            response=serialize.dumps(dict({"invalid parameters": {"days": days}, "error": "invalid parameter values"})),
+            mimetype="application/json"
+        )
+
+    stats = DBHandler.get_stats(days)
+    if len(stats) == 0:
+        return Response(
+            status=503,
+            response=serialize.dumps(dict({"error": "statistics unavailable"})),
+            mimetype="application/json"
+        )
+
+    response = Response(
+        status=200,
+        response=serialize.dumps(stats),
         mimetype="application/json"
-    )
\ No newline at end of file
+    )
+    response.set_etag(body_etag(response.get_data()))
+    response.make_conditional(request)
+    return response
+
+@monitoring.route('/metrics')
+def get_metrics():
+    """
+    exposes the metrics of every worker in the Prometheus text format
+
+    Counters and histograms are summed over all worker processes, gauges
+    over the running ones. The metrics of other workers are at most
+    METRICS_FLUSH_INTERVAL seconds old.
+
+    :return: response
+    :rtype: flask.Response
+    """
+
+    if not current_app.config.get('METRICS'):
+        return Response(status=404)
+
+    return Response(
+        status=200,
+        response=metrics.render(metrics.aggregate()),
+        mimetype="text/plain; version=0.0.4"
+    )
@@ -4,16 +4,53 @@ main driving methods
 """
 
 import os
+import copy
+import json
+import zlib
+import base64
+import hashlib
+import binascii
 import logging.config
 
-import pydash
+from datetime import datetime, timezone
 
-from ruamel.yaml import YAML
-from flask import current_app
+from flask import current_app, request
+
+from .story import PARAGRAPH_END
+from . import log_handlers
 
 
 LOG = logging.getLogger(__name__)
 
+# values of ROOMS
+ROOM_MODES = ("off", "keys", "shards")
+
+# query parameters of GET /stories/<id> selecting a range of the story
+PART_ARGS = ("para_from", "sent_from", "para_to", "sent_to", "tail")
+
+# parsed logging configurations by (path, modification time)
+_LOGGING_CONFIGS = dict()
+
+def _logging_config(path):
+    """
+    :param path: YAML file of the logging configuration
+    :type path: str
+    :return: the parsed file, parsed once per process until it changes
+    :rtype: dict
+    """
+
+    path = os.path.join(current_app.root_path, path)
+    key = (path, os.stat(path).st_mtime_ns)
+    config = _LOGGING_CONFIGS.get(key)
+    if config is None:
+        from ruamel.yaml import YAML
+
+        with current_app.open_resource(path) as f:
+            config = YAML(typ="safe").load(f)
+        _LOGGING_CONFIGS.clear()
+        _LOGGING_CONFIGS[key] = config
+    return config
+
 def config_logging():
     """
     loads configuration for the logging module
@@ -21,9 +58,10 @@ def config_logging():
     The file that is used to load logging configuration is "./log_config.yaml"    
     """
 
-    yaml = YAML(typ="safe")
-    with current_app.open_resource(current_app.config['LOGGING_CONFIG']) as f:
-        config = yaml.load(f)
+    # imported here, the first time the app is created in a process
+    import pydash
+
+    config = copy.deepcopy(_logging_config(current_app.config['LOGGING_CONFIG']))
 
     # check if debug data to be output
     log_lvl = "INFO"
@@ -39,14 +77,25 @@ def config_logging():
                 },
                 "file":
                 {
-                    "filename": current_app.config['LOGS']
+                    "filename": current_app.config['LOGS'],
+                    "maxBytes": current_app.config['LOG_MAX_BYTES'],
+                    "backupCount": current_app.config['LOG_BACKUPS'],
+                    "interval": current_app.config['LOG_ROTATE_INTERVAL']
                 }
             }
         }
+    if current_app.config['LOG_FORMAT'] == "json":
+        update_config["handlers"]["file"]["formatter"] = "json"
 
     pydash.merge(config, update_config)
 
+    log_handlers.stop_queue()
     logging.config.dictConfig(config)
+    if current_app.config['LOG_QUEUE']:
+        log_handlers.start_queue(logging.getLogger())
+    log_handlers.limit_rate(
+        logging.getLogger(), current_app.config['LOG_RATE_LIMIT'], current_app.config['LOG_RATE_PERIOD']
+    )
     LOG.debug("Logger Configured!")
 
 def sane_query_args(query_dict):
@@ -87,8 +136,246 @@ def sane_query_args(query_dict):
     if query_dict["order"] not in ["asc", "desc"]:
         error_params.update({"order": query_dict["order"]})
 
+    # cursor must be a "next" token issued for the same sort and order
+    if query_dict.get("cursor") is not None:
+        try:
+            decode_cursor(query_dict["cursor"], query_dict["sort"], query_dict["order"])
+        except ValueError as err:
+            LOG.debug(err)
+            error_params.update({"cursor": query_dict["cursor"]})
+
     if len(error_params.keys()) != 0:
         LOG.error("stories requested with invalid parameter values!")
         LOG.debug(str(error_params))
     
-    return error_params
\ No newline at end of file
+    return error_params
+
+def encode_cursor(sort, order, story):
+    """
+    creates the opaque token pointing after the given story in a listing
+
+    :param sort: column the listing is sorted by
+    :type sort: str
+    :param order: order of the listing
+    :type order: str
+    :param story: last story of the page
+    :type story: dict
+    :return: url-safe token
+    :rtype: str
+    """
+
+    raw = json.dumps([sort, order, story[sort], story["id"]], separators=(",", ":"))
+    return base64.urlsafe_b64encode(raw.encode('utf-8')).decode('ascii').rstrip("=")
+
+def decode_cursor(token, sort, order):
+    """
+    decodes a token created by encode_cursor
+
+    :param token: token received as the cursor query parameter
+    :type token: str
+    :param sort: column the listing is sorted by
+    :type sort: str
+    :param order: order of the listing
+    :type order: str
+    :raises ValueError: token is malformed or was issued for another sort or order
+    :return: (sort value, id) of the last story of the previous page
+    :rtype: tuple
+    """
+
+    try:
+        raw = base64.urlsafe_b64decode(token + "=" * (-len(token) % 4))
+        token_sort, token_order, value, id = json.loads(raw.decode('utf-8'))
+    except (binascii.Error, UnicodeDecodeError, TypeError, ValueError) as err:
+        raise ValueError("query parameter (cursor) is invalid ({})".format(err))
+
+    if token_sort != sort or token_order != order:
+        raise ValueError("query parameter (cursor) was issued for another sort or order")
+    if not isinstance(id, int) or not isinstance(value, (str, float)):
+        raise ValueError("query parameter (cursor) is invalid (malformed position)")
+    return (value, id)
+
+def resolve_room(key):
+    """
+    maps the room key sent to /add to the room whose active story gets
+    the words, as configured by ROOMS:
+
+    - "off": every word goes to the one active story, keys are refused;
+    - "keys": every key is a room of its own;
+    - "shards": keys are hashed into ROOM_SHARDS rooms, named "0" to
+      "ROOM_SHARDS - 1", so the number of active stories stays bounded.
+
+    Words sent without a key go to the default room "" in every mode.
+
+    :param key: key sent by the client, None if there is none
+    :type key: str
+    :raises ValueError: the key is not accepted
+    :return: room of the story
+    :rtype: str
+    """
+
+    if key is None or key == "":
+        return ""
+    mode = current_app.config['ROOMS']
+    if mode == "off":
+        raise ValueError("rooms are not enabled")
+    if not isinstance(key, str) or len(key) > current_app.config['ROOM_MAX_LENGTH'] or len(key.split()) != 1:
+        raise ValueError("room must be a single word of at most {} characters".format(
+            current_app.config['ROOM_MAX_LENGTH']
+        ))
+    if mode == "shards":
+        return str(zlib.crc32(key.encode('utf-8')) % int(current_app.config['ROOM_SHARDS']))
+    return key
+
+def close_clashing_stories(stories, active_rooms):
+    """
+    marks as completed the active stories of an import whose room has an
+    active story already, in the database or earlier in the import, as a
+    room has at most one
+
+    :param stories: stories in the format of DBHandler.export_stories
+    :type stories: list
+    :param active_rooms: rooms with an active story, updated with those of
+        the stories left active
+    :type active_rooms: set
+    :return: the stories, and the number of them marked completed
+    :rtype: tuple
+    """
+
+    kept, closed = [], 0
+    for story in stories:
+        if story["modifying"] != "no":
+            room = story.get("room", "")
+            if room in active_rooms:
+                story = dict(story, modifying="no")
+                closed += 1
+            else:
+                active_rooms.add(room)
+        kept.append(story)
+    return kept, closed
+
+def part_args(query_dict):
+    """
+    reads the range of a story requested from GET /stories/<id>
+
+    para_from and sent_from give the position of the first sentence,
+    para_to and sent_to that of the last one, both included, and tail
+    keeps only the last sentences of the range. Without sent_to the range
+    ends with paragraph para_to.
+
+    :param query_dict: query parameters
+    :type query_dict: dict
+    :return: (start, end, tail) as taken by DBHandler.get_story_part, None
+        if the whole story is requested, and dictionary containing wrong
+        parameters
+    :rtype: tuple
+    """
+
+    values = dict()
+    error_params = dict()
+    for name in PART_ARGS:
+        if query_dict.get(name) is None:
+            continue
+        # positions are non-negative integers, tail is positive
+        try:
+            values[name] = int(query_dict[name])
+            if values[name] < (1 if name == "tail" else 0):
+                raise ValueError("query parameter ({}) is invalid (out of range)".format(name))
+        except ValueError as err:
+            LOG.debug(err)
+            error_params.update({name: query_dict[name]})
+
+    if len(values) == 0 and len(error_params) == 0:
+        return None, error_params
+
+    start = (values.get("para_from", 0), values.get("sent_from", 0))
+    end = None
+    if "para_to" in values:
+        end = (values["para_to"], values.get("sent_to", PARAGRAPH_END))
+        if end < start:
+            error_params.update({"para_to": query_dict["para_to"]})
+    elif "sent_to" in values:
+        # a sentence index means nothing without its paragraph
+        error_params.update({"sent_to": query_dict["sent_to"]})
+
+    if len(error_params.keys()) != 0:
+        LOG.error("story part requested with invalid parameter values!")
+        LOG.debug(str(error_params))
+        return None, error_params
+    return (start, end, values.get("tail")), error_params
+
+def story_etag(id, version, part=None):
+    """
+    strong entity tag of a story
+
+    :param id: id of the story
+    :type id: int
+    :param version: version as returned by DBHandler.get_story_version
+    :type version: dict
+    :param part: (start, end, tail) of a range of the story, as returned
+        by part_args, None for the whole story
+    :type part: tuple
+    :return: unquoted entity tag
+    :rtype: str
+    """
+
+    stamp = "".join(c for c in str(version["updated_at"]) if c.isdigit())
+    etag = "{}-{}-{}".format(id, version["words"], stamp)
+    if part is not None:
+        # every range of the same version is a representation of its own
+        start, end, tail = part
+        etag += "-{}.{}-{}-{}".format(
+            start[0], start[1], "end" if end is None else "{}.{}".format(*end), "all" if tail is None else tail
+        )
+    return etag
+
+def body_etag(body):
+    """
+    strong entity tag of a response body
+
+    :param body: serialized response
+    :type body: bytes
+    :return: unquoted entity tag
+    :rtype: str
+    """
+
+    return hashlib.sha1(body).hexdigest()
+
+def parse_timestamp(timestamp):
+    """
+    converts a timestamp stored by SQLite's datetime('now') to a datetime
+
+    :param timestamp: timestamp in UTC, e.g. "2018-12-01 00:01:00"
+    :type timestamp: str
+    :return: timezone aware datetime, or None if it cannot be parsed
+    :rtype: datetime.datetime
+    """
+
+    try:
+        return datetime.strptime(timestamp, "%Y-%m-%d %H:%M:%S").replace(tzinfo=timezone.utc)
+    except (TypeError, ValueError):
+        return None
+
+def not_modified(etag, last_modified=None):
+    """
+    evaluates the conditional headers of the current request
+
+    If-None-Match takes precedence over If-Modified-Since.
+
+    :param etag: unquoted entity tag of the current representation
+    :type etag: str
+    :param last_modified: last modification time of the representation
+    :type last_modified: datetime.datetime
+    :return: whether a 304 response can be sent
+    :rtype: bool
+    """
+
+    if request.if_none_match:
+        return request.if_none_match.contains_weak(etag)
+
+    since = request.if_modified_since
+    if since is not None and last_modified is not None:
+        if since.tzinfo is None:
+            since = since.replace(tzinfo=timezone.utc)
+        return last_modified <= since
+
+    return False
@@ -0,0 +1,402 @@
+"""
+contains the idempotency keys of /add and /add/batch
+
+Clients retrying a write send the same ``Idempotency-Key`` header, or the
+same "request_id" field in the JSON body, with every attempt. The first
+attempt claims the key in the dedup store, runs and stores its response;
+later attempts get that response back, with an ``Idempotent-Replayed``
+header, without adding their words again. An attempt arriving while the
+first one still runs is answered with 409, and a key sent again with a
+different request with 422. Responses with a 5xx status (a busy writer, a
+failed database) are not stored, and the key is released so the retry runs
+again. When the outcome of the write is unknown, because the single writer
+got the words but did not reply in time, the key stays claimed: retries get
+409 until the claim times out, instead of adding the words a second time.
+
+The store is shared by every worker: a table in its own SQLite file
+(``IDEMPOTENCY_DATABASE``), so that it never takes the write lock of the
+stories, or a table of the PostgreSQL storage. Keys expire after
+``IDEMPOTENCY_TTL`` seconds and at most ``IDEMPOTENCY_MAX_KEYS`` are kept.
+A claim whose request never finished, e.g. because its worker died, is
+given to the next attempt after ``IDEMPOTENCY_LOCK_TIMEOUT`` seconds.
+"""
+
+import os
+import time
+import hashlib
+import logging
+import itertools
+import threading
+import functools
+
+from flask import current_app, g, request, Response
+
+from .pool import PoolTimeout
+from . import serialize
+
+
+LOG = logging.getLogger(__name__)
+
+_STORES = dict()
+_STORES_LOCK = threading.Lock()
+
+# outcomes of claim
+CLAIMED = "claimed"
+REPLAYED = "replayed"
+IN_PROGRESS = "in progress"
+MISMATCH = "mismatch"
+
+# claims between purges of expired and surplus keys, per process
+PURGE_EVERY = 256
+
+
+class IdempotencyStore:
+    """
+    keys of the requests already handled and their responses, in a SQLite
+    database
+    """
+
+    def __init__(self, pool, ttl=86400.0, max_keys=100000, lock_timeout=60.0):
+        """
+        :param pool: connection pool of the database holding the keys
+        :type pool: collab.pool.ConnectionPool
+        :param ttl: seconds a key is kept
+        :type ttl: float
+        :param max_keys: largest number of keys kept, the oldest go first
+        :type max_keys: int
+        :param lock_timeout: seconds after which the claim of an unfinished
+            request is given to the next attempt
+        :type lock_timeout: float
+        """
+
+        self.pool = pool
+        # a full pool times out with PoolTimeout whatever the database
+        self.errors = tuple(pool.errors) + (PoolTimeout,)
+        self.ttl = float(ttl)
+        self.max_keys = int(max_keys)
+        self.lock_timeout = float(lock_timeout)
+        # shared by the request threads, next() on a count is atomic
+        self._claims = itertools.count(1)
+
+    def setup(self):
+        """
+        creates the table of the keys if it is missing
+        """
+
+        with self.pool.connection() as conn:
+            conn.execute('''
+            CREATE TABLE IF NOT EXISTS idempotency_keys (
+                key TEXT PRIMARY KEY,
+                fingerprint TEXT NOT NULL,  /* hash of the request */
+                created_at REAL NOT NULL,  /* seconds since the epoch */
+                status INTEGER,  /* NULL while the request runs */
+                body BLOB
+            );
+            ''')
+            conn.execute("CREATE INDEX IF NOT EXISTS idempotency_keys_created_at ON idempotency_keys (created_at);")
+            conn.commit()
+
+    def _outcome(self, row, fingerprint, now):
+        """
+        :param row: stored key, None if there is none
+        :param fingerprint: hash of the current request
+        :type fingerprint: str
+        :param now: current time
+        :type now: float
+        :return: outcome of claim and the stored status and body, None if
+            the key is free to be claimed
+        :rtype: tuple
+        """
+
+        if row is None or row["created_at"] < now - self.ttl:
+            return None
+        if row["status"] is None and row["created_at"] < now - self.lock_timeout:
+            return None
+        if row["fingerprint"] != fingerprint:
+            return MISMATCH, None
+        if row["status"] is None:
+            return IN_PROGRESS, None
+        return REPLAYED, (row["status"], bytes(row["body"]))
+
+    def claim(self, key, fingerprint):
+        """
+        claims a key for the current request, unless a request with the
+        same key was handled already or is running
+
+        :param key: idempotency key
+        :type key: str
+        :param fingerprint: hash of the request
+        :type fingerprint: str
+        :return: one of CLAIMED, REPLAYED, IN_PROGRESS and MISMATCH, and the
+            claim to pass to complete or release when CLAIMED, the stored
+            (status, body) when REPLAYED
+        :rtype: tuple
+        """
+
+        now = time.time()
+        sql_cmd = "SELECT fingerprint, created_at, status, body FROM idempotency_keys WHERE key = ?;"
+        with self.pool.connection() as conn:
+            # replays are answered without a write transaction
+            outcome = self._outcome(conn.execute(sql_cmd, (key,)).fetchone(), fingerprint, now)
+            if outcome is not None:
+                return outcome
+
+            conn.execute("BEGIN IMMEDIATE;")
+            try:
+                outcome = self._outcome(conn.execute(sql_cmd, (key,)).fetchone(), fingerprint, now)
+                if outcome is None:
+                    conn.execute(
+                        "INSERT OR REPLACE INTO idempotency_keys (key, fingerprint, created_at) VALUES (?, ?, ?);",
+                        (key, fingerprint, now)
+                    )
+                conn.commit()
+            except self.errors:
+                conn.rollback()
+                raise
+        if outcome is not None:
+            return outcome
+
+        if next(self._claims) % PURGE_EVERY == 0:
+            self.purge()
+        return CLAIMED, (fingerprint, now)
+
+    def complete(self, key, claim, status, body):
+        """
+        stores the response of a claimed request, unless the claim was
+        taken over by another attempt after lock_timeout
+
+        :param key: idempotency key
+        :type key: str
+        :param claim: claim returned by claim
+        :type claim: tuple
+        :param status: status code of the response
+        :type status: int
+        :param body: body of the response
+        :type body: bytes
+        :return: whether the claim was still this request's
+        :rtype: bool
+        """
+
+        with self.pool.connection() as conn:
+            stored = conn.execute(
+                "UPDATE idempotency_keys SET status = ?, body = ? "
+                "WHERE key = ? AND fingerprint = ? AND created_at = ? AND status IS NULL;",
+                (status, body, key) + tuple(claim)
+            ).rowcount
+            conn.commit()
+        return stored == 1
+
+    def release(self, key, claim):
+        """
+        frees the claim of a request that failed, for the next attempt
+
+        :param key: idempotency key
+        :type key: str
+        :param claim: claim returned by claim
+        :type claim: tuple
+        """
+
+        with self.pool.connection() as conn:
+            conn.execute(
+                "DELETE FROM idempotency_keys WHERE key = ? AND fingerprint = ? AND created_at = ? AND status IS NULL;",
+                (key,) + tuple(claim)
+            )
+            conn.commit()
+
+    def purge(self):
+        """
+        drops the expired keys and the oldest ones past max_keys
+
+        :return: number of dropped keys
+        :rtype: int
+        """
+
+        with self.pool.connection() as conn:
+            dropped = conn.execute(
+                "DELETE FROM idempotency_keys WHERE created_at < ?;", (time.time() - self.ttl,)
+            ).rowcount
+            dropped += conn.execute('''
+            DELETE FROM idempotency_keys WHERE created_at <= (
+                SELECT created_at FROM idempotency_keys ORDER BY created_at DESC LIMIT 1 OFFSET ?
+            );
+            ''', (self.max_keys,)).rowcount
+            conn.commit()
+        if dropped:
+            LOG.debug("dropped %s idempotency keys", dropped)
+        return dropped
+
+
+def get_idempotency_store(config):
+    """
+    returns the idempotency store of the current process, creating its
+    table on first use
+
+    :param config: flask app configuration
+    :type config: flask.Config
+    :return: store of the keys
+    :rtype: IdempotencyStore
+    """
+
+    from .pool import ConnectionPool
+    from .storage import get_storage
+
+    storage = get_storage(config)
+    key = (os.getpid(), config['IDEMPOTENCY_DATABASE'] if storage is None else config['POSTGRES_DSN'])
+    store = _STORES.get(key)
+    if store is not None:
+        return store
+
+    with _STORES_LOCK:
+        store = _STORES.get(key)
+        if store is None:
+            settings = dict({
+                "ttl": config.get('IDEMPOTENCY_TTL', 86400.0),
+                "max_keys": config.get('IDEMPOTENCY_MAX_KEYS', 100000),
+                "lock_timeout": config.get('IDEMPOTENCY_LOCK_TIMEOUT', 60.0)
+            })
+            if storage is not None:
+                store = storage.idempotency_store(**settings)
+            else:
+                pool = ConnectionPool(
+                    config['IDEMPOTENCY_DATABASE'],
+                    size=config.get('DB_POOL_SIZE', 8),
+                    timeout=config.get('DB_POOL_TIMEOUT', 10.0)
+                )
+                store = IdempotencyStore(pool, **settings)
+            store.setup()
+            _STORES[key] = store
+    return store
+
+
+def outcome_unknown():
+    """
+    marks the write of the current request as possibly applied even though
+    it failed, so that its idempotency key is kept claimed, not released
+    """
+
+    g.idempotency_outcome_unknown = True
+
+
+def _request_key():
+    """
+    :raises ValueError: the key is not a string of at most
+        IDEMPOTENCY_KEY_MAX_LENGTH characters
+    :return: idempotency key of the current request, None if it has none
+    :rtype: str
+    """
+
+    key = request.headers.get("Idempotency-Key")
+    if key is None and request.is_json:
+        data = request.get_json(silent=True)
+        if isinstance(data, dict):
+            key = data.get("request_id")
+    if key is None:
+        return None
+    if isinstance(key, int) and not isinstance(key, bool):
+        key = str(key)
+    if not isinstance(key, str) or not 0 < len(key) <= current_app.config['IDEMPOTENCY_KEY_MAX_LENGTH']:
+        raise ValueError("idempotency key must be a string of 1 to {} characters".format(
+            current_app.config['IDEMPOTENCY_KEY_MAX_LENGTH']
+        ))
+    return key
+
+
+def _fingerprint():
+    """
+    :return: hash of the path, query string and body of the current request
+    :rtype: str
+    """
+
+    digest = hashlib.sha1(request.path.encode('utf-8'))
+    digest.update(b"?" + request.query_string)
+    digest.update(b"\n" + request.get_data(cache=True))
+    return digest.hexdigest()
+
+
+def _error(status, message):
+    """
+    :return: JSON response with the given status and error message
+    :rtype: flask.Response
+    """
+
+    return Response(
+        status=status,
+        response=serialize.dumps(dict({"error": message})),
+        mimetype="application/json"
+    )
+
+
+def idempotent(view):
+    """
+    decorator answering retries of a write with the response of its first
+    attempt, for requests carrying an idempotency key
+
+    :param view: view function of a write endpoint
+    :type view: function
+    :return: decorated view
+    :rtype: function
+    """
+
+    @functools.wraps(view)
+    def wrapper(*args, **kwargs):
+        from .metrics import get_registry
+
+        if not current_app.config.get('IDEMPOTENCY'):
+            return view(*args, **kwargs)
+        try:
+            key = _request_key()
+        except ValueError as err:
+            LOG.warning("No data added: %s", err)
+            return _error(400, str(err))
+        if key is None:
+            return view(*args, **kwargs)
+
+        store = get_idempotency_store(current_app.config)
+        try:
+            outcome, claim = store.claim(key, _fingerprint())
+        except store.errors as err:
+            LOG.debug(err)
+            LOG.error("failed to claim idempotency key %s", key)
+            response = _error(503, "idempotency store unavailable")
+            response.headers["Retry-After"] = "1"
+            return response
+        get_registry().inc("collab_idempotency_requests_total", labels=(("outcome", outcome),))
+
+        if outcome == REPLAYED:
+            LOG.info("replaying the response of idempotency key %s", key)
+            response = Response(status=claim[0], response=claim[1], mimetype="application/json")
+            response.headers["Idempotent-Replayed"] = "true"
+            return response
+        if outcome == IN_PROGRESS:
+            LOG.warning("request with idempotency key %s is already running", key)
+            response = _error(409, "a request with this idempotency key is in progress")
+            response.headers["Retry-After"] = "1"
+            return response
+        if outcome == MISMATCH:
+            LOG.warning("idempotency key %s sent again with a different request", key)
+            return _error(422, "idempotency key reused with a different request")
+
+        try:
+            response = view(*args, **kwargs)
+        except Exception:
+            if not g.get("idempotency_outcome_unknown", False):
+                store.release(key, claim)
+            raise
+        try:
+            if response.status_code < 500:
+                if not store.complete(key, claim, response.status_code, response.get_data()):
+                    # the next attempt owns the key and stores its own response
+                    LOG.warning("claim of idempotency key %s was taken over, its response is not stored", key)
+            elif g.get("idempotency_outcome_unknown", False):
+                # retries wait for the claim to time out rather than risk
+                # adding the words twice
+                LOG.warning("outcome of the request with idempotency key %s is unknown, keeping its claim", key)
+            else:
+                store.release(key, claim)
+        except store.errors as err:
+            # the write is done, only its retries will run it again
+            LOG.debug(err)
+            LOG.error("failed to store the response of idempotency key %s", key)
+        return response
+
+    return wrapper
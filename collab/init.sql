@@ -4,9 +4,39 @@ CREATE TABLE IF NOT EXISTS stories (
     updated_at TEXT,  /* stores time as string */
     modifying TEXT DEFAULT "1|0|0",  /* stores "no", "title", "paragraphs" */
     title TEXT NOT NULL,
-    paragraphs TEXT DEFAULT '[{"sentences":[""]}]' /* will store stringified JSON */
+    words INTEGER NOT NULL DEFAULT 1,  /* number of words, title included */
+    room TEXT NOT NULL DEFAULT '',  /* stream the story is written in, '' for the default one */
+    archived INTEGER NOT NULL DEFAULT 0  /* 1 once the sentences moved to story_archive */
 );
 
+-- one row per sentence, clustered on (story, paragraph, sentence) so a story
+-- is read back in order with a single index range scan
+CREATE TABLE IF NOT EXISTS sentences (
+    story_id INTEGER NOT NULL,
+    para_idx INTEGER NOT NULL,
+    sent_idx INTEGER NOT NULL,
+    text TEXT NOT NULL DEFAULT '',
+    word_count INTEGER NOT NULL DEFAULT 0,
+    PRIMARY KEY (story_id, para_idx, sent_idx)
+) WITHOUT ROWID;
+
+-- sentences of archived stories, see collab/archive.py
+CREATE TABLE IF NOT EXISTS story_archive (
+    story_id INTEGER PRIMARY KEY,
+    body BLOB NOT NULL  /* zlib compressed JSON, the sentences of each paragraph */
+);
+
+-- listing indexes, the id breaks ties so pages can be fetched by keyset
+CREATE INDEX IF NOT EXISTS stories_created_at ON stories (created_at, id);
+CREATE INDEX IF NOT EXISTS stories_updated_at ON stories (updated_at, id);
+CREATE INDEX IF NOT EXISTS stories_title ON stories (title, id);
+
+-- active story of each room, looked up on every added word
+CREATE INDEX IF NOT EXISTS stories_active ON stories (room) WHERE modifying != 'no';
+
+-- completed stories waiting for the archiver
+CREATE INDEX IF NOT EXISTS stories_unarchived ON stories (id) WHERE modifying = 'no' AND archived = 0;
+
 -- default updated_at to created_at
 CREATE TRIGGER IF NOT EXISTS created_to_updated
 AFTER INSERT ON stories
@@ -16,10 +46,85 @@ BEGIN
     UPDATE stories SET updated_at = NEW.created_at WHERE id = NEW.id;
 END;
 
+-- every story starts with one empty sentence
+CREATE TRIGGER IF NOT EXISTS first_sentence
+AFTER INSERT ON stories
+FOR EACH ROW
+BEGIN
+    INSERT INTO sentences (story_id, para_idx, sent_idx) VALUES (NEW.id, 0, 0);
+END;
+
 -- make modifying as "no" when it is equal to 0|6|9
 CREATE TRIGGER IF NOT EXISTS update_modifying
-AFTER UPDATE ON stories
+AFTER UPDATE OF modifying ON stories
+FOR EACH ROW
+WHEN NEW.modifying = "0|6|9"
+BEGIN
+    UPDATE stories SET modifying = "no" WHERE id = NEW.id;
+END;
+
+-- running totals of stories, kept by the triggers below so that /stats
+-- never scans the stories table; active stories are stories - completed
+CREATE TABLE IF NOT EXISTS story_totals (
+    id INTEGER PRIMARY KEY CHECK (id = 0),  /* single row */
+    stories INTEGER NOT NULL DEFAULT 0,
+    completed INTEGER NOT NULL DEFAULT 0,
+    words INTEGER NOT NULL DEFAULT 0
+);
+INSERT OR IGNORE INTO story_totals (id) VALUES (0);
+
+-- the same per UTC day: stories started, stories completed and words written
+CREATE TABLE IF NOT EXISTS story_daily (
+    day TEXT PRIMARY KEY,  /* e.g. "2018-12-01" */
+    started INTEGER NOT NULL DEFAULT 0,
+    completed INTEGER NOT NULL DEFAULT 0,
+    words INTEGER NOT NULL DEFAULT 0
+) WITHOUT ROWID;
+
+-- a new story, or an imported one: its words count on the day it was last
+-- written to
+CREATE TRIGGER IF NOT EXISTS stats_insert
+AFTER INSERT ON stories
+FOR EACH ROW
+BEGIN
+    UPDATE story_totals
+    SET stories = stories + 1, completed = completed + (NEW.modifying = 'no'), words = words + NEW.words
+    WHERE id = 0;
+    INSERT OR IGNORE INTO story_daily (day) VALUES (date(NEW.created_at));
+    UPDATE story_daily SET started = started + 1 WHERE day = date(NEW.created_at);
+    INSERT OR IGNORE INTO story_daily (day) VALUES (date(COALESCE(NEW.updated_at, NEW.created_at)));
+    UPDATE story_daily
+    SET completed = completed + (NEW.modifying = 'no'), words = words + NEW.words
+    WHERE day = date(COALESCE(NEW.updated_at, NEW.created_at));
+END;
+
+CREATE TRIGGER IF NOT EXISTS stats_words
+AFTER UPDATE OF words ON stories
+FOR EACH ROW
+WHEN NEW.words != OLD.words
+BEGIN
+    UPDATE story_totals SET words = words + NEW.words - OLD.words WHERE id = 0;
+    INSERT OR IGNORE INTO story_daily (day) VALUES (date(NEW.updated_at));
+    UPDATE story_daily SET words = words + NEW.words - OLD.words WHERE day = date(NEW.updated_at);
+END;
+
+-- also fired by the update of update_modifying
+CREATE TRIGGER IF NOT EXISTS stats_completed
+AFTER UPDATE OF modifying ON stories
+FOR EACH ROW
+WHEN NEW.modifying = 'no' AND OLD.modifying != 'no'
+BEGIN
+    UPDATE story_totals SET completed = completed + 1 WHERE id = 0;
+    INSERT OR IGNORE INTO story_daily (day) VALUES (date(NEW.updated_at));
+    UPDATE story_daily SET completed = completed + 1 WHERE day = date(NEW.updated_at);
+END;
+
+-- stories are never deleted by the app, the totals stay right if they are
+CREATE TRIGGER IF NOT EXISTS stats_delete
+AFTER DELETE ON stories
 FOR EACH ROW
 BEGIN
-    UPDATE stories SET modifying = "no" WHERE modifying="0|6|9";
-END;
\ No newline at end of file
+    UPDATE story_totals
+    SET stories = stories - 1, completed = completed - (OLD.modifying = 'no'), words = words - OLD.words
+    WHERE id = 0;
+END;
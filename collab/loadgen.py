@@ -0,0 +1,474 @@
+"""
+contains the load generator behind ``python -m collab.bench run``, ``replay``
+and ``compare``
+
+Requests are given in the trace format of collab/trace.py and sent from
+concurrent clients either to a live server or to an app created in this
+process and driven through the flask test client. Synthetic mixes may use
+the following placeholders, resolved while the load runs:
+
+    {active}  id of the story the last added word went to
+    {next}    "next" token of the client's previous listing page
+    {etag}    ETag the client last received for the same path
+"""
+
+import re
+import json
+import time
+import random
+import logging
+import threading
+
+from http import client as httpclient
+from urllib import parse as urlparse
+
+from .story import SENTENCE_WORDS, PARAGRAPH_SENTENCES, COMPLETE
+
+
+LOG = logging.getLogger(__name__)
+
+MIXES = ("add-heavy", "read-heavy", "deep-pagination", "hot-story", "rollover")
+
+# words in a completed story: two title words and every sentence full
+STORY_WORDS = 2 + (COMPLETE[1] * PARAGRAPH_SENTENCES + COMPLETE[2]) * SENTENCE_WORDS
+
+_ID_SEGMENT = re.compile(r"/\d+(?=/|$)")
+
+
+def endpoint_name(method, path):
+    """
+    :param method: HTTP method
+    :type method: str
+    :param path: path with query string
+    :type path: str
+    :return: name the request is reported under, e.g. "GET /stories/<id>"
+    :rtype: str
+    """
+
+    return "{} {}".format(method, _ID_SEGMENT.sub("/<id>", path.split("?", 1)[0]))
+
+
+def _add(word):
+    return dict({
+        "method": "POST",
+        "path": "/add",
+        "headers": dict({"Content-Type": "application/json"}),
+        "body": json.dumps(dict({"word": word}))
+    })
+
+
+def _get(path, headers=None):
+    return dict({"method": "GET", "path": path, "headers": headers or dict(), "body": None})
+
+
+def synthetic_mix(name, requests, seed=0, depth=1000):
+    """
+    generates the requests of a synthetic workload
+
+    :param name: one of MIXES
+    :type name: str
+    :param requests: number of requests, for "rollover" at least enough
+        words to complete two stories are generated
+    :type requests: int
+    :param seed: seed of the random choices
+    :type seed: int
+    :param depth: deepest offset of "deep-pagination"
+    :type depth: int
+    :return: requests in the trace format, without timestamps
+    :rtype: list
+    """
+
+    rand = random.Random(seed)
+    mix = []
+    if name == "rollover":
+        # start anywhere, then go over the 0|6|9 boundary twice
+        for i in range(max(requests, 2 * STORY_WORDS + SENTENCE_WORDS)):
+            mix.append(_add("r{}".format(i)))
+        return mix
+
+    for i in range(requests):
+        pick = rand.random()
+        if name == "add-heavy":
+            mix.append(_add("a{}".format(i)) if pick < 0.9 else _get("/stories/{active}"))
+        elif name == "read-heavy":
+            if pick < 0.1:
+                mix.append(_add("r{}".format(i)))
+            elif pick < 0.8:
+                mix.append(_get("/stories/{active}"))
+            else:
+                mix.append(_get("/stories?limit=20&sort=updated_at&order=desc"))
+        elif name == "deep-pagination":
+            if pick < 0.5:
+                mix.append(_get("/stories?limit=100&offset={}".format(rand.randrange(depth + 1))))
+            else:
+                mix.append(_get("/stories?limit=100&cursor={next}"))
+        elif name == "hot-story":
+            if pick < 0.05:
+                mix.append(_add("h{}".format(i)))
+            else:
+                mix.append(_get("/stories/{active}", dict({"If-None-Match": "{etag}"})))
+        else:
+            raise ValueError("unknown mix {}".format(name))
+    return mix
+
+
+class _TestClientSession:
+    """
+    client of an app running in this process
+    """
+
+    def __init__(self, app):
+        self.client = app.test_client()
+
+    def request(self, method, path, body, headers):
+        resp = self.client.open(path, method=method, data=body, headers=headers)
+        return resp.status_code, resp.get_data(), resp.headers.get("ETag")
+
+    def close(self):
+        pass
+
+
+class _HttpSession:
+    """
+    keep-alive client of a live server
+    """
+
+    def __init__(self, base_url):
+        address = urlparse.urlsplit(base_url)
+        self.conn = httpclient.HTTPConnection(address.hostname, address.port or 80, timeout=60)
+
+    def request(self, method, path, body, headers):
+        self.conn.request(method, path, body=body.encode("utf-8") if body is not None else None, headers=headers)
+        resp = self.conn.getresponse()
+        return resp.status, resp.read(), resp.getheader("ETag")
+
+    def close(self):
+        self.conn.close()
+
+
+class Target:
+    """
+    server the load is sent to, either a base URL or a flask app
+    """
+
+    def __init__(self, url=None, app=None):
+        """
+        :param url: address of a live server, e.g. http://127.0.0.1:8000
+        :type url: str
+        :param app: app driven through the flask test client
+        :type app: flask.Flask
+        """
+
+        self.url = url
+        self.app = app
+
+    def __str__(self):
+        return self.url if self.url is not None else "test-client"
+
+    def session(self):
+        """
+        :return: a new client, to be used from one thread
+        """
+
+        if self.app is not None:
+            return _TestClientSession(self.app)
+        return _HttpSession(self.url)
+
+
+def _resolve(entry, shared, local):
+    """
+    fills in the placeholders of a request
+
+    :return: method, path, body and headers ready to be sent
+    :rtype: tuple
+    """
+
+    path = entry["path"]
+    if "{active}" in path:
+        path = path.replace("{active}", str(shared.get("active", 1)))
+    if "{next}" in path:
+        if local.get("next"):
+            path = path.replace("{next}", local["next"])
+        else:
+            path = re.sub(r"[?&]cursor=\{next\}", "", path)
+
+    headers = dict()
+    for name, value in (entry.get("headers") or dict()).items():
+        if value == "{etag}":
+            if path not in local["etags"]:
+                continue
+            value = local["etags"][path]
+        headers[name] = value
+    return entry["method"], path, entry.get("body"), headers
+
+
+def run_requests(target, requests, clients=8, speed=0, active=None):
+    """
+    sends requests from concurrent clients and measures them
+
+    Clients take the requests in order from a shared queue, so a trace
+    recorded from a single client is replayed in order with clients=1.
+
+    :param target: server the load is sent to
+    :type target: Target
+    :param requests: requests in the trace format
+    :type requests: list
+    :param clients: number of concurrent clients
+    :type clients: int
+    :param speed: when above 0, requests are not sent before their "t"
+        relative to the first one, divided by speed
+    :type speed: float
+    :param active: id of the active story before the run
+    :type active: int
+    :return: report with throughput and latency per endpoint
+    :rtype: dict
+    """
+
+    shared = dict({"active": active}) if active else dict()
+    timings = dict()
+    statuses = dict()
+    errors = []
+    lock = threading.Lock()
+    index = iter(range(len(requests)))
+    first = requests[0].get("t") if len(requests) != 0 and speed > 0 else None
+
+    def client():
+        session = target.session()
+        local = dict({"next": None, "etags": dict()})
+        measured = []
+        try:
+            while True:
+                with lock:
+                    i = next(index, None)
+                if i is None:
+                    break
+                entry = requests[i]
+                if first is not None and entry.get("t") is not None:
+                    delay = (entry["t"] - first) / speed - (time.perf_counter() - started)
+                    if delay > 0:
+                        time.sleep(delay)
+
+                method, path, body, headers = _resolve(entry, shared, local)
+                start = time.perf_counter()
+                try:
+                    status, data, etag = session.request(method, path, body, headers)
+                except (OSError, httpclient.HTTPException) as err:
+                    LOG.debug(err)
+                    session.close()
+                    session = target.session()
+                    status, data, etag = 0, b"", None
+                elapsed = time.perf_counter() - start
+                measured.append((endpoint_name(method, path), elapsed, status))
+
+                if status in (200, 201):
+                    if path == "/add":
+                        shared["active"] = json.loads(data.decode("utf-8"))["id"]
+                    elif path.startswith("/stories?"):
+                        local["next"] = json.loads(data.decode("utf-8")).get("next")
+                    if etag is not None:
+                        local["etags"][path] = etag
+        finally:
+            session.close()
+            with lock:
+                for name, elapsed, status in measured:
+                    timings.setdefault(name, []).append(elapsed)
+                    counts = statuses.setdefault(name, dict())
+                    counts[str(status)] = counts.get(str(status), 0) + 1
+                errors.append(sum(1 for _, _, status in measured if status == 0 or status >= 500))
+
+    threads = [threading.Thread(target=client) for _ in range(clients)]
+    started = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - started
+
+    endpoints = dict()
+    for name, values in sorted(timings.items()):
+        endpoints[name] = _latency(values)
+        endpoints[name]["requests_per_second"] = round(len(values) / elapsed, 2) if elapsed else None
+        endpoints[name]["statuses"] = statuses[name]
+
+    return dict({
+        "target": str(target),
+        "clients": clients,
+        "requests": len(requests),
+        "failed": sum(errors),
+        "seconds": round(elapsed, 4),
+        "requests_per_second": round(len(requests) / elapsed, 2) if elapsed else None,
+        "endpoints": endpoints
+    })
+
+
+def _latency(timings):
+    """
+    :param timings: seconds per request
+    :type timings: list
+    :return: count with mean, p50, p95 and p99 latency in milliseconds
+    :rtype: dict
+    """
+
+    ordered = sorted(timings)
+
+    def pick(q):
+        return round(ordered[min(len(ordered) - 1, int(q * len(ordered)))] * 1e3, 3)
+
+    return dict({
+        "count": len(ordered),
+        "mean_ms": round(sum(ordered) / len(ordered) * 1e3, 3),
+        "p50_ms": pick(0.50),
+        "p95_ms": pick(0.95),
+        "p99_ms": pick(0.99)
+    })
+
+
+def _get_json(session, path):
+    status, data, _ = session.request("GET", path, None, dict())
+    if status != 200:
+        raise ValueError("GET {} answered {}".format(path, status))
+    return json.loads(data.decode("utf-8"))
+
+
+def last_story_id(target):
+    """
+    :param target: server to ask
+    :type target: Target
+    :return: highest story id, 0 if there are no stories
+    :rtype: int
+    """
+
+    session = target.session()
+    try:
+        page = _get_json(session, "/stories?limit=1&sort=created_at&order=desc")
+    finally:
+        session.close()
+    return page["results"][0]["id"] if page["count"] != 0 else 0
+
+
+def seed_stories(target, stories, extra_words=0, batch=10000):
+    """
+    fills the server with completed stories through /add/batch, e.g. before
+    measuring deep pagination
+
+    :param target: server to fill
+    :type target: Target
+    :param stories: number of stories to complete
+    :type stories: int
+    :param extra_words: words added after the completed stories
+    :type extra_words: int
+    :param batch: words per request
+    :type batch: int
+    """
+
+    words = ["s{}".format(i) for i in range(stories * STORY_WORDS + extra_words)]
+    session = target.session()
+    try:
+        for start in range(0, len(words), batch):
+            body = json.dumps(dict({"words": words[start:start + batch]}))
+            status, _, _ = session.request("POST", "/add/batch", body, dict({"Content-Type": "application/json"}))
+            if status != 200:
+                raise ValueError("POST /add/batch answered {}".format(status))
+    finally:
+        session.close()
+
+
+def check_stories(target, after_id=0):
+    """
+    checks the shape of every story created after the given id: all but
+    the newest must be completed, with a two word title and full
+    paragraphs up to the 0|6|9 boundary, and the newest must be a prefix
+    of such a story
+
+    :param target: server to check
+    :type target: Target
+    :param after_id: stories up to this id are skipped
+    :type after_id: int
+    :return: number of checked and completed stories with the ids of
+        stories that break the rules
+    :rtype: dict
+    """
+
+    last_para, last_sent = COMPLETE[1], COMPLETE[2] - 1
+    session = target.session()
+    invalid = []
+    completed = 0
+    try:
+        newest = last_story_id(target)
+        ids = list(range(after_id + 1, newest + 1)) if after_id else []
+        if not after_id:
+            # walk the listing, ids of deleted stories are never reused
+            path = "/stories?limit=1000&sort=created_at&order=asc"
+            while path is not None:
+                page = _get_json(session, path)
+                ids.extend(item["id"] for item in page["results"])
+                path = "/stories?limit=1000&sort=created_at&order=asc&cursor=" + page["next"] if page["next"] else None
+
+        for id in ids:
+            story = _get_json(session, "/stories/{}".format(id))
+            sentences = [
+                (para_idx, sent_idx, len(text.split()))
+                for para_idx, para in enumerate(story["paragraphs"])
+                for sent_idx, text in enumerate(para["sentences"])
+            ]
+            full = all(
+                count == SENTENCE_WORDS and sent_idx < PARAGRAPH_SENTENCES
+                for para_idx, sent_idx, count in sentences[:-1]
+            ) and all(len(para["sentences"]) == PARAGRAPH_SENTENCES for para in story["paragraphs"][:-1])
+            if id != newest:
+                valid = (
+                    full and len(story["title"].split()) == 2
+                    and sentences[-1] == (last_para, last_sent, SENTENCE_WORDS)
+                )
+                completed += 1
+            else:
+                valid = full and sentences[-1][2] <= SENTENCE_WORDS and len(story["title"].split()) <= 2
+            if not valid:
+                invalid.append(id)
+    finally:
+        session.close()
+
+    return dict({"checked": len(ids), "completed": completed, "invalid": invalid})
+
+
+def compare_reports(base, new, threshold=0.1):
+    """
+    compares two run reports endpoint by endpoint
+
+    A latency percentile that grew, or a throughput that shrank, by more
+    than the threshold is reported as a regression.
+
+    :param base: report of the reference run
+    :type base: dict
+    :param new: report of the run to be checked
+    :type new: dict
+    :param threshold: tolerated relative change, e.g. 0.1 for 10%
+    :type threshold: float
+    :return: relative changes per endpoint and the list of regressions
+    :rtype: dict
+    """
+
+    changes = dict()
+    regressions = []
+    for name in sorted(set(base["endpoints"]) | set(new["endpoints"])):
+        if name not in base["endpoints"] or name not in new["endpoints"]:
+            changes[name] = "only in {}".format("new" if name in new["endpoints"] else "base")
+            continue
+        changes[name] = dict()
+        for metric in ("p50_ms", "p95_ms", "p99_ms", "requests_per_second"):
+            before = base["endpoints"][name].get(metric)
+            after = new["endpoints"][name].get(metric)
+            if not before or after is None:
+                continue
+            change = (after - before) / before
+            changes[name][metric] = dict({"base": before, "new": after, "change": round(change, 4)})
+            worse = change < -threshold if metric == "requests_per_second" else change > threshold
+            if worse:
+                regressions.append("{} {}: {} -> {}".format(name, metric, before, after))
+
+    if new.get("failed", 0) > base.get("failed", 0):
+        regressions.append("failed requests: {} -> {}".format(base.get("failed", 0), new["failed"]))
+    if new.get("check") and new["check"]["invalid"]:
+        regressions.append("invalid stories: {}".format(new["check"]["invalid"][:20]))
+
+    return dict({"threshold": threshold, "endpoints": changes, "regressions": regressions})
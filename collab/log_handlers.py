@@ -0,0 +1,259 @@
+"""
+contains the handlers, formatter and filter of the logging pipeline
+
+With ``LOG_QUEUE`` enabled, the handlers configured in log_config.yaml are
+moved behind a ``QueueListener``. Request threads only put records in a
+queue, and a single thread per process writes them to the terminal and
+the log file.
+"""
+
+import os
+import copy
+import json
+import time
+import fcntl
+import queue
+import atexit
+import logging
+import threading
+import logging.handlers
+
+
+LOG = logging.getLogger(__name__)
+
+# listener of the current process, restarted in forked children
+_LISTENER = dict({"listener": None, "handlers": []})
+
+
+class JsonFormatter(logging.Formatter):
+    """
+    formats records as compact JSON lines
+    """
+
+    def format(self, record):
+        entry = dict({
+            "t": round(record.created, 3),
+            "level": record.levelname,
+            "logger": record.name,
+            "line": record.lineno,
+            "pid": record.process,
+            "msg": record.getMessage()
+        })
+        if record.exc_info:
+            entry["exc"] = self.formatException(record.exc_info)
+        elif record.exc_text:
+            entry["exc"] = record.exc_text
+        return json.dumps(entry, separators=(",", ":"))
+
+
+class SharedRotatingFileHandler(logging.handlers.RotatingFileHandler):
+    """
+    rotating file handler that can be shared by the workers of a server
+
+    The log is rotated once it grows beyond maxBytes or, with interval
+    set, once that many seconds have passed. The rotation happens under
+    a lock file. Workers that find the log rotated by another worker
+    reopen it instead of rotating it again.
+    """
+
+    def __init__(self, filename, mode="a", maxBytes=0, backupCount=0, encoding=None, delay=False, interval=0):
+        """
+        :param filename: path of the log file
+        :type filename: str
+        :param maxBytes: size at which the log is rotated, 0 to disable
+        :type maxBytes: int
+        :param backupCount: number of rotated files kept
+        :type backupCount: int
+        :param interval: seconds after which the log is rotated, 0 to disable
+        :type interval: int
+        """
+
+        super(SharedRotatingFileHandler, self).__init__(
+            filename, mode=mode, maxBytes=maxBytes, backupCount=backupCount, encoding=encoding, delay=delay
+        )
+        self.interval = int(interval)
+        self.rollover_at = self._next_rollover()
+
+    def _next_rollover(self):
+        if self.interval <= 0:
+            return None
+        return (int(time.time()) // self.interval + 1) * self.interval
+
+    def _rotated_elsewhere(self):
+        """
+        :return: whether the open file is no longer the one at the log path
+        :rtype: bool
+        """
+
+        if self.stream is None:
+            return False
+        try:
+            return os.stat(self.baseFilename).st_ino != os.fstat(self.stream.fileno()).st_ino
+        except FileNotFoundError:
+            return True
+
+    def shouldRollover(self, record):
+        if self.rollover_at is not None and time.time() >= self.rollover_at:
+            return True
+        if self.maxBytes > 0 and self.stream is not None:
+            if self.stream.tell() >= self.maxBytes:
+                return True
+        return False
+
+    def doRollover(self):
+        with open(self.baseFilename + ".lock", "w") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            if self._rotated_elsewhere():
+                self.stream.close()
+                self.stream = self._open()
+            else:
+                size = os.path.getsize(self.baseFilename) if os.path.exists(self.baseFilename) else 0
+                due = self.rollover_at is not None and time.time() >= self.rollover_at
+                if size > 0 and (due or (self.maxBytes > 0 and size >= self.maxBytes)):
+                    super(SharedRotatingFileHandler, self).doRollover()
+        self.rollover_at = self._next_rollover()
+
+
+class RateLimitFilter(logging.Filter):
+    """
+    lets through at most ``limit`` records of each warning or error per
+    ``period`` seconds, counting the rest
+
+    Records are told apart by logger, level and source line. The first
+    record let through after some were dropped says how many were dropped.
+    """
+
+    def __init__(self, limit=10, period=60.0, level=logging.WARNING):
+        """
+        :param limit: records let through per key and period, 0 to disable
+        :type limit: int
+        :param period: length of a period in seconds
+        :type period: float
+        :param level: lowest level that is limited
+        :type level: int
+        """
+
+        super(RateLimitFilter, self).__init__()
+        self.limit = int(limit)
+        self.period = float(period)
+        self.level = level
+        self._lock = threading.Lock()
+        self._seen = dict()
+
+    def filter(self, record):
+        if self.limit <= 0 or record.levelno < self.level or record.levelno >= logging.CRITICAL:
+            return True
+
+        key = (record.name, record.levelno, record.pathname, record.lineno)
+        now = record.created
+        with self._lock:
+            start, count, dropped = self._seen.get(key, (now, 0, 0))
+            if now - start >= self.period:
+                start, count = now, 0
+            if count >= self.limit:
+                self._seen[key] = (start, count, dropped + 1)
+                return False
+            self._seen[key] = (start, count + 1, 0)
+
+        if dropped:
+            record.msg = "{} [{} similar messages suppressed]".format(record.msg, dropped)
+        return True
+
+
+class _QueueHandler(logging.handlers.QueueHandler):
+    """
+    queue handler that keeps the traceback apart from the message, so that
+    formatters on the other side of the queue can still place it
+    """
+
+    def prepare(self, record):
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+        record.exc_info = None
+        record.stack_info = None
+        return record
+
+
+def limit_rate(logger, limit=10, period=60.0):
+    """
+    adds one shared RateLimitFilter to the handlers of a logger
+
+    :param logger: logger whose handlers are filtered, usually the root logger
+    :type logger: logging.Logger
+    :param limit: repeated warnings let through per period, 0 to disable
+    :type limit: int
+    :param period: seconds of a rate limit period
+    :type period: float
+    """
+
+    if int(limit) <= 0:
+        return
+    rate_filter = RateLimitFilter(limit, period)
+    for handler in logger.handlers:
+        handler.addFilter(rate_filter)
+
+
+def start_queue(logger):
+    """
+    moves the handlers of a logger behind a queue served by one thread
+
+    :param logger: logger whose handlers are moved, usually the root logger
+    :type logger: logging.Logger
+    """
+
+    stop_queue()
+    handlers = list(logger.handlers)
+    records = queue.SimpleQueue()
+    queue_handler = _QueueHandler(records)
+    for handler in handlers:
+        logger.removeHandler(handler)
+    logger.addHandler(queue_handler)
+
+    listener = logging.handlers.QueueListener(records, *handlers, respect_handler_level=True)
+    listener.start()
+    _LISTENER["listener"] = listener
+    _LISTENER["handlers"] = handlers
+
+
+def stop_queue():
+    """
+    writes the records left in the queue and stops its thread
+    """
+
+    listener = _LISTENER["listener"]
+    _LISTENER["listener"] = None
+    if listener is not None and listener._thread is not None:
+        listener.stop()
+
+
+def log_handlers():
+    """
+    :return: handlers that write the records, behind the queue if any
+    :rtype: list
+    """
+
+    if _LISTENER["listener"] is not None:
+        return list(_LISTENER["handlers"])
+    return list(logging.getLogger().handlers)
+
+
+def _restart_in_child():
+    # threads do not survive fork, e.g. gunicorn --preload; records still
+    # queued at the fork are the parent's to write
+    listener = _LISTENER["listener"]
+    if listener is not None:
+        try:
+            while True:
+                listener.queue.get_nowait()
+        except queue.Empty:
+            pass
+        listener._thread = None
+        listener.start()
+
+
+atexit.register(stop_queue)
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_restart_in_child)
@@ -0,0 +1,489 @@
+"""
+contains the request and database instrumentation exposed on /metrics
+
+Every process records its observations in memory, which only costs a lock
+and a few additions per observation. A background thread writes them every
+``METRICS_FLUSH_INTERVAL`` seconds to ``METRICS_DIR/<pid>.json``. /metrics
+merges the files of all workers into the Prometheus text format:
+
+    counters and histograms are summed over every process, including
+    workers that have exited, whose files are folded into archive.json
+    gauges are summed over the processes that are still running
+"""
+
+import os
+import json
+import time
+import glob
+import fcntl
+import bisect
+import logging
+import threading
+
+from contextlib import contextmanager
+
+
+LOG = logging.getLogger(__name__)
+
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+QUERY_BUCKETS = (0.00001, 0.000025, 0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.1, 1.0)
+SIZE_BUCKETS = (64, 256, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304)
+
+# name: (type, help, buckets)
+METRICS = dict({
+    "collab_http_request_duration_seconds": ("histogram", "Time spent serving requests.", LATENCY_BUCKETS),
+    "collab_http_request_size_bytes": ("histogram", "Size of request bodies.", SIZE_BUCKETS),
+    "collab_http_response_size_bytes": ("histogram", "Size of response bodies.", SIZE_BUCKETS),
+    "collab_db_query_duration_seconds": ("histogram", "Time spent executing an SQL statement.", QUERY_BUCKETS),
+    "collab_db_commit_duration_seconds": ("histogram", "Time spent committing a transaction.", QUERY_BUCKETS),
+    "collab_wordlog_fsync_duration_seconds": ("histogram", "Time spent in fsync of the word log.", QUERY_BUCKETS),
+    "collab_json_duration_seconds": ("histogram", "Time spent encoding or decoding JSON.", QUERY_BUCKETS),
+    "collab_compress_duration_seconds": ("histogram", "Time spent compressing response bodies.", QUERY_BUCKETS),
+    "collab_startup_duration_seconds": ("histogram", "Time spent creating the app, by phase.", LATENCY_BUCKETS),
+    "collab_db_connections_opened_total": ("counter", "Database connections opened.", None),
+    "collab_db_connections_closed_total": ("counter", "Database connections closed.", None),
+    "collab_db_pool_checkouts_total": ("counter", "Connections checked out of the pool.", None),
+    "collab_db_pool_waits_total": ("counter", "Checkouts that waited for a free connection.", None),
+    "collab_db_pool_wait_seconds_total": ("counter", "Time spent waiting for a free connection.", None),
+    "collab_db_pool_timeouts_total": ("counter", "Checkouts that timed out.", None),
+    "collab_db_pool_open_connections": ("gauge", "Open database connections.", None),
+    "collab_story_cache_hits_total": ("counter", "Story cache hits.", None),
+    "collab_story_cache_misses_total": ("counter", "Story cache misses.", None),
+    "collab_story_cache_entries": ("gauge", "Cached story responses.", None),
+    "collab_story_cache_compressed_hits_total": ("counter", "Story reads sent with a kept compressed body.", None),
+    "collab_idempotency_requests_total": ("counter", "Writes carrying an idempotency key, by outcome.", None),
+    "collab_writer_queue_depth": ("gauge", "Writes waiting in the writer queue.", None),
+    "collab_writer_rejected_total": ("counter", "Writes rejected because the writer queue was full.", None),
+    "collab_writer_transactions_total": ("counter", "Transactions committed by the writer.", None)
+})
+
+# label used for statements beyond the limit, so that dynamic SQL cannot
+# blow up the number of series
+_OTHER_STATEMENT = "other"
+_MAX_STATEMENTS = 256
+
+_REGISTRIES = dict()
+_REGISTRIES_LOCK = threading.Lock()
+# callables returning (name, labels, value) samples, registered once per app
+_COLLECTORS = []
+_SETTINGS = dict({"directory": None, "interval": 1.0})
+
+
+class Registry:
+    """
+    counters and histograms observed by the current process
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._histograms = dict()
+        self._counters = dict()
+        self._statements = dict()
+        self.flushing = False
+
+    def observe(self, name, value, labels=()):
+        """
+        records a value in a histogram
+
+        :param name: histogram in METRICS
+        :type name: str
+        :param value: observed value
+        :type value: float
+        :param labels: (name, value) pairs
+        :type labels: tuple
+        """
+
+        buckets = METRICS[name][2]
+        index = bisect.bisect_left(buckets, value)
+        key = (name, labels)
+        with self._lock:
+            entry = self._histograms.get(key)
+            if entry is None:
+                entry = [[0] * (len(buckets) + 1), 0.0]
+                self._histograms[key] = entry
+            entry[0][index] += 1
+            entry[1] += value
+
+    def inc(self, name, value=1, labels=()):
+        """
+        increments a counter
+
+        :param name: counter in METRICS
+        :type name: str
+        :param value: increment
+        :type value: float
+        :param labels: (name, value) pairs
+        :type labels: tuple
+        """
+
+        key = (name, labels)
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    @contextmanager
+    def time(self, name, labels=()):
+        """
+        context manager recording the time spent in its block in a histogram
+        """
+
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start, labels)
+
+    def statement(self, sql):
+        """
+        :param sql: SQL statement
+        :type sql: str
+        :return: label of the statement, its text on a single line
+            without comments
+        :rtype: str
+        """
+
+        label = self._statements.get(sql)
+        if label is None:
+            lines = [line.split("--", 1)[0] for line in sql.splitlines()]
+            label = " ".join(" ".join(lines).split())[:120]
+            if len(self._statements) >= _MAX_STATEMENTS:
+                return _OTHER_STATEMENT
+            self._statements[sql] = label
+        return label
+
+    def snapshot(self):
+        """
+        :return: observations of this process with the samples of every
+            collector, in the format of the metrics files
+        :rtype: dict
+        """
+
+        with self._lock:
+            histograms = [[name, list(labels), list(entry[0]), entry[1]] for (name, labels), entry in self._histograms.items()]
+            counters = [[name, list(labels), value] for (name, labels), value in self._counters.items()]
+
+        gauges = []
+        for collector in list(_COLLECTORS):
+            try:
+                samples = collector()
+            except Exception as err:
+                LOG.debug(err)
+                continue
+            for name, labels, value in samples:
+                entry = [name, list(labels), value]
+                (gauges if METRICS[name][0] == "gauge" else counters).append(entry)
+
+        return dict({
+            "pid": os.getpid(),
+            "histograms": histograms,
+            "counters": counters,
+            "gauges": gauges
+        })
+
+
+def get_registry():
+    """
+    returns the registry of the current process, creating it and its
+    flusher thread on first use
+
+    :return: metrics registry
+    :rtype: Registry
+    """
+
+    pid = os.getpid()
+    registry = _REGISTRIES.get(pid)
+    if registry is not None and (registry.flushing or _SETTINGS["directory"] is None):
+        return registry
+
+    with _REGISTRIES_LOCK:
+        registry = _REGISTRIES.get(pid)
+        if registry is None:
+            registry = Registry()
+            _REGISTRIES[pid] = registry
+        if not registry.flushing and _SETTINGS["directory"] is not None:
+            registry.flushing = True
+            threading.Thread(target=_flush_loop, args=(registry,), name="collab-metrics", daemon=True).start()
+    return registry
+
+
+def _flush_loop(registry):
+    while True:
+        time.sleep(_SETTINGS["interval"])
+        try:
+            flush(registry)
+        except OSError as err:
+            LOG.debug(err)
+            LOG.warning("unable to write metrics to %s", _SETTINGS["directory"])
+
+
+def flush(registry):
+    """
+    writes the snapshot of a registry to its file, atomically
+
+    :param registry: registry of the current process
+    :type registry: Registry
+    """
+
+    path = os.path.join(_SETTINGS["directory"], "{}.json".format(os.getpid()))
+    with open(path + ".tmp", "w", encoding="utf-8") as f:
+        json.dump(registry.snapshot(), f)
+    os.replace(path + ".tmp", path)
+
+
+def _alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def _as_snapshot(merged):
+    """
+    :param merged: samples keyed by (name, labels), as built by _merge
+    :type merged: dict
+    :return: the samples in the format of the metrics files, without gauges
+    :rtype: dict
+    """
+
+    return dict({
+        "pid": 0,
+        "histograms": [[name, list(labels), entry[0], entry[1]] for (name, labels), entry in merged["histograms"].items()],
+        "counters": [[name, list(labels), value] for (name, labels), value in merged["counters"].items()],
+        "gauges": []
+    })
+
+
+def _merge(total, snapshot, gauges=True):
+    """
+    adds a snapshot to merged samples keyed by (name, labels)
+    """
+
+    for name, labels, buckets, value in snapshot["histograms"]:
+        entry = total["histograms"].setdefault((name, tuple(map(tuple, labels))), [[0] * len(buckets), 0.0])
+        entry[0] = [a + b for a, b in zip(entry[0], buckets)]
+        entry[1] += value
+    for name, labels, value in snapshot["counters"]:
+        key = (name, tuple(map(tuple, labels)))
+        total["counters"][key] = total["counters"].get(key, 0) + value
+    if gauges:
+        for name, labels, value in snapshot["gauges"]:
+            key = (name, tuple(map(tuple, labels)))
+            total["gauges"][key] = total["gauges"].get(key, 0) + value
+
+
+def aggregate():
+    """
+    merges the metrics files of every process, folding the files of exited
+    processes into archive.json
+
+    :return: merged histograms, counters and gauges
+    :rtype: dict
+    """
+
+    directory = _SETTINGS["directory"]
+    flush(get_registry())
+
+    total = dict({"histograms": dict(), "counters": dict(), "gauges": dict()})
+    with open(os.path.join(directory, "archive.lock"), "w") as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        archive_path = os.path.join(directory, "archive.json")
+        archive = dict({"histograms": dict(), "counters": dict(), "gauges": dict()})
+        if os.path.exists(archive_path):
+            with open(archive_path, encoding="utf-8") as f:
+                _merge(archive, json.load(f), gauges=False)
+
+        exited = []
+        for path in glob.glob(os.path.join(directory, "[0-9]*.json")):
+            try:
+                with open(path, encoding="utf-8") as f:
+                    snapshot = json.load(f)
+            except (OSError, ValueError) as err:
+                LOG.debug(err)
+                continue
+            if _alive(snapshot["pid"]):
+                _merge(total, snapshot)
+            else:
+                _merge(archive, snapshot, gauges=False)
+                exited.append(path)
+
+        if exited:
+            with open(archive_path + ".tmp", "w", encoding="utf-8") as f:
+                json.dump(_as_snapshot(archive), f)
+            os.replace(archive_path + ".tmp", archive_path)
+            for path in exited:
+                os.unlink(path)
+
+    _merge(total, _as_snapshot(archive), gauges=False)
+    return total
+
+
+def _labels(labels, extra=()):
+    pairs = list(labels) + list(extra)
+    if not pairs:
+        return ""
+    return "{" + ",".join(
+        '{}="{}"'.format(name, str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n"))
+        for name, value in pairs
+    ) + "}"
+
+
+def render(total):
+    """
+    formats merged metrics in the Prometheus text exposition format
+
+    :param total: merged metrics as returned by aggregate
+    :type total: dict
+    :return: exposition text
+    :rtype: str
+    """
+
+    lines = []
+    for name, (kind, help_text, buckets) in METRICS.items():
+        if kind == "histogram":
+            series = sorted((labels, entry) for (key, labels), entry in total["histograms"].items() if key == name)
+        else:
+            source = total["counters"] if kind == "counter" else total["gauges"]
+            series = sorted((labels, value) for (key, labels), value in source.items() if key == name)
+        if not series:
+            continue
+
+        lines.append("# HELP {} {}".format(name, help_text))
+        lines.append("# TYPE {} {}".format(name, kind))
+        for labels, value in series:
+            if kind != "histogram":
+                lines.append("{}{} {}".format(name, _labels(labels), value))
+                continue
+            counts, total_sum = value
+            cumulative = 0
+            for bound, count in zip(list(buckets) + ["+Inf"], counts):
+                cumulative += count
+                lines.append("{}_bucket{} {}".format(name, _labels(labels, [("le", bound)]), cumulative))
+            lines.append("{}_sum{} {}".format(name, _labels(labels), total_sum))
+            lines.append("{}_count{} {}".format(name, _labels(labels), cumulative))
+    return "\n".join(lines) + "\n"
+
+
+def add_collector(collector):
+    """
+    registers a callable returning (name, labels, value) samples read at
+    every flush, e.g. from the connection pool
+
+    :param collector: sample source
+    :type collector: callable
+    """
+
+    _COLLECTORS.append(collector)
+
+
+def configure(directory, interval=1.0):
+    """
+    sets the directory shared by the workers and the flush interval
+
+    :param directory: directory of the metrics files, created if missing
+    :type directory: str
+    :param interval: seconds between flushes
+    :type interval: float
+    """
+
+    os.makedirs(directory, exist_ok=True)
+    _SETTINGS["directory"] = directory
+    _SETTINGS["interval"] = float(interval)
+
+
+# labels of collab_json_duration_seconds
+JSON_ENCODE = (("op", "encode"),)
+JSON_DECODE = (("op", "decode"),)
+
+
+def _component_samples(app):
+    """
+    reads the counters kept by the connection pool, the story cache and
+    the writer of the current process
+
+    :param app: flask app
+    :type app: flask.Flask
+    :return: (name, labels, value) samples
+    :rtype: list
+    """
+
+    from .pool import get_pool
+    from .cache import get_story_cache
+    from .storage import get_storage
+    from .writer import get_writer_client
+
+    storage = get_storage(app.config)
+    pool = storage.pool_stats() if storage is not None else get_pool(app.config).stats()
+    cache = get_story_cache(app.config).stats()
+    samples = [
+        ("collab_db_connections_opened_total", (), pool["opened"]),
+        ("collab_db_connections_closed_total", (), pool["closed"]),
+        ("collab_db_pool_checkouts_total", (), pool["checkouts"]),
+        ("collab_db_pool_waits_total", (), pool["waits"]),
+        ("collab_db_pool_wait_seconds_total", (), pool["wait_seconds"]),
+        ("collab_db_pool_timeouts_total", (), pool["timeouts"]),
+        ("collab_db_pool_open_connections", (), pool["open"]),
+        ("collab_story_cache_hits_total", (), cache["hits"]),
+        ("collab_story_cache_misses_total", (), cache["misses"]),
+        ("collab_story_cache_entries", (), cache["entries"]),
+        ("collab_story_cache_compressed_hits_total", (), cache["encoded_hits"])
+    ]
+    if app.config.get('WRITER') and storage is None:
+        writer = get_writer_client(app).writer
+        if writer is not None:
+            stats = writer.stats()
+            samples.extend([
+                ("collab_writer_queue_depth", (), stats["depth"]),
+                ("collab_writer_rejected_total", (), stats["rejected"]),
+                ("collab_writer_transactions_total", (), stats["transactions"])
+            ])
+    return samples
+
+
+def _before_request():
+    from flask import current_app, g, request
+    from .profiler import SamplingProfiler
+
+    g.metrics_start = time.perf_counter()
+    if current_app.config.get('PROFILE_REQUESTS') and request.args.get("profile") == "1":
+        g.profiler = SamplingProfiler(threading.get_ident(), current_app.config.get('PROFILE_INTERVAL', 0.001)).start()
+
+
+def _after_request(response):
+    from flask import current_app, g, request
+    from .profiler import dump_stacks
+
+    endpoint = request.url_rule.rule if request.url_rule is not None else "unmatched"
+    registry = get_registry()
+    registry.observe(
+        "collab_http_request_duration_seconds",
+        time.perf_counter() - g.metrics_start,
+        (("endpoint", endpoint), ("method", request.method), ("status", str(response.status_code)))
+    )
+    registry.observe("collab_http_request_size_bytes", request.content_length or 0, (("endpoint", endpoint),))
+    if response.content_length is not None:
+        registry.observe("collab_http_response_size_bytes", response.content_length, (("endpoint", endpoint),))
+
+    profiler = g.pop("profiler", None)
+    if profiler is not None:
+        path = dump_stacks(profiler.stop(), current_app.config['PROFILE_DIR'], request.method + endpoint)
+        response.headers["X-Profile"] = os.path.basename(path)
+    return response
+
+
+def init_app(app):
+    """
+    times every request of the app and collects the counters of its
+    components, if METRICS is enabled
+
+    :param app: flask app
+    :type app: flask.Flask
+    """
+
+    if not app.config.get('METRICS'):
+        return
+    configure(app.config['METRICS_DIR'], app.config.get('METRICS_FLUSH_INTERVAL', 1.0))
+    add_collector(lambda: _component_samples(app))
+    app.before_request(_before_request)
+    app.after_request(_after_request)
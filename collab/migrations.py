@@ -0,0 +1,223 @@
+"""
+contains the versioned schema migrations of the database
+
+The schema version is kept in SQLite's ``user_version`` pragma. The
+configured database is migrated when the app starts; other database files
+can be migrated in place with:
+
+    flask migrate-db path/to/collab.sql
+"""
+
+import os
+import json
+import sqlite3
+import logging
+
+import click
+
+
+LOG = logging.getLogger(__name__)
+
+# version of the schema described by init.sql
+SCHEMA_VERSION = 6
+
+INIT_SQL = os.path.join(os.path.dirname(os.path.realpath(__file__)), "init.sql")
+
+
+def split_statements(script):
+    """
+    splits an SQL script into complete statements, so that it can be run
+    inside a transaction (executescript always commits first)
+
+    :param script: SQL script
+    :type script: str
+    :return: statements
+    :rtype: list
+    """
+
+    statements = []
+    pending = ""
+    for line in script.splitlines(keepends=True):
+        pending += line
+        if sqlite3.complete_statement(pending):
+            statements.append(pending.strip())
+            pending = ""
+    if pending.strip():
+        statements.append(pending.strip())
+    return statements
+
+
+def schema_version(conn):
+    """
+    :param conn: connection to the database
+    :type conn: sqlite3.Connection
+    :return: schema version stored in the database
+    :rtype: int
+    """
+
+    return conn.execute("PRAGMA user_version;").fetchone()[0]
+
+
+def _columns(conn, table):
+    """
+    :param conn: connection to the database
+    :type conn: sqlite3.Connection
+    :param table: name of the table
+    :type table: str
+    :return: column names of the table, empty if it does not exist
+    :rtype: list
+    """
+
+    return [row[1] for row in conn.execute("PRAGMA table_info({});".format(table))]
+
+
+def _to_v1(conn, statements):
+    """
+    moves the stringified paragraphs JSON of every story into the sentences
+    table and drops the paragraphs column
+
+    :param conn: connection inside an open transaction
+    :type conn: sqlite3.Connection
+    :param statements: statements of init.sql
+    :type statements: list
+    """
+
+    conn.execute("DROP TRIGGER IF EXISTS created_to_updated;")
+    conn.execute("DROP TRIGGER IF EXISTS update_modifying;")
+    conn.execute("ALTER TABLE stories RENAME TO stories_legacy;")
+    for statement in statements:
+        conn.execute(statement)
+
+    conn.execute('''
+    INSERT INTO stories (id, created_at, updated_at, modifying, title)
+    SELECT id, created_at, updated_at, modifying, title FROM stories_legacy ORDER BY id;
+    ''')
+
+    migrated = 0
+    insert = conn.cursor()
+    for story_id, paragraphs in conn.execute("SELECT id, paragraphs FROM stories_legacy ORDER BY id;"):
+        paragraphs = json.loads(paragraphs) if paragraphs else []
+        insert.executemany(
+            "INSERT OR REPLACE INTO sentences (story_id, para_idx, sent_idx, text, word_count) VALUES (?, ?, ?, ?, ?);",
+            [
+                (story_id, para_idx, sent_idx, text, len(text.split()))
+                for para_idx, para in enumerate(paragraphs)
+                for sent_idx, text in enumerate(para["sentences"])
+            ]
+        )
+        migrated += 1
+
+    conn.execute('''
+    UPDATE sqlite_sequence
+    SET seq = (SELECT seq FROM sqlite_sequence WHERE name = 'stories_legacy')
+    WHERE name = 'stories' AND EXISTS (SELECT 1 FROM sqlite_sequence WHERE name = 'stories_legacy');
+    ''')
+    conn.execute("DROP TABLE stories_legacy;")
+    LOG.info("migrated %s stories to the sentences table", migrated)
+
+
+def _count_words(conn):
+    """
+    fills the words column of every story from its title and sentences
+
+    :param conn: connection inside an open transaction
+    :type conn: sqlite3.Connection
+    """
+
+    conn.execute('''
+    UPDATE stories
+    SET words = length(title) - length(replace(title, ' ', '')) + 1
+        + COALESCE((SELECT SUM(word_count) FROM sentences WHERE story_id = stories.id), 0);
+    ''')
+
+
+def _count_stats(conn):
+    """
+    fills story_totals and story_daily from the stories table, for
+    databases written before the statistics triggers existed
+
+    Earlier words of a story are counted on the day it was last written
+    to, as the days they were added on are not known.
+
+    :param conn: connection inside an open transaction
+    :type conn: sqlite3.Connection
+    """
+
+    conn.execute('''
+    UPDATE story_totals
+    SET stories = (SELECT COUNT(*) FROM stories),
+        completed = (SELECT COUNT(*) FROM stories WHERE modifying = 'no'),
+        words = (SELECT COALESCE(SUM(words), 0) FROM stories)
+    WHERE id = 0;
+    ''')
+    conn.execute("DELETE FROM story_daily;")
+    conn.execute('''
+    INSERT INTO story_daily (day, started, completed, words)
+    SELECT day, SUM(started), SUM(completed), SUM(words) FROM (
+        SELECT date(created_at) AS day, 1 AS started, 0 AS completed, 0 AS words FROM stories
+        UNION ALL
+        SELECT date(COALESCE(updated_at, created_at)), 0, modifying = 'no', words FROM stories
+    )
+    GROUP BY day;
+    ''')
+
+
+def migrate(conn, script):
+    """
+    brings the database to SCHEMA_VERSION in a single transaction
+
+    :param conn: connection to the database
+    :type conn: sqlite3.Connection
+    :param script: contents of init.sql
+    :type script: str
+    :return: schema version before the migration
+    :rtype: int
+    """
+
+    statements = split_statements(script)
+    version = schema_version(conn)
+
+    conn.execute("BEGIN IMMEDIATE;")
+    try:
+        columns = _columns(conn, "stories")
+        if version < 1 and "paragraphs" in columns:
+            LOG.warning("migrating database from schema version %s to 1...", version)
+            _to_v1(conn, statements)
+        else:
+            if columns and "words" not in columns:
+                conn.execute("ALTER TABLE stories ADD COLUMN words INTEGER NOT NULL DEFAULT 1;")
+            if columns and "room" not in columns:
+                conn.execute("ALTER TABLE stories ADD COLUMN room TEXT NOT NULL DEFAULT '';")
+            if columns and "archived" not in columns:
+                conn.execute("ALTER TABLE stories ADD COLUMN archived INTEGER NOT NULL DEFAULT 0;")
+            # version 2 only adds indexes, which init.sql creates if missing
+            for statement in statements:
+                conn.execute(statement)
+        if columns and version < 3:
+            _count_words(conn)
+        if columns and version < 6:
+            _count_stats(conn)
+        conn.execute("PRAGMA user_version = {};".format(SCHEMA_VERSION))
+        conn.commit()
+    except sqlite3.Error:
+        conn.rollback()
+        raise
+    return version
+
+
+@click.command("migrate-db")
+@click.argument("database", type=click.Path(exists=True, dir_okay=False))
+def migrate_command(database):
+    """
+    migrates the SQLite database file DATABASE to the current schema
+    """
+
+    with open(INIT_SQL, encoding="utf-8") as f:
+        script = f.read()
+
+    conn = sqlite3.connect(database)
+    try:
+        before = migrate(conn, script)
+    finally:
+        conn.close()
+    click.echo("{}: schema version {} -> {}".format(database, before, SCHEMA_VERSION))
@@ -0,0 +1,126 @@
+-- schema of the postgres storage backend, see collab/postgres.py
+CREATE TABLE IF NOT EXISTS stories (
+    id BIGSERIAL PRIMARY KEY,
+    -- UTC, to the second like SQLite's datetime('now')
+    created_at TIMESTAMP NOT NULL DEFAULT date_trunc('second', now() AT TIME ZONE 'utc'),
+    updated_at TIMESTAMP NOT NULL DEFAULT date_trunc('second', now() AT TIME ZONE 'utc'),
+    modifying TEXT NOT NULL DEFAULT '1|0|0',  /* cursor of the next word, "no" once completed */
+    title TEXT NOT NULL,
+    words INTEGER NOT NULL DEFAULT 1,  /* number of words, title included */
+    room TEXT NOT NULL DEFAULT '',  /* stream the story is written in, '' for the default one */
+    -- paragraphs in the API format, every story starts with one empty sentence
+    paragraphs JSONB NOT NULL DEFAULT '[{"sentences": [""]}]'
+);
+
+-- listing indexes, the id breaks ties so pages can be fetched by keyset;
+-- titles sort by byte value, as they do in SQLite
+CREATE INDEX IF NOT EXISTS stories_created_at ON stories (created_at, id);
+CREATE INDEX IF NOT EXISTS stories_updated_at ON stories (updated_at, id);
+CREATE INDEX IF NOT EXISTS stories_title ON stories (title COLLATE "C", id);
+
+-- added after the first release of this schema
+ALTER TABLE stories ADD COLUMN IF NOT EXISTS room TEXT NOT NULL DEFAULT '';
+
+-- at most one story of each room is being written at a time
+CREATE UNIQUE INDEX IF NOT EXISTS stories_room_active ON stories (room) WHERE modifying <> 'no';
+DROP INDEX IF EXISTS stories_active;
+
+-- running totals of stories and the same per UTC day, kept by the
+-- story_stats trigger so that /stats never scans stories; rows are split
+-- into shards by story id, so that writers of different rooms do not wait
+-- on the same counter row
+CREATE TABLE IF NOT EXISTS story_totals (
+    shard SMALLINT PRIMARY KEY,
+    stories BIGINT NOT NULL DEFAULT 0,
+    completed BIGINT NOT NULL DEFAULT 0,
+    words BIGINT NOT NULL DEFAULT 0
+);
+CREATE TABLE IF NOT EXISTS story_daily (
+    day DATE NOT NULL,
+    shard SMALLINT NOT NULL,
+    started BIGINT NOT NULL DEFAULT 0,
+    completed BIGINT NOT NULL DEFAULT 0,
+    words BIGINT NOT NULL DEFAULT 0,
+    PRIMARY KEY (day, shard)
+);
+
+CREATE OR REPLACE FUNCTION story_stats_count(
+    in_shard SMALLINT, in_day DATE, in_started BIGINT, in_completed BIGINT, in_words BIGINT
+) RETURNS VOID AS $$
+BEGIN
+    INSERT INTO story_totals AS t (shard, stories, completed, words)
+    VALUES (in_shard, in_started, in_completed, in_words)
+    ON CONFLICT (shard) DO UPDATE
+    SET stories = t.stories + excluded.stories, completed = t.completed + excluded.completed,
+        words = t.words + excluded.words;
+    IF in_day IS NOT NULL THEN
+        INSERT INTO story_daily AS d (day, shard, started, completed, words)
+        VALUES (in_day, in_shard, in_started, in_completed, in_words)
+        ON CONFLICT (day, shard) DO UPDATE
+        SET started = d.started + excluded.started, completed = d.completed + excluded.completed,
+            words = d.words + excluded.words;
+    END IF;
+END;
+$$ LANGUAGE plpgsql;
+
+-- a new or imported story counts as started on the day it was created,
+-- its words and completion on the day it was last written to
+CREATE OR REPLACE FUNCTION story_stats() RETURNS TRIGGER AS $$
+BEGIN
+    IF TG_OP = 'INSERT' THEN
+        PERFORM story_stats_count((NEW.id % 16)::SMALLINT, NEW.created_at::DATE, 1, 0, 0);
+        PERFORM story_stats_count(
+            (NEW.id % 16)::SMALLINT, NEW.updated_at::DATE, 0, (NEW.modifying = 'no')::INT, NEW.words
+        );
+    ELSIF TG_OP = 'UPDATE' THEN
+        IF NEW.words <> OLD.words OR (NEW.modifying = 'no') <> (OLD.modifying = 'no') THEN
+            PERFORM story_stats_count(
+                (NEW.id % 16)::SMALLINT, NEW.updated_at::DATE, 0,
+                (NEW.modifying = 'no')::INT - (OLD.modifying = 'no')::INT, NEW.words - OLD.words
+            );
+        END IF;
+    ELSE
+        -- stories are never deleted by the app, the totals stay right if they are
+        PERFORM story_stats_count(
+            (OLD.id % 16)::SMALLINT, NULL, -1, -(OLD.modifying = 'no')::INT, -OLD.words
+        );
+    END IF;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+-- the first run counts the existing stories; the trigger is created first,
+-- its lock on stories keeps writers out until the counts are committed
+DO $$
+BEGIN
+    IF NOT EXISTS (SELECT 1 FROM pg_trigger WHERE tgname = 'story_stats' AND tgrelid = 'stories'::regclass) THEN
+        CREATE TRIGGER story_stats AFTER INSERT OR DELETE OR UPDATE OF words, modifying ON stories
+        FOR EACH ROW EXECUTE FUNCTION story_stats();
+        DELETE FROM story_totals;
+        DELETE FROM story_daily;
+        INSERT INTO story_totals (shard, stories, completed, words)
+        SELECT id % 16, COUNT(*), COUNT(*) FILTER (WHERE modifying = 'no'), SUM(words)
+        FROM stories GROUP BY 1;
+        INSERT INTO story_daily (day, shard, started, completed, words)
+        SELECT day, shard, SUM(started), SUM(completed), SUM(words) FROM (
+            SELECT created_at::DATE AS day, id % 16 AS shard, 1 AS started, 0 AS completed, 0 AS words FROM stories
+            UNION ALL
+            SELECT updated_at::DATE, id % 16, 0, (modifying = 'no')::INT, words FROM stories
+        ) AS counts
+        GROUP BY day, shard;
+    END IF;
+END;
+$$;
+
+-- idempotency keys of /add and /add/batch, see collab/idempotency.py
+CREATE TABLE IF NOT EXISTS idempotency_keys (
+    key TEXT PRIMARY KEY,
+    fingerprint TEXT NOT NULL,  /* hash of the request */
+    created_at DOUBLE PRECISION NOT NULL,  /* seconds since the epoch */
+    status INTEGER,  /* NULL while the request runs */
+    body BYTEA
+);
+CREATE INDEX IF NOT EXISTS idempotency_keys_created_at ON idempotency_keys (created_at);
+
+-- version of this script, see SCHEMA_COMMENT in collab/postgres.py
+COMMENT ON TABLE stories IS 'collab schema 4';
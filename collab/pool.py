@@ -0,0 +1,332 @@
+"""
+contains a thread-safe, per-process pool of tuned SQLite connections
+"""
+
+import os
+import time
+import queue
+import sqlite3
+import logging
+import threading
+
+from contextlib import contextmanager
+
+from .metrics import get_registry
+
+
+LOG = logging.getLogger(__name__)
+
+# one pool per (process, database); a forked worker never reuses its parent's pool
+_POOLS = dict()
+_POOLS_LOCK = threading.Lock()
+
+
+class PoolTimeout(sqlite3.OperationalError):
+    """
+    raised when no connection could be checked out within the pool timeout
+    """
+
+
+class TimedCursor(sqlite3.Cursor):
+    """
+    cursor recording the time of every statement in the metrics registry
+    """
+
+    def execute(self, sql, parameters=()):
+        registry = get_registry()
+        start = time.perf_counter()
+        try:
+            return super(TimedCursor, self).execute(sql, parameters)
+        finally:
+            registry.observe(
+                "collab_db_query_duration_seconds",
+                time.perf_counter() - start,
+                (("statement", registry.statement(sql)),)
+            )
+
+    def executemany(self, sql, seq_of_parameters):
+        registry = get_registry()
+        start = time.perf_counter()
+        try:
+            return super(TimedCursor, self).executemany(sql, seq_of_parameters)
+        finally:
+            registry.observe(
+                "collab_db_query_duration_seconds",
+                time.perf_counter() - start,
+                (("statement", registry.statement(sql)),)
+            )
+
+
+class TimedConnection(sqlite3.Connection):
+    """
+    connection handing out TimedCursor and timing commits
+    """
+
+    def cursor(self, factory=TimedCursor):
+        return super(TimedConnection, self).cursor(factory)
+
+    def execute(self, sql, parameters=()):
+        return self.cursor().execute(sql, parameters)
+
+    def executemany(self, sql, seq_of_parameters):
+        return self.cursor().executemany(sql, seq_of_parameters)
+
+    def commit(self):
+        start = time.perf_counter()
+        try:
+            super(TimedConnection, self).commit()
+        finally:
+            get_registry().observe("collab_db_commit_duration_seconds", time.perf_counter() - start)
+
+
+class ConnectionPool:
+    """
+    keeps a bounded set of open SQLite connections that are handed out to
+    request threads and returned after use
+
+    Connections are tuned once when they are opened (WAL journal,
+    ``synchronous=NORMAL``, mmap and page cache sizes) and keep their
+    prepared statement cache between checkouts. Pools of other databases
+    override _open, _in_transaction and errors.
+    """
+
+    # errors of the database driver
+    errors = (sqlite3.Error,)
+
+    def __init__(self, database, size=8, timeout=10.0, mmap_size=0, cache_size=-2000, cached_statements=128,
+                 timed=False):
+        """
+        :param database: path of the SQLite database file
+        :type database: str
+        :param size: maximum number of open connections
+        :type size: int
+        :param timeout: seconds to wait for a free connection
+        :type timeout: float
+        :param mmap_size: bytes of the database file to memory map
+        :type mmap_size: int
+        :param cache_size: SQLite page cache size (negative values are KiB)
+        :type cache_size: int
+        :param cached_statements: prepared statements kept per connection
+        :type cached_statements: int
+        :param timed: record statement and commit times in the metrics registry
+        :type timed: bool
+        """
+
+        self.database = database
+        self.size = int(size)
+        self.timeout = float(timeout)
+        self.mmap_size = int(mmap_size)
+        self.cache_size = int(cache_size)
+        self.cached_statements = int(cached_statements)
+        self.timed = bool(timed)
+        self.pid = os.getpid()
+
+        self._idle = queue.LifoQueue()
+        self._lock = threading.Lock()
+        self._opened = 0
+        self._metrics = dict({
+            "checkouts": 0,
+            "hits": 0,
+            "misses": 0,
+            "waits": 0,
+            "wait_seconds": 0.0,
+            "timeouts": 0,
+            "opened": 0,
+            "closed": 0
+        })
+
+    def _open(self):
+        """
+        opens and tunes a new connection
+
+        :return: new connection
+        :rtype: sqlite3.Connection
+        """
+
+        conn = sqlite3.connect(
+            self.database,
+            detect_types=sqlite3.PARSE_DECLTYPES,
+            timeout=self.timeout,
+            check_same_thread=False,
+            cached_statements=self.cached_statements,
+            factory=TimedConnection if self.timed else sqlite3.Connection
+        )
+        conn.row_factory = sqlite3.Row
+        conn.execute("PRAGMA journal_mode=WAL;")
+        conn.execute("PRAGMA synchronous=NORMAL;")
+        conn.execute("PRAGMA mmap_size={};".format(self.mmap_size))
+        conn.execute("PRAGMA cache_size={};".format(self.cache_size))
+        conn.execute("PRAGMA temp_store=MEMORY;")
+        LOG.debug("SUCCESS: DB connection established!")
+        return conn
+
+    @staticmethod
+    def _in_transaction(conn):
+        """
+        :param conn: connection obtained from acquire
+        :type conn: sqlite3.Connection
+        :return: whether a transaction is left open on the connection
+        :rtype: bool
+        """
+
+        return conn.in_transaction
+
+    def acquire(self):
+        """
+        checks out a connection, opening a new one while below the size limit
+
+        :raises PoolTimeout: no connection became free within the timeout
+        :return: connection for exclusive use until released
+        :rtype: sqlite3.Connection
+        """
+
+        try:
+            conn = self._idle.get_nowait()
+            with self._lock:
+                self._metrics["checkouts"] += 1
+                self._metrics["hits"] += 1
+            return conn
+        except queue.Empty:
+            pass
+
+        with self._lock:
+            can_open = self._opened < self.size
+            if can_open:
+                self._opened += 1
+                self._metrics["checkouts"] += 1
+                self._metrics["misses"] += 1
+                self._metrics["opened"] += 1
+
+        if can_open:
+            try:
+                return self._open()
+            except self.errors:
+                with self._lock:
+                    self._opened -= 1
+                raise
+
+        start = time.perf_counter()
+        try:
+            conn = self._idle.get(timeout=self.timeout)
+        except queue.Empty:
+            with self._lock:
+                self._metrics["timeouts"] += 1
+            raise PoolTimeout("no database connection available after {}s".format(self.timeout))
+        waited = time.perf_counter() - start
+        with self._lock:
+            self._metrics["checkouts"] += 1
+            self._metrics["hits"] += 1
+            self._metrics["waits"] += 1
+            self._metrics["wait_seconds"] += waited
+        return conn
+
+    def release(self, conn):
+        """
+        returns a connection to the pool, rolling back any open transaction
+
+        :param conn: connection obtained from acquire
+        :type conn: sqlite3.Connection
+        """
+
+        try:
+            if self._in_transaction(conn):
+                conn.rollback()
+        except self.errors as err:
+            LOG.debug(err)
+            self.discard(conn)
+            return
+        self._idle.put(conn)
+
+    def discard(self, conn):
+        """
+        closes a connection instead of returning it to the pool
+
+        :param conn: connection obtained from acquire
+        :type conn: sqlite3.Connection
+        """
+
+        with self._lock:
+            self._opened -= 1
+            self._metrics["closed"] += 1
+        try:
+            conn.close()
+        except self.errors as err:
+            LOG.debug(err)
+        LOG.debug("SUCCESS: DB connection closed!")
+
+    @contextmanager
+    def connection(self):
+        """
+        context manager that checks out a connection and releases it when
+        the context ends
+        """
+
+        conn = self.acquire()
+        try:
+            yield conn
+        finally:
+            self.release(conn)
+
+    def close(self):
+        """
+        closes every idle connection held by the pool
+        """
+
+        while True:
+            try:
+                conn = self._idle.get_nowait()
+            except queue.Empty:
+                break
+            self.discard(conn)
+
+    def stats(self):
+        """
+        reports pool usage counters
+
+        :return: counters along with the current number of open and idle connections
+        :rtype: dict
+        """
+
+        with self._lock:
+            stats = dict(self._metrics)
+            stats["open"] = self._opened
+        stats["idle"] = self._idle.qsize()
+        stats["size"] = self.size
+        return stats
+
+
+def get_pool(config):
+    """
+    returns the connection pool of the current process for the configured
+    database, creating it on first use
+
+    :param config: flask app configuration
+    :type config: flask.Config
+    :return: connection pool
+    :rtype: ConnectionPool
+    """
+
+    key = (os.getpid(), config['DATABASE'])
+    pool = _POOLS.get(key)
+    if pool is not None:
+        return pool
+
+    with _POOLS_LOCK:
+        pool = _POOLS.get(key)
+        if pool is None:
+            # drop pools inherited from a parent process without touching
+            # their connections, which belong to the parent
+            for stale in [k for k in _POOLS if k[0] != key[0]]:
+                _POOLS.pop(stale)
+            pool = ConnectionPool(
+                config['DATABASE'],
+                size=config.get('DB_POOL_SIZE', 8),
+                timeout=config.get('DB_POOL_TIMEOUT', 10.0),
+                mmap_size=config.get('DB_MMAP_SIZE', 0),
+                cache_size=config.get('DB_CACHE_SIZE', -2000),
+                cached_statements=config.get('DB_STATEMENT_CACHE', 128),
+                timed=config.get('METRICS', False) and config.get('METRICS_DB_TIMING', False)
+            )
+            _POOLS[key] = pool
+            LOG.debug("initialized DB connection pool (size=%s) for process %s", pool.size, key[0])
+    return pool
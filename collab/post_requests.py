@@ -3,27 +3,73 @@ contains all methods for endpoints that use POST method
 """
 
 import logging
-import json
 
-from flask import Blueprint, request, Response
+from flask import Blueprint, current_app, request, Response
 
 from .db_hanlder import DBHandler
+from .helpers import resolve_room
+from .exceptions import WriterBusy, WriterUnavailable
+from .idempotency import idempotent, outcome_unknown
+from . import metrics, serialize
 
 LOG = logging.getLogger(__name__)
 
 add = Blueprint('add_story', __name__, url_prefix='/add')
 
+def _room(data):
+    """
+    room of the story the words of the current request go to, sent as
+    "room" in the JSON body or the query string
+
+    :param data: decoded JSON body, None if there is none
+    :type data: dict
+    :raises ValueError: the room is not accepted
+    :return: room, see helpers.resolve_room
+    :rtype: str
+    """
+
+    key = data.get("room") if isinstance(data, dict) and "room" in data else request.args.get("room")
+    return resolve_room(key)
+
+def _writer_busy(err):
+    """
+    response telling the client to retry a write the writer could not take
+
+    :param err: error raised by the writer client
+    :type err: WriterBusy or WriterUnavailable
+    :return: 503 response with a Retry-After header
+    :rtype: flask.Response
+    """
+
+    if isinstance(err, WriterBusy):
+        response_dict = dict({"error": "too many pending writes", "queue_depth": err.depth})
+    else:
+        response_dict = dict({"error": "writer unavailable"})
+        if err.sent:
+            # the writer may still apply the words
+            outcome_unknown()
+    response = Response(
+        status=503,
+        response=serialize.dumps(response_dict),
+        mimetype="application/json"
+    )
+    response.headers["Retry-After"] = str(current_app.config.get('WRITER_RETRY_AFTER', 1))
+    return response
+
 @add.route('', methods=["POST"])
+@idempotent
 def add_story():
     """
-    endpoint to accept the incoming word
+    endpoint to accept the incoming word, optionally for a room
     
     :return: response to the provided request data
     :rtype: flask.Response
     """
 
+    data, room = None, None
     if request.is_json:
-        data = request.get_json()
+        with metrics.get_registry().time("collab_json_duration_seconds", metrics.JSON_DECODE):
+            data = request.get_json()
         words = data["word"]
     elif request.args.get("word", None):
         words = request.args.get("word")
@@ -45,10 +91,21 @@ def add_story():
             status_code = 400
             response_dict = dict({"error": resp})
         else:
+            try:
+                room = _room(data)
+            except ValueError as err:
+                LOG.warning("No data added: %s", err)
+                status_code = 400
+                response_dict = dict({"error": str(err)})
+
+        if room is not None:
 
-            LOG.info("Adding word (%s) to the stories table", words)
+            LOG.debug("Adding word (%s) to the stories table", words)
 
-            db_resp = DBHandler.add_word(words)
+            try:
+                db_resp = DBHandler.add_word(words, room)
+            except (WriterBusy, WriterUnavailable) as err:
+                return _writer_busy(err)
 
             # return internal server error in case of Database Error
             if len(db_resp.keys()) == 0:
@@ -56,23 +113,128 @@ def add_story():
                 return Response(status=500)
 
             if db_resp["created_at"] == db_resp["updated_at"]:
-                LOG.info("SUCCESS: new story start with word (%s)", words)
+                LOG.debug("SUCCESS: new story start with word (%s)", words)
                 status_code = 201
             else:
-                LOG.info("SUCCESS: story updated with word (%s)", words)
+                LOG.debug("SUCCESS: story updated with word (%s)", words)
                 status_code = 200
 
-            paragraphs = db_resp["paragraphs"]
-            cur_para = paragraphs[len(paragraphs)-1]["sentences"]
-            cur_sent = cur_para[len(cur_para)-1]
             response_dict = dict({
                 "id": db_resp["id"],
                 "title": db_resp["title"],
-                "current_sentence": cur_sent
+                "current_sentence": db_resp["current_sentence"]
             })
 
+    with metrics.get_registry().time("collab_json_duration_seconds", metrics.JSON_ENCODE):
+        body = serialize.dumps(response_dict)
     return Response(
         status = status_code,
-        response=json.dumps(response_dict),
+        response=body,
+        mimetype="application/json"
+    )
+
+@add.route('/batch', methods=["POST"])
+@idempotent
+def add_batch():
+    """
+    endpoint to accept an ordered batch of words
+
+    The words are sent either as JSON, a list or {"words": [...]} with an
+    optional "room", or as a newline-delimited text body with one word per
+    line. They are added in one transaction by the same rules as /add, so
+    a batch that completes a story carries on in a new one.
+
+    The response format is as below:
+    {
+        "count": 2,
+        "results": [
+            {
+                "id": 1,
+                "title": "verloop hiring",
+                "current_sentence": "lorem"
+            },
+            {
+                "id": 1,
+                "title": "verloop hiring",
+                "current_sentence": "lorem ipsum"
+            }
+        ]
+    }
+
+    :return: response to the provided request data
+    :rtype: flask.Response
+    """
+
+    if request.is_json:
+        with metrics.get_registry().time("collab_json_duration_seconds", metrics.JSON_DECODE):
+            data = request.get_json(silent=True)
+        words = data.get("words") if isinstance(data, dict) else data
+    else:
+        words = [line.strip() for line in request.get_data(as_text=True).splitlines() if line.strip()]
+
+    if not isinstance(words, list) or len(words) == 0:
+        LOG.warning("No data added: no words detected in batch request!")
+        return Response(
+            status=400,
+            response=serialize.dumps(dict({"error": "no words detected"})),
+            mimetype="application/json"
+        )
+
+    if len(words) > current_app.config['ADD_BATCH_MAX_WORDS']:
+        LOG.warning("No data added: batch of %s words is too large", len(words))
+        return Response(
+            status=413,
+            response=serialize.dumps(dict({
+                "error": "too many words",
+                "max_words": current_app.config['ADD_BATCH_MAX_WORDS']
+            })),
+            mimetype="application/json"
+        )
+
+    try:
+        room = _room(data if request.is_json else None)
+    except ValueError as err:
+        LOG.warning("No data added: %s", err)
+        return Response(
+            status=400,
+            response=serialize.dumps(dict({"error": str(err)})),
+            mimetype="application/json"
+        )
+
+    invalid = [index for index, word in enumerate(words) if not isinstance(word, str) or len(word.split()) != 1]
+    if len(invalid) != 0:
+        LOG.warning("No data added: %s entries of the batch are not single words", len(invalid))
+        return Response(
+            status=400,
+            response=serialize.dumps(dict({"error": "entries must be single words", "invalid": invalid[:100]})),
+            mimetype="application/json"
+        )
+
+    LOG.debug("Adding batch of %s words to the stories table", len(words))
+
+    try:
+        db_resp = DBHandler.add_words(words, room)
+    except (WriterBusy, WriterUnavailable) as err:
+        return _writer_busy(err)
+
+    # return internal server error in case of Database Error
+    if len(db_resp) == 0:
+        LOG.error("FAILED: adding batch of %s words to the stories table", len(words))
+        return Response(status=500)
+
+    results = [
+        dict({
+            "id": result["id"],
+            "title": result["title"],
+            "current_sentence": result["current_sentence"]
+        })
+        for result in db_resp
+    ]
+
+    with metrics.get_registry().time("collab_json_duration_seconds", metrics.JSON_ENCODE):
+        body = serialize.dumps(dict({"count": len(results), "results": results}))
+    return Response(
+        status=200,
+        response=body,
         mimetype="application/json"
-    )
\ No newline at end of file
+    )
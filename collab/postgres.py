@@ -0,0 +1,814 @@
+"""
+contains the PostgreSQL storage backend, selected with STORAGE = "postgres"
+
+Stories are kept in one table, see pg_init.sql, with their paragraphs in
+a JSONB column in the format of the API. Every worker process, on any
+number of hosts, writes directly to the database:
+
+- the active story of the room is read with ``SELECT ... FOR UPDATE``, so
+  concurrent writers of a room queue on its row lock while other rooms
+  are written in parallel, words are appended in memory with the rules
+  of collab/story.py and only the paragraphs they changed are written
+  back with ``jsonb_set``;
+- when a room has no active story, the first writer takes a transaction
+  level advisory lock of the room before inserting one, and the unique
+  index stories_room_active guarantees there is never more than one.
+
+Needs psycopg 3 (``pip install "psycopg[binary]"``) and a DSN in
+``POSTGRES_DSN``, e.g. "postgresql://collab@localhost/collab".
+"""
+
+import os
+import time
+import logging
+
+try:
+    import psycopg
+    from psycopg.pq import TransactionStatus
+    from psycopg.rows import dict_row
+    from psycopg.types.json import Jsonb, set_json_loads
+except ImportError:
+    psycopg = None
+
+from .exceptions import IDNotFound
+from .pool import ConnectionPool, PoolTimeout
+from .storage import Storage
+from .idempotency import IdempotencyStore, CLAIMED, PURGE_EVERY
+from .story import ActiveStory, story_part
+from .helpers import close_clashing_stories
+from . import serialize
+
+
+LOG = logging.getLogger(__name__)
+
+# first key of the advisory locks taken to insert a new active story, the
+# second one is the hash of the room
+ACTIVE_STORY_LOCK = 0x636f6c6c
+# key of the advisory lock taken to set up the schema
+SETUP_LOCK = 0x636f6c6c6162
+# comment pg_init.sql leaves on the stories table, changed with the schema
+SCHEMA_COMMENT = "collab schema 4"
+
+# listing indexes, dropped while importing
+LISTING_INDEXES = ("stories_created_at", "stories_updated_at", "stories_title")
+
+# sort columns accepted by get_stories, with the type of their keyset value
+SORT_COLUMNS = dict({
+    "created_at": ("created_at", "%s::timestamp"),
+    "updated_at": ("updated_at", "%s::timestamp"),
+    "title": ('title COLLATE "C"', "%s")
+})
+ORDERS = dict({"asc": "ASC", "desc": "DESC"})
+# filters of DBHandler.export_stories in SQL of this backend
+EXPORT_FILTERS = dict({
+    "id_from": "id >= %s",
+    "id_to": "id <= %s",
+    "created_from": "created_at >= %s::timestamp",
+    "created_to": "created_at < %s::timestamp",
+    "updated_from": "updated_at >= %s::timestamp",
+    "updated_to": "updated_at < %s::timestamp"
+})
+
+
+def _timestamp(column):
+    """
+    :param column: TIMESTAMP column
+    :type column: str
+    :return: SQL selecting the column as a string in the format of SQLite
+    :rtype: str
+    """
+
+    return "to_char({0}, 'YYYY-MM-DD HH24:MI:SS') AS {0}".format(column)
+
+
+STORY_COLUMNS = "id, title, {}, {}, modifying, words".format(_timestamp("created_at"), _timestamp("updated_at"))
+NOW = "date_trunc('second', now() AT TIME ZONE 'utc')"
+
+
+class PostgresPool(ConnectionPool):
+    """
+    keeps a bounded set of open PostgreSQL connections in autocommit mode,
+    writes open their transactions explicitly
+    """
+
+    errors = (psycopg.Error,) if psycopg is not None else ()
+
+    def __init__(self, dsn, size=8, timeout=10.0):
+        """
+        :param dsn: libpq connection string or URI
+        :type dsn: str
+        :param size: maximum number of open connections
+        :type size: int
+        :param timeout: seconds to wait for a free connection
+        :type timeout: float
+        """
+
+        super(PostgresPool, self).__init__(dsn, size=size, timeout=timeout)
+
+    def _open(self):
+        """
+        :return: new connection returning rows as dicts
+        :rtype: psycopg.Connection
+        """
+
+        conn = psycopg.connect(
+            self.database,
+            autocommit=True,
+            row_factory=dict_row,
+            connect_timeout=max(1, int(self.timeout))
+        )
+        # JSONB is decoded by the JSON backend of the API
+        set_json_loads(serialize.loads, conn)
+        LOG.debug("SUCCESS: postgres connection established!")
+        return conn
+
+    @staticmethod
+    def _in_transaction(conn):
+        """
+        :param conn: connection obtained from acquire
+        :type conn: psycopg.Connection
+        :return: whether the connection is broken or left in a transaction
+        :rtype: bool
+        """
+
+        return conn.closed or conn.info.transaction_status != TransactionStatus.IDLE
+
+
+class PostgresIdempotencyStore(IdempotencyStore):
+    """
+    keys of the requests already handled and their responses, in the
+    idempotency_keys table of pg_init.sql
+    """
+
+    def setup(self):
+        """
+        the table is created along with the stories, see PostgresStorage.setup
+        """
+
+    def claim(self, key, fingerprint):
+        """
+        :param key: idempotency key
+        :type key: str
+        :param fingerprint: hash of the request
+        :type fingerprint: str
+        :return: outcome and stored response as returned by
+            IdempotencyStore.claim
+        :rtype: tuple
+        """
+
+        now = time.time()
+        with self.pool.connection() as conn:
+            # a single statement claims a free, expired or abandoned key
+            claimed = conn.execute('''
+            INSERT INTO idempotency_keys AS k (key, fingerprint, created_at) VALUES (%s, %s, %s)
+            ON CONFLICT (key) DO UPDATE
+            SET fingerprint = excluded.fingerprint, created_at = excluded.created_at, status = NULL, body = NULL
+            WHERE k.created_at < %s OR (k.status IS NULL AND k.created_at < %s)
+            RETURNING key;
+            ''', (key, fingerprint, now, now - self.ttl, now - self.lock_timeout)).fetchone()
+            if claimed is None:
+                row = conn.execute(
+                    "SELECT fingerprint, created_at, status, body FROM idempotency_keys WHERE key = %s;", (key,)
+                ).fetchone()
+                outcome = self._outcome(row, fingerprint, now)
+                if outcome is not None:
+                    return outcome
+
+        if next(self._claims) % PURGE_EVERY == 0:
+            self.purge()
+        return CLAIMED, (fingerprint, now)
+
+    def complete(self, key, claim, status, body):
+        """
+        stores the response of a claimed request, unless the claim was
+        taken over, see IdempotencyStore.complete
+        """
+
+        with self.pool.connection() as conn:
+            stored = conn.execute(
+                "UPDATE idempotency_keys SET status = %s, body = %s "
+                "WHERE key = %s AND fingerprint = %s AND created_at = %s AND status IS NULL;",
+                (status, body, key) + tuple(claim)
+            ).rowcount
+        return stored == 1
+
+    def release(self, key, claim):
+        """
+        frees the claim of a request that failed, for the next attempt
+        """
+
+        with self.pool.connection() as conn:
+            conn.execute(
+                "DELETE FROM idempotency_keys WHERE key = %s AND fingerprint = %s AND created_at = %s AND status IS NULL;",
+                (key,) + tuple(claim)
+            )
+
+    def purge(self):
+        """
+        drops the expired keys and the oldest ones past max_keys
+
+        :return: number of dropped keys
+        :rtype: int
+        """
+
+        with self.pool.connection() as conn:
+            dropped = conn.execute(
+                "DELETE FROM idempotency_keys WHERE created_at < %s;", (time.time() - self.ttl,)
+            ).rowcount
+            dropped += conn.execute('''
+            DELETE FROM idempotency_keys WHERE created_at <= (
+                SELECT created_at FROM idempotency_keys ORDER BY created_at DESC LIMIT 1 OFFSET %s
+            );
+            ''', (self.max_keys,)).rowcount
+        if dropped:
+            LOG.debug("dropped %s idempotency keys", dropped)
+        return dropped
+
+
+class PostgresStorage(Storage):
+    """
+    stories kept by PostgreSQL, shared by workers on any number of hosts
+    """
+
+    errors = ((psycopg.Error,) if psycopg is not None else ()) + (PoolTimeout,)
+
+    def __init__(self, config):
+        """
+        :param config: flask app configuration
+        :type config: flask.Config
+        :raises RuntimeError: psycopg is not installed or no DSN is set
+        """
+
+        super(PostgresStorage, self).__init__(config)
+        if psycopg is None:
+            raise RuntimeError('the postgres storage needs psycopg 3: pip install "psycopg[binary]"')
+        if not config.get('POSTGRES_DSN'):
+            raise RuntimeError("the postgres storage needs POSTGRES_DSN")
+        self.pool = PostgresPool(
+            config['POSTGRES_DSN'],
+            size=config.get('DB_POOL_SIZE', 8),
+            timeout=config.get('DB_POOL_TIMEOUT', 10.0)
+        )
+
+    def setup(self):
+        """
+        creates the schema if it is missing, one worker at a time
+
+        A schema already carrying SCHEMA_COMMENT is left as it is, without
+        reading pg_init.sql or taking the lock.
+        """
+
+        with self.pool.connection() as conn:
+            row = conn.execute("SELECT obj_description(to_regclass('stories'), 'pg_class') AS comment;").fetchone()
+        if row["comment"] == SCHEMA_COMMENT:
+            return
+
+        with open(os.path.join(os.path.dirname(os.path.realpath(__file__)), "pg_init.sql"), encoding="utf-8") as f:
+            script = f.read()
+        with self.pool.connection() as conn:
+            with conn.transaction():
+                conn.execute("SELECT pg_advisory_xact_lock(%s);", (SETUP_LOCK,))
+                conn.execute(script)
+
+    @staticmethod
+    def _active_story(cursor, room):
+        """
+        locks and loads the active story of a room within the caller's
+        transaction
+
+        :param cursor: cursor inside an open transaction
+        :type cursor: psycopg.Cursor
+        :param room: room of the story
+        :type room: str
+        :return: the active story, None if there is none
+        :rtype: ActiveStory
+        """
+
+        sql_cmd = "SELECT {}, paragraphs FROM stories WHERE modifying <> 'no' AND room = %s FOR UPDATE;".format(
+            STORY_COLUMNS
+        )
+        row = cursor.execute(sql_cmd, (room,)).fetchone()
+        if row is None:
+            # writers that found no active story insert one in turn, the
+            # next one sees the story of the first
+            cursor.execute("SELECT pg_advisory_xact_lock(%s, hashtext(%s));", (ACTIVE_STORY_LOCK, room))
+            row = cursor.execute(sql_cmd, (room,)).fetchone()
+            if row is None:
+                return None
+        return ActiveStory(
+            row["id"], row["title"], row["modifying"], row["paragraphs"], row["created_at"], row["updated_at"]
+        )
+
+    @staticmethod
+    def _insert_story(cursor, word, room):
+        """
+        inserts a new story within the caller's transaction
+
+        :param cursor: cursor inside an open transaction
+        :type cursor: psycopg.Cursor
+        :param word: first word of the title
+        :type word: str
+        :param room: room of the story
+        :type room: str
+        :return: the inserted story
+        :rtype: ActiveStory
+        """
+
+        row = cursor.execute(
+            "INSERT INTO stories (title, room) VALUES (%s, %s) RETURNING {}, paragraphs;".format(STORY_COLUMNS),
+            (word, room)
+        ).fetchone()
+        return ActiveStory(
+            row["id"], row["title"], row["modifying"], row["paragraphs"], row["created_at"], row["updated_at"]
+        )
+
+    @staticmethod
+    def _save_story(cursor, story):
+        """
+        writes the title, cursor and changed paragraphs of a story within
+        the caller's transaction
+
+        :param cursor: cursor inside an open transaction
+        :type cursor: psycopg.Cursor
+        :param story: story words were appended to
+        :type story: ActiveStory
+        """
+
+        paragraphs = "paragraphs"
+        params = []
+        # paragraphs in index order, so a new one is appended after the
+        # last existing one
+        for para in sorted(set(para for para, _ in story.dirty)):
+            paragraphs = "jsonb_set({}, %s, %s)".format(paragraphs)
+            params.extend([[str(para)], Jsonb(story.paragraphs[para])])
+        params.extend(["no" if story.completed else str(story.cursor), story.title, story.words, story.id])
+        cursor.execute('''
+        UPDATE stories
+        SET updated_at = {now},
+            paragraphs = {paragraphs},
+            modifying = %s,
+            title = %s,
+            words = %s
+        WHERE id = %s
+        '''.format(now=NOW, paragraphs=paragraphs), params)
+        story.dirty.clear()
+
+    def add_words(self, words, room=""):
+        """
+        adds words to the active story of a room, or new stories, in one
+        transaction
+
+        :param words: words to be added, in order
+        :type words: list
+        :param room: room of the stories
+        :type room: str
+        :return: one entry per word in the format of DBHandler.add_word, or
+            an empty list if nothing was added
+        :rtype: list
+        """
+
+        results = []
+        try:
+            with self.pool.connection() as conn:
+                with conn.transaction():
+                    cursor = conn.cursor()
+                    now = cursor.execute(
+                        "SELECT to_char({}, 'YYYY-MM-DD HH24:MI:SS') AS now;".format(NOW)
+                    ).fetchone()["now"]
+                    story = self._active_story(cursor, room)
+                    changed = False
+                    for word in words:
+                        if story is None:
+                            story = self._insert_story(cursor, word, room)
+                            current_sentence = ""
+                        else:
+                            # the title is only written right after a story is created
+                            current_sentence = "" if story.cursor.title else None
+                            story.append(word)
+                            story.updated_at = now
+                            changed = True
+                            if current_sentence is None:
+                                current_sentence = story.current_sentence
+                        results.append(dict({
+                            "id": story.id,
+                            "title": story.title,
+                            "created_at": story.created_at,
+                            "updated_at": story.updated_at,
+                            "words": story.words,
+                            "current_sentence": current_sentence
+                        }))
+                        if story.completed:
+                            self._save_story(cursor, story)
+                            story, changed = None, False
+                    if changed:
+                        self._save_story(cursor, story)
+        except self.errors as err:
+            LOG.debug(err)
+            LOG.error("unable to add batch of %s words to database", len(words))
+            return []
+        return results
+
+    def create_new_story(self, word, room=""):
+        """
+        :param word: first word of the title
+        :type word: str
+        :param room: room of the story
+        :type room: str
+        :return: added story in the format of DBHandler.create_new_story, or
+            an empty dict
+        :rtype: dict
+        """
+
+        try:
+            with self.pool.connection() as conn:
+                with conn.transaction():
+                    cursor = conn.cursor()
+                    # fails on the stories_room_active index while the room has an active story
+                    cursor.execute("SELECT pg_advisory_xact_lock(%s, hashtext(%s));", (ACTIVE_STORY_LOCK, room))
+                    story = self._insert_story(cursor, word, room)
+        except self.errors as err:
+            LOG.debug(err)
+            LOG.error("failed to add data")
+            return dict()
+
+        return dict({
+            "id": story.id,
+            "title": story.title,
+            "created_at": story.created_at,
+            "updated_at": story.updated_at,
+            "current_sentence": ""
+        })
+
+    def get_stories(self, limit, offset, sort, order, after=None):
+        """
+        :return: stories in the format of DBHandler.get_stories
+        :rtype: list
+        """
+
+        sort_by, placeholder = SORT_COLUMNS[sort.lower()]
+        order = ORDERS[order.lower()]
+        where = ""
+        params = []
+        if after is not None:
+            where = "WHERE (stories.{sort_by}, id) {op} ({placeholder}, %s)".format(
+                sort_by=sort_by,
+                op=">" if order == "ASC" else "<",
+                placeholder=placeholder
+            )
+            params.extend(after)
+        params.extend([int(limit), int(offset)])
+
+        # qualified, as a bare name would sort by the text column of the
+        # same name in the SELECT list, which no index covers
+        sql_cmd = '''
+        SELECT id, title, {created_at}, {updated_at}
+        FROM stories
+        {where}
+        ORDER BY stories.{sort_by} {order}, id {order}
+        LIMIT %s OFFSET %s
+        '''.format(
+            created_at=_timestamp("created_at"),
+            updated_at=_timestamp("updated_at"),
+            where=where,
+            sort_by=sort_by,
+            order=order
+        )
+
+        try:
+            with self.pool.connection() as conn:
+                results = conn.execute(sql_cmd, params).fetchall()
+        except self.errors as err:
+            LOG.debug(err)
+            LOG.error("failed to load stories from database")
+            results = dict({})
+        return results
+
+    def _story_row(self, id, columns, params=()):
+        """
+        :param id: id of the story
+        :type id: int
+        :param columns: SQL of the columns to read
+        :type columns: str
+        :param params: values of the placeholders in columns
+        :type params: tuple
+        :raises IDNotFound: id not present in the database
+        :return: row of the story
+        :rtype: dict
+        """
+
+        try:
+            with self.pool.connection() as conn:
+                row = conn.execute("SELECT {} FROM stories WHERE id = %s;".format(columns), tuple(params) + (id,)).fetchone()
+        except self.errors as err:
+            LOG.debug(err)
+            LOG.error("failed to fetch story (id=%s) from database", id)
+            row = None
+
+        if row is None:
+            raise IDNotFound(id)
+        return row
+
+    def load_story(self, id):
+        """
+        :param id: id of the story
+        :type id: int
+        :raises IDNotFound: id not present in the database
+        :return: story in the format of DBHandler.get_story, its version and
+            whether it is completed
+        :rtype: tuple
+        """
+
+        row = self._story_row(id, STORY_COLUMNS + ", paragraphs")
+        story = dict({
+            "id": row["id"],
+            "title": row["title"],
+            "created_at": row["created_at"],
+            "updated_at": row["updated_at"],
+            "paragraphs": row["paragraphs"]
+        })
+        version = dict({"updated_at": row["updated_at"], "words": row["words"]})
+        return story, version, row["modifying"] == "no"
+
+    def get_story_version(self, id):
+        """
+        :param id: id of the story
+        :type id: int
+        :raises IDNotFound: id not present in the database
+        :return: version in the format of DBHandler.get_story_version
+        :rtype: dict
+        """
+
+        row = self._story_row(id, _timestamp("updated_at") + ", words")
+        return dict({"updated_at": row["updated_at"], "words": row["words"]})
+
+    def get_story_tail(self, id, para=0, sent=0):
+        """
+        :param id: id of the story
+        :type id: int
+        :param para: paragraph index of the first sentence to read
+        :type para: int
+        :param sent: sentence index of the first sentence to read
+        :type sent: int
+        :raises IDNotFound: id not present in the database
+        :return: sentences in the format of DBHandler.get_story_tail
+        :rtype: dict
+        """
+
+        # paragraphs before the requested one are not sent by the server
+        row = self._story_row(
+            id,
+            "title, modifying, words, "
+            "jsonb_path_query_array(paragraphs, '$[$first to last]', jsonb_build_object('first', %s)) AS paragraphs",
+            (int(para),)
+        )
+        return dict({
+            "title": row["title"],
+            "words": row["words"],
+            "completed": row["modifying"] == "no",
+            "sentences": [
+                (para_idx, sent_idx, text)
+                for para_idx, paragraph in enumerate(row["paragraphs"], int(para))
+                for sent_idx, text in enumerate(paragraph["sentences"])
+                if (para_idx, sent_idx) >= (para, sent)
+            ]
+        })
+
+    def get_story_part(self, id, start=(0, 0), end=None, tail=None):
+        """
+        :param id: id of the story
+        :type id: int
+        :param start: (para_idx, sent_idx) of the first sentence of the range
+        :type start: tuple
+        :param end: (para_idx, sent_idx) of the last sentence of the range,
+            None for the end of the story
+        :type end: tuple
+        :param tail: number of sentences kept from the end of the range
+        :type tail: int
+        :raises IDNotFound: id not present in the database
+        :return: range of the story and its version, in the format of
+            DBHandler.get_story_part
+        :rtype: tuple
+        """
+
+        # only the paragraphs holding the range leave the server; every
+        # paragraph has a sentence, so a tail of n sentences lies within
+        # the last n paragraphs of the range
+        last = None if end is None else end[0]
+        first = "GREATEST(%s::int, LEAST(%s::int, jsonb_array_length(paragraphs) - 1) - %s::int + 1)"
+        row = self._story_row(
+            id,
+            STORY_COLUMNS + ", {0} AS first, "
+            "jsonb_path_query_array(paragraphs, %s, jsonb_build_object('first', {0}, 'last', %s::int)) "
+            "AS paragraphs".format(first),
+            (start[0], last, tail, "$[$first to last]" if last is None else "$[$first to $last]",
+             start[0], last, tail, last)
+        )
+        offset, paragraphs = story_part([
+            (para_idx, sent_idx, text)
+            for para_idx, paragraph in enumerate(row["paragraphs"], row["first"])
+            for sent_idx, text in enumerate(paragraph["sentences"])
+        ], start, end, tail)
+        story = dict({
+            "id": row["id"],
+            "title": row["title"],
+            "created_at": row["created_at"],
+            "updated_at": row["updated_at"],
+            "offset": offset,
+            "paragraphs": paragraphs
+        })
+        return story, dict({"updated_at": row["updated_at"], "words": row["words"]})
+
+    def get_stats(self, days=30):
+        """
+        :param days: number of most recent UTC days reported, today included
+        :type days: int
+        :return: statistics in the format of DBHandler.get_stats
+        :rtype: dict
+        """
+
+        try:
+            with self.pool.connection() as conn:
+                totals = conn.execute(
+                    "SELECT COALESCE(SUM(stories), 0) AS stories, COALESCE(SUM(completed), 0) AS completed, "
+                    "COALESCE(SUM(words), 0) AS words FROM story_totals;"
+                ).fetchone()
+                daily = conn.execute('''
+                SELECT to_char(day, 'YYYY-MM-DD') AS day, SUM(started) AS started, SUM(completed) AS completed,
+                    SUM(words) AS words
+                FROM story_daily
+                WHERE day > (now() AT TIME ZONE 'utc')::DATE - %s
+                GROUP BY day
+                ORDER BY day DESC;
+                ''', (int(days),)).fetchall()
+        except self.errors as err:
+            LOG.debug(err)
+            LOG.error("failed to fetch statistics from database")
+            return dict()
+
+        return dict({
+            "stories": int(totals["stories"]),
+            "completed": int(totals["completed"]),
+            "active": int(totals["stories"] - totals["completed"]),
+            "words": int(totals["words"]),
+            "days": [
+                dict({key: row[key] if key == "day" else int(row[key]) for key in ("day", "started", "completed", "words")})
+                for row in daily
+            ]
+        })
+
+    def idempotency_store(self, ttl=86400.0, max_keys=100000, lock_timeout=60.0):
+        """
+        :return: store of the idempotency keys, shared by every host
+        :rtype: PostgresIdempotencyStore
+        """
+
+        return PostgresIdempotencyStore(self.pool, ttl, max_keys, lock_timeout)
+
+    def export_stories(self, filters=None, batch=1000):
+        """
+        :param filters: values of EXPORT_FILTERS, e.g. {"id_from": 10}
+        :type filters: dict
+        :param batch: number of stories fetched at a time
+        :type batch: int
+        :return: stories in the format of DBHandler.export_stories
+        :rtype: generator
+        """
+
+        filters = dict({key: value for key, value in (filters or dict()).items() if value is not None})
+        where = " AND ".join(EXPORT_FILTERS[key] for key in filters) or "TRUE"
+        sql_cmd = "SELECT {}, room, paragraphs FROM stories WHERE {} ORDER BY id".format(STORY_COLUMNS, where)
+
+        try:
+            with self.pool.connection() as conn:
+                with conn.transaction():
+                    # a server side cursor, only one batch is held in memory
+                    with conn.cursor(name="collab_export") as cursor:
+                        cursor.execute(sql_cmd, tuple(filters.values()))
+                        while True:
+                            rows = cursor.fetchmany(batch)
+                            if len(rows) == 0:
+                                break
+                            for row in rows:
+                                yield dict({
+                                    "id": row["id"],
+                                    "title": row["title"],
+                                    "created_at": row["created_at"],
+                                    "updated_at": row["updated_at"],
+                                    "modifying": row["modifying"],
+                                    "words": row["words"],
+                                    "room": row["room"],
+                                    "paragraphs": row["paragraphs"]
+                                })
+        except self.errors as err:
+            LOG.debug(err)
+            LOG.error("failed to export stories from database")
+
+    def import_stories(self, stories, batch=10000):
+        """
+        inserts stories in the format of DBHandler.export_stories, keeping
+        their ids, with the listing indexes dropped for the import
+
+        :param stories: stories to insert
+        :type stories: iterable
+        :param batch: number of stories per transaction
+        :type batch: int
+        :return: counts in the format of DBHandler.import_stories
+        :rtype: dict
+        """
+
+        counts = dict({"imported": 0, "skipped": 0, "closed": 0})
+        try:
+            with self.pool.connection() as conn:
+                indexes = conn.execute(
+                    "SELECT indexname, indexdef FROM pg_indexes WHERE tablename = 'stories' AND indexname = ANY(%s);",
+                    (list(LISTING_INDEXES),)
+                ).fetchall()
+                for index in indexes:
+                    conn.execute('DROP INDEX IF EXISTS "{}";'.format(index["indexname"]))
+                try:
+                    pending = []
+                    for story in stories:
+                        pending.append(story)
+                        if len(pending) >= batch:
+                            self._import_batch(conn, pending, counts)
+                            pending = []
+                    if len(pending) != 0:
+                        self._import_batch(conn, pending, counts)
+                finally:
+                    LOG.info("building %s indexes of the stories table", len(indexes))
+                    for index in indexes:
+                        conn.execute(index["indexdef"])
+                    # new stories carry on after the highest imported id
+                    conn.execute(
+                        "SELECT setval(pg_get_serial_sequence('stories', 'id'), "
+                        "GREATEST((SELECT max(id) FROM stories), 1));"
+                    )
+        except self.errors as err:
+            LOG.debug(err)
+            LOG.error("failed to import stories after %s of them", counts["imported"])
+            counts = dict({})
+        return counts
+
+    @staticmethod
+    def _import_batch(conn, stories, counts):
+        """
+        inserts a batch of stories in one transaction
+
+        :param conn: connection to the database
+        :type conn: psycopg.Connection
+        :param stories: stories in the format of DBHandler.export_stories
+        :type stories: list
+        :param counts: number of imported and skipped stories, updated
+        :type counts: dict
+        """
+
+        with conn.transaction():
+            cursor = conn.cursor()
+            taken = set(
+                row["id"] for row in cursor.execute(
+                    "SELECT id FROM stories WHERE id = ANY(%s);", ([story["id"] for story in stories],)
+                )
+            )
+            fresh = [story for story in stories if story["id"] not in taken]
+            # a second active story in a room would break stories_room_active
+            rooms = list(set(story.get("room", "") for story in fresh if story["modifying"] != "no"))
+            active = set()
+            if len(rooms) != 0:
+                active.update(row["room"] for row in cursor.execute(
+                    "SELECT room FROM stories WHERE modifying <> 'no' AND room = ANY(%s);", (rooms,)
+                ))
+            fresh, closed = close_clashing_stories(fresh, active)
+            cursor.executemany(
+                '''
+                INSERT INTO stories (id, created_at, updated_at, modifying, title, words, room, paragraphs)
+                VALUES (%s, %s::timestamp, %s::timestamp, %s, %s, %s, %s, %s)
+                ''',
+                [
+                    (
+                        story["id"], story["created_at"], story["updated_at"], story["modifying"],
+                        story["title"], story["words"], story.get("room", ""), Jsonb(story["paragraphs"])
+                    )
+                    for story in fresh
+                ]
+            )
+        counts["imported"] += len(fresh)
+        counts["skipped"] += len(stories) - len(fresh)
+        counts["closed"] += closed
+        if closed:
+            LOG.warning("imported %s active stories as completed, their room has an active story", closed)
+        LOG.debug("imported %s stories, skipped %s", counts["imported"], counts["skipped"])
+
+    def pool_stats(self):
+        """
+        :return: counters of this process' connection pool
+        :rtype: dict
+        """
+
+        return self.pool.stats()
+
+    def close(self):
+        """
+        closes the idle connections of the pool
+        """
+
+        self.pool.close()
@@ -0,0 +1,92 @@
+"""
+contains the sampling profiler behind the ``?profile=1`` query parameter
+
+With ``PROFILE_REQUESTS`` enabled, a request carrying ``profile=1`` is
+sampled every ``PROFILE_INTERVAL`` seconds from a separate thread while it
+runs. Its stacks are written to ``PROFILE_DIR`` in the collapsed format
+read by flamegraph.pl and speedscope, one "frame;frame;frame count" line
+per distinct stack.
+"""
+
+import os
+import sys
+import time
+import logging
+import threading
+
+from collections import Counter
+
+
+LOG = logging.getLogger(__name__)
+
+
+class SamplingProfiler:
+    """
+    samples the stack of one thread at a fixed interval
+    """
+
+    def __init__(self, thread_id, interval=0.001):
+        """
+        :param thread_id: identifier of the thread to sample
+        :type thread_id: int
+        :param interval: seconds between samples
+        :type interval: float
+        """
+
+        self.thread_id = thread_id
+        self.interval = float(interval)
+        self.stacks = Counter()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._sample, name="collab-profiler", daemon=True)
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def stop(self):
+        """
+        stops sampling
+
+        :return: number of samples per stack
+        :rtype: collections.Counter
+        """
+
+        self._stop.set()
+        self._thread.join()
+        return self.stacks
+
+    def _sample(self):
+        while not self._stop.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            if frame is None:
+                continue
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append("{}:{}:{}".format(os.path.basename(code.co_filename), code.co_name, frame.f_lineno))
+                frame = frame.f_back
+            self.stacks[";".join(reversed(stack))] += 1
+
+
+def dump_stacks(stacks, directory, name):
+    """
+    writes sampled stacks in the collapsed format
+
+    :param stacks: number of samples per stack
+    :type stacks: collections.Counter
+    :param directory: directory of the profiles, created if missing
+    :type directory: str
+    :param name: describes the request, e.g. its endpoint
+    :type name: str
+    :return: path of the written file
+    :rtype: str
+    """
+
+    os.makedirs(directory, exist_ok=True)
+    safe_name = "".join(c if c.isalnum() else "_" for c in name).strip("_")
+    path = os.path.join(directory, "{}-{}-{}.folded".format(time.strftime("%Y%m%d%H%M%S"), os.getpid(), safe_name))
+    with open(path, "w", encoding="utf-8") as f:
+        for stack, count in stacks.most_common():
+            f.write("{} {}\n".format(stack, count))
+    LOG.info("wrote profile of %s samples to %s", sum(stacks.values()), path)
+    return path
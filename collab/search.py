@@ -0,0 +1,215 @@
+"""
+contains the full-text index of stories behind /stories/search
+
+Stories are indexed in the FTS5 table ``story_search``, one row per story
+with its title and its sentences as body, under the id of the story. What
+gets indexed depends on ``SEARCH_INDEX``:
+
+- "completed": a story is indexed once, by a trigger, when its last word
+  is added. Adding any other word costs nothing.
+- "all": the story is indexed again by triggers whenever a word is added,
+  so the active story can be found as it is written, at the cost of
+  rewriting its row on every /add.
+- "off": no index is kept and the endpoint answers 404.
+
+The triggers of the selected mode are created when the app starts. When
+the mode changes, the index is rebuilt from the stories table.
+"""
+
+import sqlite3
+import logging
+
+from .archive import unpack
+
+
+LOG = logging.getLogger(__name__)
+
+SEARCH_MODES = ("completed", "all", "off")
+
+
+def _fts5_supported():
+    try:
+        conn = sqlite3.connect(":memory:")
+        try:
+            conn.execute("CREATE VIRTUAL TABLE probe USING fts5(text);")
+        finally:
+            conn.close()
+    except sqlite3.Error:
+        return False
+    return True
+
+
+FTS5_SUPPORTED = _fts5_supported()
+
+CREATE_TABLE = "CREATE VIRTUAL TABLE IF NOT EXISTS story_search USING fts5(title, body);"
+
+# replaces the row of one story, the body reads the sentences in order
+_INDEX_STORY = '''
+    DELETE FROM story_search WHERE rowid = {id};
+    INSERT INTO story_search (rowid, title, body)
+    SELECT id, title, (
+        SELECT group_concat(text, ' ') FROM (
+            SELECT text FROM sentences WHERE story_id = {id} ORDER BY para_idx, sent_idx
+        )
+    )
+    FROM stories WHERE id = {id};
+'''
+
+TRIGGERS = dict({
+    "completed": dict({
+        "search_completed": '''
+        CREATE TRIGGER search_completed
+        AFTER UPDATE OF modifying ON stories
+        FOR EACH ROW
+        WHEN NEW.modifying = 'no' AND OLD.modifying != 'no'
+        BEGIN
+        ''' + _INDEX_STORY.format(id="NEW.id") + '''
+        END;
+        '''
+    }),
+    "all": dict({
+        "search_inserted": '''
+        CREATE TRIGGER search_inserted
+        AFTER INSERT ON stories
+        FOR EACH ROW
+        BEGIN
+        ''' + _INDEX_STORY.format(id="NEW.id") + '''
+        END;
+        ''',
+        "search_updated": '''
+        CREATE TRIGGER search_updated
+        AFTER UPDATE OF words ON stories
+        FOR EACH ROW
+        BEGIN
+        ''' + _INDEX_STORY.format(id="NEW.id") + '''
+        END;
+        '''
+    }),
+    "off": dict()
+})
+
+# stories kept in the index of each mode
+_INDEXED = dict({"completed": "modifying = 'no'", "all": "1", "off": "0"})
+
+
+def _installed(conn):
+    """
+    :param conn: connection to the database
+    :type conn: sqlite3.Connection
+    :return: names of the search triggers and whether the index exists
+    :rtype: tuple
+    """
+
+    existing = set(
+        row[0] for row in conn.execute(
+            "SELECT name FROM sqlite_master WHERE type = 'trigger' AND name LIKE 'search\\_%' ESCAPE '\\';"
+        )
+    )
+    table = conn.execute("SELECT 1 FROM sqlite_master WHERE name = 'story_search';").fetchone() is not None
+    return existing, table
+
+
+def setup_search(conn, mode):
+    """
+    creates the index and the triggers of a mode, rebuilding the index if
+    the mode changed, in a single transaction
+
+    :param conn: connection to the database
+    :type conn: sqlite3.Connection
+    :param mode: one of SEARCH_MODES
+    :type mode: str
+    :return: whether the index was rebuilt
+    :rtype: bool
+    """
+
+    if mode not in SEARCH_MODES:
+        raise ValueError("unknown search mode {}".format(mode))
+    if not FTS5_SUPPORTED:
+        if mode != "off":
+            LOG.warning("SQLite is built without FTS5, search is disabled")
+        return False
+
+    # checked without the write lock first, as every worker starting does
+    if _installed(conn) == (set(TRIGGERS[mode]), mode != "off"):
+        return False
+
+    conn.execute("BEGIN IMMEDIATE;")
+    try:
+        existing, table = _installed(conn)
+        if existing == set(TRIGGERS[mode]) and table == (mode != "off"):
+            conn.rollback()
+            return False
+
+        for name in existing:
+            conn.execute("DROP TRIGGER IF EXISTS {};".format(name))
+        if mode == "off":
+            conn.execute("DROP TABLE IF EXISTS story_search;")
+        else:
+            conn.execute(CREATE_TABLE)
+            for sql in TRIGGERS[mode].values():
+                conn.execute(sql)
+            rebuild_search(conn, mode)
+        conn.commit()
+    except sqlite3.Error:
+        conn.rollback()
+        raise
+    LOG.info("search index set up for %s stories", mode)
+    return True
+
+
+def rebuild_search(conn, mode, ids=None):
+    """
+    indexes the stories kept by a mode, within the caller's transaction
+
+    :param conn: connection to the database
+    :type conn: sqlite3.Connection
+    :param mode: one of SEARCH_MODES
+    :type mode: str
+    :param ids: ids of the stories to index again, None for all of them
+    :type ids: list
+    """
+
+    if mode == "off" or not FTS5_SUPPORTED:
+        return
+    if ids is None:
+        conn.execute("DELETE FROM story_search;")
+        where, params = "", ()
+    else:
+        if len(ids) == 0:
+            return
+        where = "AND id IN ({})".format(",".join("?" * len(ids)))
+        params = tuple(ids)
+        conn.execute("DELETE FROM story_search WHERE rowid IN ({});".format(",".join("?" * len(ids))), params)
+
+    # sentences are read in index order, so their group keeps it
+    conn.execute('''
+    INSERT INTO story_search (rowid, title, body)
+    SELECT stories.id, title, group_concat(text, ' ')
+    FROM stories NOT INDEXED JOIN sentences ON sentences.story_id = stories.id
+    WHERE {} {}
+    GROUP BY stories.id
+    '''.format(_INDEXED[mode], where), params)
+    # archived stories have no sentences left, their bodies are unpacked here
+    archived = conn.execute('''
+    SELECT stories.id, title, story_archive.body
+    FROM stories JOIN story_archive ON story_archive.story_id = stories.id
+    WHERE {} {}
+    '''.format(_INDEXED[mode], where), params)
+    conn.executemany(
+        "INSERT INTO story_search (rowid, title, body) VALUES (?, ?, ?);",
+        ((id, title, " ".join(text for _, _, text in unpack(body))) for id, title, body in archived)
+    )
+
+
+def match_expression(query):
+    """
+    turns free text into an FTS5 query matching stories that contain
+    every word of it
+
+    :param query: words to search for
+    :type query: str
+    :return: FTS5 query, empty if there are no words
+    :rtype: str
+    """
+
+    return " ".join('"{}"'.format(word.replace('"', '""')) for word in query.split())
@@ -0,0 +1,129 @@
+"""
+contains the JSON encoding and decoding used by the API
+
+orjson is used when it is installed, the standard library otherwise; set
+``JSON_BACKEND`` to pick one. Both produce the same documents, orjson
+without the spaces after separators.
+
+Story bodies are spliced together from serialized paragraphs. Paragraphs
+before the last one never change, so their bytes are kept by the story
+cache, and only the paragraph still being written is read and encoded
+again after a word is added.
+"""
+
+import json
+import logging
+
+from flask.json.provider import DefaultJSONProvider
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+LOG = logging.getLogger(__name__)
+
+BACKENDS = ("auto", "orjson", "json")
+
+_BACKEND = dict({"name": "orjson" if orjson is not None else "json"})
+
+
+def use(name):
+    """
+    selects the JSON backend of the current process
+
+    :param name: one of BACKENDS, "auto" picks orjson when installed
+    :type name: str
+    :return: name of the backend in use
+    :rtype: str
+    """
+
+    if name not in BACKENDS:
+        raise ValueError("unknown JSON backend {}".format(name))
+    if name == "orjson" and orjson is None:
+        LOG.warning("orjson is not installed, falling back to the json module")
+        name = "json"
+    elif name == "auto":
+        name = "orjson" if orjson is not None else "json"
+    _BACKEND["name"] = name
+    return name
+
+
+def backend():
+    """
+    :return: name of the backend in use
+    :rtype: str
+    """
+
+    return _BACKEND["name"]
+
+
+def dumps(obj):
+    """
+    :param obj: document to encode
+    :return: UTF-8 JSON
+    :rtype: bytes
+    """
+
+    if _BACKEND["name"] == "orjson":
+        return orjson.dumps(obj)
+    return json.dumps(obj).encode('utf-8')
+
+
+def loads(data):
+    """
+    :param data: JSON document
+    :type data: bytes or str
+    :return: decoded document
+    """
+
+    if _BACKEND["name"] == "orjson":
+        return orjson.loads(data)
+    return json.loads(data)
+
+
+def paragraph_json(sentences):
+    """
+    :param sentences: sentences of a paragraph
+    :type sentences: list
+    :return: the paragraph as it appears in a story body
+    :rtype: bytes
+    """
+
+    return dumps(dict({"sentences": sentences}))
+
+
+def story_json(header, paragraphs):
+    """
+    splices serialized paragraphs into a story body
+
+    :param header: every field of the story but its paragraphs, not empty
+    :type header: dict
+    :param paragraphs: serialized paragraphs as returned by paragraph_json
+    :type paragraphs: list
+    :return: the story in the format of DBHandler.get_story
+    :rtype: bytes
+    """
+
+    separator = b', "paragraphs": [' if _BACKEND["name"] == "json" else b',"paragraphs":['
+    paragraphs = b", ".join(paragraphs) if _BACKEND["name"] == "json" else b",".join(paragraphs)
+    return b"".join((dumps(header)[:-1], separator, paragraphs, b"]}"))
+
+
+class JSONProvider(DefaultJSONProvider):
+    """
+    flask JSON provider backed by the selected backend, used by
+    request.get_json and jsonify
+    """
+
+    def dumps(self, obj, **kwargs):
+        if _BACKEND["name"] == "orjson" and len(kwargs) == 0:
+            option = orjson.OPT_SORT_KEYS if self.sort_keys else 0
+            return orjson.dumps(obj, default=self.default, option=option).decode('utf-8')
+        return super(JSONProvider, self).dumps(obj, **kwargs)
+
+    def loads(self, s, **kwargs):
+        if _BACKEND["name"] == "orjson" and len(kwargs) == 0:
+            return orjson.loads(s)
+        return super(JSONProvider, self).loads(s, **kwargs)
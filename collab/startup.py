@@ -0,0 +1,68 @@
+"""
+contains the startup report of the app
+
+create_app times each of its phases. The report is logged once the app is
+ready, kept in ``app.extensions["collab_startup"]`` and, with METRICS,
+observed in ``collab_startup_duration_seconds``. Under ``gunicorn
+--preload`` the app is created once in the master and forked workers start
+without running any of these phases.
+"""
+
+import os
+import time
+import logging
+
+from contextlib import contextmanager
+
+
+LOG = logging.getLogger(__name__)
+
+
+class StartupReport:
+    """
+    durations of the phases of create_app, in the order they ran
+    """
+
+    def __init__(self):
+        self.pid = os.getpid()
+        self.phases = dict()
+        self._start = time.perf_counter()
+        self.total = None
+
+    @contextmanager
+    def phase(self, name):
+        """
+        context manager recording the time spent in its block under name
+        """
+
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.phases[name] = self.phases.get(name, 0.0) + time.perf_counter() - start
+
+    def finish(self):
+        """
+        stops the clock and logs the report
+
+        :return: the report
+        :rtype: dict
+        """
+
+        self.total = time.perf_counter() - self._start
+        LOG.info("app started in %.1f ms (%s)", self.total * 1000, ", ".join(
+            "{} {:.1f}".format(name, seconds * 1000) for name, seconds in self.phases.items()
+        ))
+        return self.as_dict()
+
+    def as_dict(self):
+        """
+        :return: pid, total and phase durations in milliseconds
+        :rtype: dict
+        """
+
+        return dict({
+            "pid": self.pid,
+            "total_ms": round((self.total or 0.0) * 1000, 3),
+            "phases_ms": dict({name: round(seconds * 1000, 3) for name, seconds in self.phases.items()})
+        })
@@ -0,0 +1,239 @@
+"""
+contains the interface of the storage backends behind DBHandler
+
+SQLite is the built-in backend: DBHandler runs its queries itself, along
+with the story cache, the write-behind buffer and the single writer that
+are specific to it. Other databases implement Storage and are selected
+with ``STORAGE``; DBHandler then hands every read and write to them.
+
+A backend returns the same formats as DBHandler, with timestamps as UTC
+strings like "2018-12-01 00:01:00", and follows its error handling:
+failures of the database are logged and answered with an empty dict or
+list, and unknown ids raise IDNotFound.
+"""
+
+import os
+import logging
+import threading
+import importlib
+
+from . import serialize
+
+
+LOG = logging.getLogger(__name__)
+
+# backends selectable with STORAGE, None for the built-in SQLite one
+STORAGE_BACKENDS = dict({
+    "sqlite": None,
+    "postgres": "collab.postgres.PostgresStorage"
+})
+
+_STORAGES = dict()
+_STORAGES_LOCK = threading.Lock()
+
+
+class Storage:
+    """
+    stories kept by a database other than the built-in SQLite one
+    """
+
+    # errors of the database driver, raised by setup
+    errors = ()
+    # whether search_stories is available
+    supports_search = False
+
+    def __init__(self, config):
+        """
+        :param config: flask app configuration
+        :type config: flask.Config
+        """
+
+        self.config = config
+
+    def setup(self):
+        """
+        creates the schema if it is missing
+        """
+
+        raise NotImplementedError
+
+    def add_words(self, words, room=""):
+        """
+        :param words: words to be added, in order
+        :type words: list
+        :param room: room of the stories, "" for the default one
+        :type room: str
+        :return: one entry per word in the format of DBHandler.add_word,
+            or an empty list if nothing was added
+        :rtype: list
+        """
+
+        raise NotImplementedError
+
+    def add_word(self, word, room=""):
+        """
+        :param word: word to be added
+        :type word: str
+        :param room: room of the story, "" for the default one
+        :type room: str
+        :return: edited story in the format of DBHandler.add_word, or an
+            empty dict
+        :rtype: dict
+        """
+
+        results = self.add_words([word], room)
+        return results[0] if len(results) != 0 else dict()
+
+    def create_new_story(self, word, room=""):
+        """
+        :param word: first word of the title
+        :type word: str
+        :param room: room of the story
+        :type room: str
+        :return: added story in the format of DBHandler.create_new_story, or
+            an empty dict
+        :rtype: dict
+        """
+
+        raise NotImplementedError
+
+    def get_stories(self, limit, offset, sort, order, after=None):
+        """
+        :return: stories in the format of DBHandler.get_stories
+        :rtype: list
+        """
+
+        raise NotImplementedError
+
+    def load_story(self, id):
+        """
+        :param id: id of the story
+        :type id: int
+        :raises IDNotFound: id not present in the database
+        :return: story in the format of DBHandler.get_story, its version in
+            the format of DBHandler.get_story_version and whether it is
+            completed
+        :rtype: tuple
+        """
+
+        raise NotImplementedError
+
+    def get_story_json(self, id):
+        """
+        :param id: id of the story
+        :type id: int
+        :raises IDNotFound: id not present in the database
+        :return: story as UTF-8 JSON, its version and whether it is completed
+        :rtype: tuple
+        """
+
+        story, version, completed = self.load_story(id)
+        return serialize.dumps(story), version, completed
+
+    def get_story_version(self, id):
+        """
+        :param id: id of the story
+        :type id: int
+        :raises IDNotFound: id not present in the database
+        :return: version in the format of DBHandler.get_story_version
+        :rtype: dict
+        """
+
+        raise NotImplementedError
+
+    def get_story_tail(self, id, para=0, sent=0):
+        """
+        :raises IDNotFound: id not present in the database
+        :return: sentences in the format of DBHandler.get_story_tail
+        :rtype: dict
+        """
+
+        raise NotImplementedError
+
+    def get_story_part(self, id, start=(0, 0), end=None, tail=None):
+        """
+        :raises IDNotFound: id not present in the database
+        :return: range of the story and its version, in the format of
+            DBHandler.get_story_part
+        :rtype: tuple
+        """
+
+        raise NotImplementedError
+
+    def get_stats(self, days=30):
+        """
+        :return: statistics in the format of DBHandler.get_stats
+        :rtype: dict
+        """
+
+        raise NotImplementedError
+
+    def idempotency_store(self, ttl=86400.0, max_keys=100000, lock_timeout=60.0):
+        """
+        :return: store of the idempotency keys of /add, shared by the
+            workers of every host
+        :rtype: collab.idempotency.IdempotencyStore
+        """
+
+        raise NotImplementedError
+
+    def export_stories(self, filters=None, batch=1000):
+        """
+        :return: stories in the format of DBHandler.export_stories
+        :rtype: generator
+        """
+
+        raise NotImplementedError
+
+    def import_stories(self, stories, batch=10000):
+        """
+        :return: counts in the format of DBHandler.import_stories
+        :rtype: dict
+        """
+
+        raise NotImplementedError
+
+    def pool_stats(self):
+        """
+        :return: counters in the format of ConnectionPool.stats
+        :rtype: dict
+        """
+
+        raise NotImplementedError
+
+    def close(self):
+        """
+        closes the connections held by the backend
+        """
+
+
+def get_storage(config):
+    """
+    returns the storage backend of the current process, creating it on
+    first use
+
+    :param config: flask app configuration
+    :type config: flask.Config
+    :return: backend, None for the built-in SQLite storage
+    :rtype: Storage
+    """
+
+    name = config.get('STORAGE', "sqlite")
+    if STORAGE_BACKENDS.get(name, "") is None:
+        return None
+
+    key = (os.getpid(), name, config.get('DATABASE'), config.get('POSTGRES_DSN'))
+    storage = _STORAGES.get(key)
+    if storage is not None:
+        return storage
+
+    with _STORAGES_LOCK:
+        storage = _STORAGES.get(key)
+        if storage is None:
+            if name not in STORAGE_BACKENDS:
+                raise ValueError("unknown storage backend {}".format(name))
+            module, cls = STORAGE_BACKENDS[name].rsplit(".", 1)
+            storage = getattr(importlib.import_module(module), cls)(config)
+            _STORAGES[key] = storage
+            LOG.debug("initialized %s storage for process %s", name, key[0])
+    return storage
@@ -0,0 +1,273 @@
+"""
+contains the in-memory representation of a story and the rules used to
+append words to it
+"""
+
+import time
+
+
+# index of modifying table
+MOD_TITLE = 0
+MOD_PARA = 1
+MOD_SENT = 2
+
+# limits of a story
+SENTENCE_WORDS = 15
+PARAGRAPH_SENTENCES = 10
+# cursor value at which a story is complete, the update_modifying trigger
+# in init.sql flips it to "no"
+COMPLETE = [0, 6, 9]
+# sentence index past the last one of any paragraph, ends a range of a
+# story with a whole paragraph
+PARAGRAPH_END = 2 ** 31 - 1
+
+
+def utc_now():
+    """
+    current UTC time in the format produced by SQLite's datetime('now')
+
+    :return: timestamp
+    :rtype: str
+    """
+
+    return time.strftime("%Y-%m-%d %H:%M:%S", time.gmtime())
+
+
+def build_paragraphs(rows):
+    """
+    nests sentence rows into the paragraphs format of the API
+
+    :param rows: (para_idx, text) pairs ordered by paragraph and sentence
+    :type rows: iterable
+    :return: paragraphs, e.g. [{"sentences": ["hi!"]}]
+    :rtype: list
+    """
+
+    paragraphs = []
+    last_para = None
+    for para_idx, text in rows:
+        if para_idx != last_para:
+            paragraphs.append(dict({"sentences": []}))
+            last_para = para_idx
+        paragraphs[-1]["sentences"].append(text)
+    return paragraphs
+
+
+def story_part(sentences, start=(0, 0), end=None, tail=None):
+    """
+    selects the sentences of a range of a story
+
+    :param sentences: (para_idx, sent_idx, text) of the sentences of a
+        story, or of a part of it holding the range, in order
+    :type sentences: list
+    :param start: (para_idx, sent_idx) of the first sentence of the range
+    :type start: tuple
+    :param end: (para_idx, sent_idx) of the last sentence of the range,
+        None for the end of the story
+    :type end: tuple
+    :param tail: number of sentences kept from the end of the range, None
+        for all of them
+    :type tail: int
+    :return: position of the first selected sentence, e.g.
+        {"paragraph": 2, "sentence": 0}, None if none is selected, and the
+        selected sentences in the paragraphs format of the API
+    :rtype: tuple
+    """
+
+    selected = [
+        sentence for sentence in sentences
+        if tuple(sentence[:2]) >= tuple(start) and (end is None or tuple(sentence[:2]) <= tuple(end))
+    ]
+    if tail is not None:
+        selected = selected[max(len(selected) - tail, 0):]
+    if len(selected) == 0:
+        return None, []
+    offset = dict({"paragraph": selected[0][0], "sentence": selected[0][1]})
+    return offset, build_paragraphs((para_idx, text) for para_idx, _, text in selected)
+
+
+class StoryCursor:
+    """
+    position of the next word in a story, as stored in the modifying column
+
+    Along with the position, the number of words in the sentence under the
+    cursor is tracked so that the rollover rules never need the text of the
+    story.
+    """
+
+    def __init__(self, modifying, sent_words=0):
+        """
+        :param modifying: cursor as stored in the modifying column, e.g. "0|1|4"
+        :type modifying: str
+        :param sent_words: number of words in the sentence under the cursor
+        :type sent_words: int
+        """
+
+        self.position = [int(x) for x in modifying.split('|')]
+        self.sent_words = sent_words
+
+    def __str__(self):
+        return "|".join(map(str, self.position))
+
+    @property
+    def title(self):
+        """
+        whether the next word goes to the title
+        """
+
+        return bool(self.position[MOD_TITLE])
+
+    @property
+    def para(self):
+        return self.position[MOD_PARA]
+
+    @property
+    def sent(self):
+        return self.position[MOD_SENT]
+
+    @property
+    def completed(self):
+        """
+        whether the story has reached its last sentence
+        """
+
+        return self.position == COMPLETE
+
+    def title_written(self):
+        """
+        records that the title has received its word
+        """
+
+        self.position[MOD_TITLE] = 0
+
+    def next_sentence(self):
+        """
+        moves the cursor to the next sentence or paragraph if the sentence
+        under it is full
+
+        :return: whether the next word starts a new sentence
+        :rtype: bool
+        """
+
+        if self.sent_words < SENTENCE_WORDS:
+            return False
+
+        if self.position[MOD_SENT] < PARAGRAPH_SENTENCES - 1:
+            self.position[MOD_SENT] += 1
+        else:
+            self.position[MOD_SENT] = 0
+            self.position[MOD_PARA] += 1
+        self.sent_words = 0
+        return True
+
+    def word_written(self):
+        """
+        records a word added to the sentence under the cursor
+        """
+
+        self.sent_words += 1
+        # corner case for moving the cursor to "0|6|9" as soon as the last
+        # sentence is full, so the trigger marks the story as complete
+        last_sentence = [COMPLETE[MOD_PARA], COMPLETE[MOD_SENT] - 1]
+        if self.position[MOD_PARA:] == last_sentence and self.sent_words >= SENTENCE_WORDS:
+            self.position[MOD_SENT] += 1
+
+
+class ActiveStory:
+    """
+    structured, mutable form of the story that is currently being written
+
+    Appending a word does not depend on the length of the story. The
+    positions of sentences changed since the last commit are kept in
+    ``dirty``.
+    """
+
+    def __init__(self, id, title, modifying, paragraphs, created_at=None, updated_at=None):
+        """
+        :param id: id of the story
+        :type id: int
+        :param title: title of the story
+        :type title: str
+        :param modifying: cursor as stored in the modifying column, e.g. "0|1|4"
+        :type modifying: str
+        :param paragraphs: paragraphs in the API format
+        :type paragraphs: list
+        :param created_at: creation timestamp
+        :type created_at: str
+        :param updated_at: last update timestamp
+        :type updated_at: str
+        """
+
+        self.id = id
+        self.title = title
+        self.paragraphs = paragraphs
+        self.created_at = created_at
+        self.updated_at = updated_at
+        self.cursor = StoryCursor(modifying)
+        try:
+            self.cursor.sent_words = len(self.paragraphs[self.cursor.para]["sentences"][self.cursor.sent].split())
+        except IndexError:
+            pass
+        self.words = len(title.split()) + sum(
+            len(sent.split()) for para in self.paragraphs for sent in para["sentences"]
+        )
+        self.dirty = set()
+
+    @property
+    def completed(self):
+        """
+        whether the story has reached its last sentence
+        """
+
+        return self.cursor.completed
+
+    @property
+    def current_sentence(self):
+        """
+        sentence that the last word was added to
+        """
+
+        last_para = self.paragraphs[-1]["sentences"]
+        return last_para[-1] if last_para else ""
+
+    def append(self, word):
+        """
+        adds a word to the title or to the sentence under the cursor, moving
+        on to the next sentence or paragraph when the current one is full
+
+        :param word: word to be added
+        :type word: str
+        """
+
+        self.words += 1
+        if self.cursor.title:
+            self.title = self.title + " " + word
+            self.cursor.title_written()
+            return
+
+        if self.cursor.next_sentence():
+            if self.cursor.sent == 0:
+                self.paragraphs.append(dict({"sentences": []}))
+            self.paragraphs[self.cursor.para]["sentences"].append("")
+
+        para, sent = self.cursor.para, self.cursor.sent
+        sentences = self.paragraphs[para]["sentences"]
+        sentences[sent] = sentences[sent] + (" " if sentences[sent] != "" else "") + word
+        self.dirty.add((para, sent))
+        self.cursor.word_written()
+
+    def to_dict(self):
+        """
+        story in the response format of the API
+
+        :return: story with decoded paragraphs
+        :rtype: dict
+        """
+
+        return dict({
+            "id": self.id,
+            "title": self.title,
+            "created_at": self.created_at,
+            "updated_at": self.updated_at,
+            "paragraphs": self.paragraphs
+        })
@@ -0,0 +1,95 @@
+"""
+contains the request traces used by the load generator
+
+A trace is a JSON lines file with one request per line:
+
+    {"t": 1545000000.0124, "method": "POST", "path": "/add", "headers": {"Content-Type": "application/json"}, "body": "{\"word\": \"lorem\"}"}
+
+``t`` is the time the request was received, in seconds since the epoch,
+and replays keep the gaps between requests when asked to. With
+``COLLAB_TRACE`` set to a file, every request served by the app is appended
+to it, so live traffic can be replayed later with ``python -m collab.bench
+replay``.
+"""
+
+import io
+import os
+import json
+import time
+import logging
+
+
+LOG = logging.getLogger(__name__)
+
+# request headers kept in traces, others vary between clients
+TRACE_HEADERS = ("Content-Type", "Accept", "If-None-Match", "If-Modified-Since", "Last-Event-ID")
+
+
+class TraceRecorder:
+    """
+    WSGI middleware appending every request to a trace file
+    """
+
+    def __init__(self, wsgi_app, path):
+        """
+        :param wsgi_app: WSGI app to be traced
+        :type wsgi_app: callable
+        :param path: trace file, appended to
+        :type path: str
+        """
+
+        self.wsgi_app = wsgi_app
+        self.path = path
+        # lines are written with a single call to an O_APPEND descriptor, so
+        # the workers of a gunicorn server can share the file
+        self._fd = os.open(path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        LOG.info("recording requests to %s", path)
+
+    def __call__(self, environ, start_response):
+        length = int(environ.get("CONTENT_LENGTH") or 0)
+        body = environ["wsgi.input"].read(length) if length > 0 else b""
+        environ["wsgi.input"] = io.BytesIO(body)
+
+        path = environ.get("PATH_INFO", "")
+        if environ.get("QUERY_STRING"):
+            path += "?" + environ["QUERY_STRING"]
+        headers = dict()
+        for name in TRACE_HEADERS:
+            key = "CONTENT_TYPE" if name == "Content-Type" else "HTTP_" + name.upper().replace("-", "_")
+            if environ.get(key):
+                headers[name] = environ[key]
+
+        entry = dict({
+            "t": round(time.time(), 6),
+            "method": environ["REQUEST_METHOD"],
+            "path": path,
+            "headers": headers,
+            "body": body.decode("utf-8", errors="replace") if body else None
+        })
+        os.write(self._fd, (json.dumps(entry) + "\n").encode("utf-8"))
+        return self.wsgi_app(environ, start_response)
+
+
+def read_trace(path):
+    """
+    :param path: trace file
+    :type path: str
+    :return: requests of the trace, in order
+    :rtype: list
+    """
+
+    with open(path, encoding="utf-8") as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def write_trace(path, requests):
+    """
+    :param path: trace file, overwritten
+    :type path: str
+    :param requests: requests in the trace format
+    :type requests: list
+    """
+
+    with open(path, "w", encoding="utf-8") as f:
+        for entry in requests:
+            f.write(json.dumps(entry) + "\n")
@@ -0,0 +1,155 @@
+"""
+contains the bulk export and import of stories as newline-delimited JSON
+
+Every line holds one story in the format of DBHandler.export_stories, so
+an export can be imported into another database as it is:
+
+    flask --app collab export-stories stories.ndjson --created-from "2019-03-01 00:00:00"
+    flask --app collab import-stories stories.ndjson
+"""
+
+import logging
+
+import click
+
+from flask.cli import with_appcontext
+
+from .db_hanlder import DBHandler, EXPORT_FILTERS
+from .helpers import parse_timestamp
+from . import serialize
+
+
+LOG = logging.getLogger(__name__)
+
+
+def export_filters(values):
+    """
+    checks the filters of an export
+
+    :param values: values of EXPORT_FILTERS as strings, missing ones None
+    :type values: dict
+    :raises ValueError: a value is not an id or a timestamp as stored
+        by SQLite, e.g. "2018-12-01 00:01:00"
+    :return: filters for DBHandler.export_stories
+    :rtype: dict
+    """
+
+    filters = dict()
+    for key in EXPORT_FILTERS:
+        value = values.get(key)
+        if value is None:
+            continue
+        if key.startswith("id_"):
+            filters[key] = int(value)
+        elif parse_timestamp(value) is None:
+            raise ValueError("{} is not a timestamp: {}".format(key, value))
+        else:
+            filters[key] = value
+    return filters
+
+
+def export_lines(filters=None, batch=1000):
+    """
+    :param filters: filters for DBHandler.export_stories
+    :type filters: dict
+    :param batch: number of rows fetched at a time
+    :type batch: int
+    :return: one line of JSON per story
+    :rtype: generator
+    """
+
+    for story in DBHandler.export_stories(filters, batch):
+        yield serialize.dumps(story) + b"\n"
+
+
+def read_lines(lines):
+    """
+    decodes and checks the stories of an export
+
+    :param lines: lines of an export, blank lines are skipped
+    :type lines: iterable
+    :raises ValueError: a line is not a story, along with its number
+    :return: stories in the format of DBHandler.export_stories
+    :rtype: generator
+    """
+
+    for number, line in enumerate(lines, 1):
+        if not line.strip():
+            continue
+        try:
+            story = serialize.loads(line)
+            record = dict({
+                "id": int(story["id"]),
+                "title": str(story["title"]),
+                "created_at": story["created_at"],
+                "updated_at": story.get("updated_at") or story["created_at"],
+                "modifying": story.get("modifying", "no"),
+                "room": str(story.get("room") or ""),
+                "paragraphs": [
+                    dict({"sentences": [str(text) for text in paragraph["sentences"]]})
+                    for paragraph in story["paragraphs"]
+                ]
+            })
+            if len(record["paragraphs"]) == 0 or len(record["paragraphs"][0]["sentences"]) == 0:
+                raise ValueError("a story has at least one sentence")
+            record["words"] = int(story.get("words") or len(record["title"].split()) + sum(
+                len(text.split()) for paragraph in record["paragraphs"] for text in paragraph["sentences"]
+            ))
+        except (KeyError, TypeError, ValueError) as err:
+            raise ValueError("line {} is not a story: {}".format(number, err))
+        yield record
+
+
+def _filter_options(command):
+    for key in reversed(list(EXPORT_FILTERS)):
+        command = click.option(
+            "--" + key.replace("_", "-"), key, default=None,
+            help="story id" if key.startswith("id_") else "timestamp, e.g. \"2018-12-01 00:01:00\""
+        )(command)
+    return command
+
+
+@click.command("export-stories")
+@click.argument("destination", type=click.File("wb"))
+@click.option("--batch", type=int, default=1000, help="rows fetched at a time")
+@_filter_options
+@with_appcontext
+def export_command(destination, batch, **values):
+    """
+    writes the stories matching the filters to the file DESTINATION as
+    newline-delimited JSON
+    """
+
+    try:
+        filters = export_filters(values)
+    except ValueError as err:
+        raise click.BadParameter(str(err))
+
+    count = 0
+    for line in export_lines(filters, batch):
+        destination.write(line)
+        count += 1
+    destination.flush()
+    click.echo("exported {} stories".format(count), err=True)
+
+
+@click.command("import-stories")
+@click.argument("source", type=click.File("rb"))
+@click.option("--batch", type=int, default=10000, help="stories per transaction")
+@with_appcontext
+def import_command(source, batch):
+    """
+    loads the stories of the newline-delimited JSON file SOURCE ("-" for
+    stdin), skipping those whose id is taken and completing active ones
+    whose room has an active story
+    """
+
+    try:
+        counts = DBHandler.import_stories(read_lines(source), batch)
+    except ValueError as err:
+        raise click.ClickException(str(err))
+    if len(counts) == 0:
+        raise click.ClickException("import failed, see the logs")
+    click.echo("imported {} stories, skipped {}, completed {} active ones whose room had one".format(
+        counts["imported"], counts["skipped"], counts["closed"]
+    ), err=True)
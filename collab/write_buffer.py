@@ -0,0 +1,397 @@
+"""
+contains the optional write-behind buffer for the active stories
+
+With ``WRITE_BEHIND`` enabled, the story that is being written is kept in
+memory and words are appended to it without touching SQLite. The story is
+written back in group commits, after ``WRITE_BEHIND_MAX_WORDS`` words or
+``WRITE_BEHIND_INTERVAL`` seconds, whichever comes first, and always when
+the story is completed or the process exits. Every accepted word is first
+appended to a small word log, which is replayed on startup so words that
+were not yet committed survive a crash.
+
+The buffer owns the active stories of its process, one per room, so
+write-behind mode must be served by a single worker process.
+"""
+
+import os
+import json
+import atexit
+import sqlite3
+import logging
+import threading
+
+from .pool import get_pool
+from .metrics import get_registry
+from .story import ActiveStory, build_paragraphs, utc_now
+
+
+LOG = logging.getLogger(__name__)
+
+_BUFFERS = dict()
+_BUFFERS_LOCK = threading.Lock()
+
+
+class WriteBuffer:
+    """
+    in-memory active stories with group commits and a replayable word log
+
+    There is one active story per room (see story.room_of), each appended
+    to under a lock of its own, so words of different rooms do not wait
+    for each other.
+    """
+
+    def __init__(self, pool, log_path, max_words=500, interval=0.5, fsync=False):
+        """
+        :param pool: connection pool of the database
+        :type pool: collab.pool.ConnectionPool
+        :param log_path: path of the append-only word log
+        :type log_path: str
+        :param max_words: pending words of a room that trigger a commit
+        :type max_words: int
+        :param interval: seconds after which pending words are committed
+        :type interval: float
+        :param fsync: fsync the word log after every word
+        :type fsync: bool
+        """
+
+        self.pool = pool
+        self.log_path = log_path
+        self.max_words = int(max_words)
+        self.interval = float(interval)
+        self.fsync = fsync
+
+        # active story and number of uncommitted words of each room
+        self.stories = dict()
+        self.pending = dict()
+        self._lock = threading.Lock()
+        self._room_locks = dict()
+        self._log_lock = threading.Lock()
+        self._stop = threading.Event()
+
+        self._log = open(self.log_path, "a", encoding="utf-8")
+        self._load()
+        self._replay()
+
+        self._flusher = threading.Thread(target=self._run, name="collab-write-buffer", daemon=True)
+        self._flusher.start()
+
+    def _room_lock(self, room):
+        """
+        :param room: room of the story
+        :type room: str
+        :return: lock of the room's active story
+        :rtype: threading.RLock
+        """
+
+        with self._lock:
+            lock = self._room_locks.get(room)
+            if lock is None:
+                lock = self._room_locks[room] = threading.RLock()
+            return lock
+
+    def _read(self, story_id):
+        """
+        :param story_id: id of the story
+        :type story_id: int
+        :return: the story as it is in the database
+        :rtype: ActiveStory
+        """
+
+        with self.pool.connection() as conn:
+            row = conn.execute(
+                "SELECT id, modifying, title, created_at, updated_at FROM stories WHERE id = ?;", (story_id,)
+            ).fetchone()
+            sentences = conn.execute(
+                "SELECT para_idx, text FROM sentences WHERE story_id = ? ORDER BY para_idx, sent_idx;", (story_id,)
+            ).fetchall()
+        return ActiveStory(
+            row["id"],
+            row["title"],
+            row["modifying"],
+            build_paragraphs(sentences),
+            row["created_at"],
+            row["updated_at"]
+        )
+
+    def _load(self):
+        """
+        loads the active story of every room from the database
+        """
+
+        with self.pool.connection() as conn:
+            rows = conn.execute("SELECT id, room FROM stories WHERE modifying != 'no';").fetchall()
+        for row in rows:
+            self.stories[row["room"]] = self._read(row["id"])
+
+    def _replay(self):
+        """
+        applies words from the word log that were not committed before the
+        last shutdown and commits them
+
+        Each log record carries the story id, its room and the word count
+        of the story after the word was added, so records that did reach
+        the database are skipped.
+        """
+
+        replayed = 0
+        with open(self.log_path, "r", encoding="utf-8") as f:
+            records = [json.loads(line) for line in f if line.endswith("\n")]
+
+        committed = dict({room: story.words for room, story in self.stories.items()})
+        for record in records:
+            room = record.get("r", "")
+            story = self.stories.get(room)
+            if story is not None and record["id"] == story.id and record["n"] > committed[room]:
+                story.append(record["w"])
+                story.updated_at = record["t"]
+                committed[room] = story.words
+                self.pending[room] = self.pending.get(room, 0) + 1
+                replayed += 1
+
+        if replayed:
+            LOG.warning("replayed %s uncommitted words from %s", replayed, self.log_path)
+            self.flush()
+        else:
+            self._log.truncate(0)
+
+    def _run(self):
+        """
+        background loop committing pending words every interval
+        """
+
+        while not self._stop.wait(self.interval):
+            try:
+                self.flush()
+            except sqlite3.Error as err:
+                LOG.debug(err)
+                LOG.error("failed to commit buffered words, retrying in %ss", self.interval)
+
+    def _create(self, word, room):
+        """
+        inserts a new story and makes it the active one of its room
+
+        :param word: first word of the title
+        :type word: str
+        :param room: room of the story
+        :type room: str
+        """
+
+        with self.pool.connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute("INSERT INTO stories (title, room) VALUES (?, ?);", (word, room))
+            conn.commit()
+        self.stories[room] = self._read(cursor.lastrowid)
+
+    def add_word(self, word, room=""):
+        """
+        appends a word to the active story of a room in memory, creating a
+        story if none is active
+
+        :param word: word to be added
+        :type word: str
+        :param room: room of the story
+        :type room: str
+        :return: story without paragraphs, with the sentence the word went to
+        :rtype: dict
+        """
+
+        with self._room_lock(room):
+            story = self.stories.get(room)
+            if story is not None and story.completed:
+                # an earlier commit of the completed story failed
+                self._flush_room(room)
+                story = self.stories.get(room)
+
+            if story is None:
+                self._create(word, room)
+                story = self.stories[room]
+            else:
+                story.append(word)
+                story.updated_at = utc_now()
+                record = dict({"id": story.id, "n": story.words, "w": word, "t": story.updated_at})
+                if room:
+                    record["r"] = room
+                with self._log_lock:
+                    self._log.write(json.dumps(record) + "\n")
+                    self._log.flush()
+                    if self.fsync:
+                        with get_registry().time("collab_wordlog_fsync_duration_seconds"):
+                            os.fsync(self._log.fileno())
+                    self.pending[room] = self.pending.get(room, 0) + 1
+
+            resp = dict({
+                "id": story.id,
+                "title": story.title,
+                "created_at": story.created_at,
+                "updated_at": story.updated_at,
+                "words": story.words,
+                "current_sentence": story.current_sentence
+            })
+
+            if story.completed or self.pending.get(room, 0) >= self.max_words:
+                self._flush_room(room)
+        return resp
+
+    def add_words(self, words, room=""):
+        """
+        appends an ordered list of words while holding the room
+
+        :param words: words to be added, in order
+        :type words: list
+        :param room: room of the stories
+        :type room: str
+        :return: one entry per word in the format returned by add_word
+        :rtype: list
+        """
+
+        with self._room_lock(room):
+            return [self.add_word(word, room) for word in words]
+
+    def _flush_room(self, room):
+        """
+        commits the in-memory active story of a room, and clears the word
+        log once no room has uncommitted words
+
+        :param room: room of the story, whose lock is held by the caller
+        :type room: str
+        """
+
+        story = self.stories.get(room)
+        if story is None or self.pending.get(room, 0) == 0:
+            return
+
+        sentences = []
+        for para_idx, sent_idx in story.dirty:
+            text = story.paragraphs[para_idx]["sentences"][sent_idx]
+            sentences.append((story.id, para_idx, sent_idx, text, len(text.split())))
+
+        with self.pool.connection() as conn:
+            conn.executemany(
+                "INSERT OR REPLACE INTO sentences (story_id, para_idx, sent_idx, text, word_count) VALUES (?, ?, ?, ?, ?);",
+                sentences
+            )
+            conn.execute(
+                "UPDATE stories SET updated_at = ?, modifying = ?, title = ?, words = ? WHERE id = ?;",
+                (story.updated_at, str(story.cursor), story.title, story.words, story.id)
+            )
+            conn.commit()
+        story.dirty.clear()
+
+        with self._log_lock:
+            LOG.debug("committed %s buffered words of story (id=%s)", self.pending[room], story.id)
+            self.pending[room] = 0
+            if not any(self.pending.values()):
+                self._log.truncate(0)
+        if story.completed:
+            self.stories.pop(room)
+
+    def flush(self):
+        """
+        commits the in-memory active story of every room and clears the
+        word log
+        """
+
+        with self._lock:
+            rooms = list(self.stories)
+        for room in rooms:
+            with self._room_lock(room):
+                self._flush_room(room)
+
+    def _buffered(self, id):
+        """
+        :param id: id of the story
+        :type id: int
+        :return: room of the story if it is buffered, None otherwise
+        :rtype: str
+        """
+
+        with self._lock:
+            for room, story in list(self.stories.items()):
+                if story.id == id:
+                    return room
+        return None
+
+    def get_story(self, id):
+        """
+        returns the buffered story if it is the one asked for
+
+        :param id: id of the story
+        :type id: int
+        :return: story in the API format and its version (updated_at and
+            words), or None if it is not buffered
+        :rtype: tuple
+        """
+
+        room = self._buffered(id)
+        if room is None:
+            return None
+        with self._room_lock(room):
+            story = self.stories.get(room)
+            if story is None or story.id != id:
+                return None
+            body = story.to_dict()
+            body["paragraphs"] = [dict({"sentences": list(para["sentences"])}) for para in body["paragraphs"]]
+            return body, dict({"updated_at": story.updated_at, "words": story.words})
+
+    def get_version(self, id):
+        """
+        returns the version of the buffered story if it is the one asked for
+
+        :param id: id of the story
+        :type id: int
+        :return: updated_at and words, or None if it is not buffered
+        :rtype: dict
+        """
+
+        room = self._buffered(id)
+        if room is None:
+            return None
+        with self._room_lock(room):
+            story = self.stories.get(room)
+            if story is None or story.id != id:
+                return None
+            return dict({"updated_at": story.updated_at, "words": story.words})
+
+    def close(self):
+        """
+        stops the background committer and commits pending words
+        """
+
+        self._stop.set()
+        try:
+            self.flush()
+        except sqlite3.Error as err:
+            LOG.debug(err)
+            LOG.error("failed to commit buffered words on shutdown, they remain in %s", self.log_path)
+        self._log.close()
+
+
+def get_write_buffer(config):
+    """
+    returns the write buffer of the current process, creating it on first use
+
+    :param config: flask app configuration
+    :type config: flask.Config
+    :return: write buffer
+    :rtype: WriteBuffer
+    """
+
+    key = (os.getpid(), config['DATABASE'])
+    buffer = _BUFFERS.get(key)
+    if buffer is not None:
+        return buffer
+
+    with _BUFFERS_LOCK:
+        buffer = _BUFFERS.get(key)
+        if buffer is None:
+            buffer = WriteBuffer(
+                get_pool(config),
+                config['WORD_LOG'],
+                max_words=config.get('WRITE_BEHIND_MAX_WORDS', 500),
+                interval=config.get('WRITE_BEHIND_INTERVAL', 0.5),
+                fsync=config.get('WRITE_BEHIND_FSYNC', False)
+            )
+            atexit.register(buffer.close)
+            _BUFFERS[key] = buffer
+            LOG.info("write-behind buffer enabled (max_words=%s, interval=%ss)", buffer.max_words, buffer.interval)
+    return buffer
@@ -0,0 +1,379 @@
+"""
+contains the single writer that owns every story mutation
+
+With ``WRITER`` enabled, words are not written by the worker that received
+them. Each worker sends them over a Unix socket to the writer, which runs
+in whichever worker process holds the writer lock file. The writer puts
+requests in a bounded queue and applies them in arrival order from a
+single thread, several per transaction. So SQLite never sees two writers,
+and ordering is deterministic. When the queue is full, requests are turned
+away at once and the worker answers 503. If the process hosting the writer
+exits, the next worker that fails to reach it takes the lock over.
+"""
+
+import os
+import time
+import queue
+import fcntl
+import select
+import socket
+import logging
+import threading
+
+from .exceptions import WriterBusy, WriterUnavailable
+from . import serialize
+
+
+LOG = logging.getLogger(__name__)
+
+_CLIENTS = dict()
+_LOCK = threading.Lock()
+
+# requests accepted over the socket
+OPS = ("add_word", "add_words", "stats")
+
+
+class _Request:
+    """
+    a mutation waiting in the writer queue
+    """
+
+    __slots__ = ("op", "args", "done", "result")
+
+    def __init__(self, op, args):
+        self.op = op
+        self.args = args
+        self.done = threading.Event()
+        self.result = None
+
+
+class Writer:
+    """
+    accepts mutations over a Unix socket and applies them from one thread
+    """
+
+    def __init__(self, app, path, lock_fd, queue_size=1024, batch=64, timeout=10.0):
+        """
+        :param app: flask app, used for an app context on the writer thread
+        :type app: flask.Flask
+        :param path: path of the Unix socket
+        :type path: str
+        :param lock_fd: descriptor of the held writer lock file
+        :type lock_fd: int
+        :param queue_size: maximum number of queued mutations
+        :type queue_size: int
+        :param batch: maximum number of mutations applied per transaction
+        :type batch: int
+        :param timeout: seconds a submitter waits for its mutation
+        :type timeout: float
+        """
+
+        self.app = app
+        self.path = path
+        self.batch = int(batch)
+        self.timeout = float(timeout)
+        self._lock_fd = lock_fd
+        self._queue = queue.Queue(maxsize=int(queue_size))
+        self._metrics_lock = threading.Lock()
+        self._metrics = dict({
+            "submitted": 0,
+            "rejected": 0,
+            "applied": 0,
+            "transactions": 0,
+            "max_depth": 0
+        })
+
+        if os.path.exists(path):
+            os.unlink(path)
+        self._server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self._server.bind(path)
+        self._server.listen(128)
+
+        threading.Thread(target=self._accept, name="collab-writer-accept", daemon=True).start()
+        threading.Thread(target=self._apply, name="collab-writer", daemon=True).start()
+        LOG.info("story writer listening on %s (pid=%s)", path, os.getpid())
+
+    def submit(self, op, args):
+        """
+        queues a mutation and waits for its result
+
+        :param op: name of the mutation, "add_word" or "add_words"
+        :type op: str
+        :param args: arguments of the mutation
+        :type args: list
+        :raises WriterBusy: the queue is full
+        :raises WriterUnavailable: the mutation was not applied within the
+            timeout, it may still be
+        :return: result of the mutation
+        """
+
+        if op == "stats":
+            return self.stats()
+
+        request = _Request(op, args)
+        try:
+            self._queue.put_nowait(request)
+        except queue.Full:
+            with self._metrics_lock:
+                self._metrics["rejected"] += 1
+            raise WriterBusy(self._queue.qsize())
+
+        with self._metrics_lock:
+            self._metrics["submitted"] += 1
+            self._metrics["max_depth"] = max(self._metrics["max_depth"], self._queue.qsize())
+        if not request.done.wait(self.timeout):
+            raise WriterUnavailable(self.path, sent=True)
+        return request.result
+
+    def _apply(self):
+        """
+        writer loop: applies queued mutations in order, grouping the ones
+        waiting in the queue into one transaction
+        """
+
+        from .db_hanlder import DBHandler
+
+        while True:
+            requests = [self._queue.get()]
+            while len(requests) < self.batch:
+                try:
+                    requests.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+
+            try:
+                with self.app.app_context():
+                    results = DBHandler._apply_mutations([(request.op, request.args) for request in requests])
+            except Exception as err:
+                # the thread must outlive any request, each of the batch
+                # gets the empty result of a failed write
+                LOG.debug(err)
+                LOG.error("FAILED: applying a group of %s writes", len(requests), exc_info=True)
+                results = [dict() if request.op == "add_word" else [] for request in requests]
+
+            with self._metrics_lock:
+                self._metrics["applied"] += len(requests)
+                self._metrics["transactions"] += 1
+            for request, result in zip(requests, results):
+                request.result = result
+                request.done.set()
+
+    def _accept(self):
+        """
+        accepts connections from workers, one thread per connection
+        """
+
+        while True:
+            conn, _ = self._server.accept()
+            threading.Thread(target=self._serve, args=(conn,), name="collab-writer-conn", daemon=True).start()
+
+    def _serve(self, conn):
+        """
+        answers the newline-delimited JSON requests of one worker connection
+
+        :param conn: connection to a worker
+        :type conn: socket.socket
+        """
+
+        with conn, conn.makefile("rwb") as stream:
+            for line in stream:
+                try:
+                    message = serialize.loads(line)
+                    op, args = message["op"], message["args"]
+                    if op not in OPS or not isinstance(args, list):
+                        raise ValueError("unknown writer request {}".format(op))
+                except (ValueError, KeyError, TypeError) as err:
+                    # nothing was queued, the worker may send it again
+                    LOG.debug(err)
+                    LOG.error("malformed request from a worker, ignoring it")
+                    reply = dict({"error": "malformed request"})
+                else:
+                    try:
+                        reply = dict({"result": self.submit(op, args)})
+                    except WriterBusy as err:
+                        reply = dict({"busy": err.depth})
+                    except WriterUnavailable:
+                        reply = dict({"unavailable": True})
+                try:
+                    stream.write(serialize.dumps(reply) + b"\n")
+                    stream.flush()
+                except OSError as err:
+                    # the worker gave up waiting and closed the connection
+                    LOG.debug(err)
+                    return
+
+    def stats(self):
+        """
+        :return: queue depth and counters of the writer
+        :rtype: dict
+        """
+
+        with self._metrics_lock:
+            stats = dict(self._metrics)
+        stats["depth"] = self._queue.qsize()
+        stats["capacity"] = self._queue.maxsize
+        stats["pid"] = os.getpid()
+        return stats
+
+
+class WriterClient:
+    """
+    sends mutations to the writer, hosting it when no other process does
+    """
+
+    def __init__(self, app, config):
+        """
+        :param app: flask app
+        :type app: flask.Flask
+        :param config: flask app configuration
+        :type config: flask.Config
+        """
+
+        self.app = app
+        self.path = config['WRITER_SOCKET']
+        self.lock_path = config['WRITER_LOCK']
+        self.timeout = float(config.get('WRITER_TIMEOUT', 10.0))
+        self.queue_size = config.get('WRITER_QUEUE_SIZE', 1024)
+        self.batch = config.get('WRITER_BATCH', 64)
+        self.writer = None
+        self._local = threading.local()
+        self._elect_lock = threading.Lock()
+
+    def _elect(self):
+        """
+        starts the writer in this process if no other process holds the lock
+
+        :return: whether this process hosts the writer
+        :rtype: bool
+        """
+
+        with self._elect_lock:
+            if self.writer is not None:
+                return True
+            fd = os.open(self.lock_path, os.O_RDWR | os.O_CREAT, 0o600)
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except OSError:
+                os.close(fd)
+                return False
+            self.writer = Writer(self.app, self.path, fd, self.queue_size, self.batch, self.timeout)
+            return True
+
+    def _connection(self):
+        """
+        :return: this thread's connection to the writer
+        :rtype: file object
+        """
+
+        stream = getattr(self._local, "stream", None)
+        if stream is not None and select.select([self._local.sock], [], [], 0)[0]:
+            # nothing is sent unasked: the writer closed the connection, e.g.
+            # because its process exited, so reconnect before sending
+            self._drop_connection()
+            stream = None
+        if stream is None:
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            sock.settimeout(self.timeout)
+            sock.connect(self.path)
+            stream = sock.makefile("rwb")
+            self._local.sock = sock
+            self._local.stream = stream
+        return stream
+
+    def _drop_connection(self):
+        stream = getattr(self._local, "stream", None)
+        if stream is not None:
+            try:
+                stream.close()
+                self._local.sock.close()
+            except OSError:
+                pass
+        self._local.stream = None
+
+    @property
+    def is_host(self):
+        """
+        whether the writer runs in this process
+        """
+
+        return self.writer is not None
+
+    def submit(self, op, args):
+        """
+        sends a mutation to the writer and waits for its result
+
+        :param op: name of the mutation, "add_word", "add_words" or "stats"
+        :type op: str
+        :param args: arguments of the mutation
+        :type args: list
+        :raises WriterBusy: the writer queue is full
+        :raises WriterUnavailable: the writer could not be reached
+        :return: result of the mutation
+        """
+
+        if self.writer is None:
+            self._elect()
+        if self.writer is not None:
+            return self.writer.submit(op, args)
+
+        message = serialize.dumps(dict({"op": op, "args": args})) + b"\n"
+        for attempt in range(2):
+            try:
+                stream = self._connection()
+                stream.write(message)
+                stream.flush()
+                break
+            except OSError as err:
+                LOG.debug(err)
+                self._drop_connection()
+                # the process hosting the writer may have exited
+                if attempt == 0 and self._elect():
+                    return self.writer.submit(op, args)
+                if attempt == 0:
+                    time.sleep(0.05)
+                    continue
+                raise WriterUnavailable(self.path)
+
+        # once sent, the mutation may be queued or applied: it is never sent
+        # again, whether the reply times out or the connection drops
+        try:
+            line = stream.readline()
+            if not line:
+                raise ConnectionError("writer closed the connection")
+            reply = serialize.loads(line)
+        except (OSError, ValueError) as err:
+            LOG.debug(err)
+            self._drop_connection()
+            raise WriterUnavailable(self.path, sent=True)
+
+        if "busy" in reply:
+            raise WriterBusy(reply["busy"])
+        if "unavailable" in reply:
+            raise WriterUnavailable(self.path, sent=True)
+        if "error" in reply:
+            # the writer could not read the request and queued nothing
+            raise WriterUnavailable(self.path)
+        return reply["result"]
+
+
+def get_writer_client(app):
+    """
+    returns the writer client of the current process, creating it on first use
+
+    :param app: flask app
+    :type app: flask.Flask
+    :return: writer client
+    :rtype: WriterClient
+    """
+
+    key = (os.getpid(), app.config['DATABASE'])
+    client = _CLIENTS.get(key)
+    if client is not None:
+        return client
+
+    with _LOCK:
+        client = _CLIENTS.get(key)
+        if client is None:
+            client = WriterClient(app, app.config)
+            _CLIENTS[key] = client
+    return client
@@ -0,0 +1,47 @@
+"""
+contains the conformance checks of the storage backends, run by pytest
+
+SQLite is always checked. PostgreSQL is checked when
+``COLLAB_TEST_POSTGRES_DSN`` names a throwaway database, whose tables are
+dropped first:
+
+    COLLAB_TEST_POSTGRES_DSN=postgresql://collab@localhost/collab_test python -m pytest tests
+"""
+
+import os
+
+import pytest
+
+from collab.bench import _target
+from collab.conformance import run_checks, _reset_postgres
+
+
+POSTGRES_DSN = os.environ.get("COLLAB_TEST_POSTGRES_DSN")
+
+
+def _run(tmp_path, config):
+    """
+    :return: failed checks and transcript of the session, see run_checks
+    :rtype: dict
+    """
+
+    return run_checks(_target(None, str(tmp_path), config).app, clients=4, words=25)
+
+
+@pytest.fixture(scope="module")
+def sqlite_result(tmp_path_factory):
+    return _run(tmp_path_factory.mktemp("sqlite"), dict({"STORAGE": "sqlite"}))
+
+
+def test_sqlite(sqlite_result):
+    assert sqlite_result["failures"] == []
+
+
+@pytest.mark.skipif(POSTGRES_DSN is None, reason="COLLAB_TEST_POSTGRES_DSN is not set")
+def test_postgres(tmp_path, sqlite_result):
+    pytest.importorskip("psycopg")
+    _reset_postgres(POSTGRES_DSN, True)
+    result = _run(tmp_path, dict({"STORAGE": "postgres", "POSTGRES_DSN": POSTGRES_DSN}))
+    assert result["failures"] == []
+    # the same responses as SQLite, timestamps and ETags left out
+    assert result["transcript"] == sqlite_result["transcript"]
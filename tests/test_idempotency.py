@@ -0,0 +1,49 @@
+"""
+contains the checks of the idempotency store, run by pytest against SQLite
+and, when ``COLLAB_TEST_POSTGRES_DSN`` is set, PostgreSQL
+"""
+
+import os
+import time
+
+import pytest
+
+from collab.bench import _target
+from collab.conformance import _reset_postgres
+from collab.idempotency import get_idempotency_store, CLAIMED, REPLAYED
+
+
+POSTGRES_DSN = os.environ.get("COLLAB_TEST_POSTGRES_DSN")
+STORAGES = [
+    "sqlite",
+    pytest.param("postgres", marks=pytest.mark.skipif(POSTGRES_DSN is None, reason="COLLAB_TEST_POSTGRES_DSN is not set"))
+]
+
+
+@pytest.fixture(params=STORAGES)
+def store(request, tmp_path):
+    config = dict({"STORAGE": request.param})
+    if request.param == "postgres":
+        pytest.importorskip("psycopg")
+        _reset_postgres(POSTGRES_DSN, True)
+        config["POSTGRES_DSN"] = POSTGRES_DSN
+    app = _target(None, str(tmp_path), config).app
+    # the store of a DSN is shared by every app of the process
+    store = get_idempotency_store(app.config)
+    lock_timeout, store.lock_timeout = store.lock_timeout, 0.05
+    yield store
+    store.lock_timeout = lock_timeout
+
+
+def test_taken_over_claim_keeps_the_new_response(store):
+    outcome, first = store.claim("key", "request")
+    assert outcome == CLAIMED
+    time.sleep(0.1)
+    outcome, second = store.claim("key", "request")
+    assert outcome == CLAIMED
+
+    # the slow first attempt neither overwrites nor frees the new claim
+    store.release("key", first)
+    assert store.complete("key", first, 201, b"first") is False
+    assert store.complete("key", second, 200, b"second") is True
+    assert store.claim("key", "request") == (REPLAYED, (200, b"second"))
@@ -0,0 +1,65 @@
+"""
+contains the checks of the story import, run by pytest against SQLite and,
+when ``COLLAB_TEST_POSTGRES_DSN`` is set, PostgreSQL
+"""
+
+import os
+
+import pytest
+
+from collab.bench import _target
+from collab.conformance import _reset_postgres
+from collab.db_hanlder import DBHandler
+
+
+POSTGRES_DSN = os.environ.get("COLLAB_TEST_POSTGRES_DSN")
+STORAGES = [
+    "sqlite",
+    pytest.param("postgres", marks=pytest.mark.skipif(POSTGRES_DSN is None, reason="COLLAB_TEST_POSTGRES_DSN is not set"))
+]
+
+
+@pytest.fixture(params=STORAGES)
+def app(request, tmp_path):
+    config = dict({"STORAGE": request.param, "ROOMS": "keys"})
+    if request.param == "postgres":
+        pytest.importorskip("psycopg")
+        _reset_postgres(POSTGRES_DSN, True)
+        config["POSTGRES_DSN"] = POSTGRES_DSN
+    return _target(None, str(tmp_path), config).app
+
+
+def _story(id, room, modifying):
+    return dict({
+        "id": id,
+        "title": "t{}".format(id),
+        "created_at": "2019-01-01 00:00:00",
+        "updated_at": "2019-01-01 00:00:00",
+        "modifying": modifying,
+        "words": 1,
+        "room": room,
+        "paragraphs": [dict({"sentences": [""]})]
+    })
+
+
+def test_import_completes_clashing_active_stories(app):
+    client = app.test_client()
+    assert client.post("/add", json=dict({"word": "live", "room": "a"})).status_code in (200, 201)
+
+    stories = [
+        _story(100, "a", "1|0|0"),  # room a has an active story already
+        _story(101, "b", "1|0|0"),
+        _story(102, "b", "1|0|0"),  # second active story of room b in the file
+        _story(103, "c", "no")
+    ]
+    with app.app_context():
+        counts = DBHandler.import_stories(stories, batch=2)
+        assert counts == dict({"imported": 4, "skipped": 0, "closed": 2})
+        active = sorted(
+            (story["room"], story["id"]) for story in DBHandler.export_stories() if story["modifying"] != "no"
+        )
+    assert active == [("a", 1), ("b", 101)]
+
+    # the live story of each room keeps getting the words
+    assert client.post("/add", json=dict({"word": "more", "room": "a"})).get_json()["id"] == 1
+    assert client.post("/add", json=dict({"word": "more", "room": "b"})).get_json()["id"] == 101